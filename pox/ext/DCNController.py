@@ -29,32 +29,112 @@ Works with openflow.spanning_tree
 
 from pox.core import core
 import pox.openflow.libopenflow_01 as of
+import pox.lib.packet as pkt
 from pox.lib.revent import *
 from pox.lib.recoco import Timer
 from collections import defaultdict
 from pox.openflow.discovery import Discovery
-from pox.lib.util import dpid_to_str
+from pox.lib.util import dpid_to_str, str_to_bool
+import struct
+import threading
 import time
+from zlib import crc32
 
 log = core.getLogger()
 
 topotype = None
 
+# What IPv4 flows are matched on: 'flow' (5-tuple), 'ip' (address pair),
+# or 'mac' to forward IPv4 along the ethaddr paths ARP set up
+ecmp_match = 'flow'
+
 # Adjacency map.  [sw1][sw2] -> port from sw1 to sw2
 adjacency = defaultdict(lambda: defaultdict(lambda: None))
 
 # Switches we know of.  [dpid] -> Switch
 switches = {}
 
-# ethaddr -> (switch, port)
-mac_map = {}
+
+class MacMap(object):
+    """
+    Where ethaddrs were learned, indexed both ways
+
+    Learning, moving and unlearning an ethaddr are O(1), and unlearning
+    everything on a port touches only that port's ethaddrs.
+    """
+
+    def __init__(self):
+        self.locations = {}  # ethaddr -> (switch, port)
+        self.on_port = defaultdict(set)  # (switch, port) -> set of ethaddrs
+        self.moves = 0
+        self.unlearns = 0
+
+    def __contains__(self, mac):
+        return mac in self.locations
+
+    def __getitem__(self, mac):
+        return self.locations[mac]
+
+    def __len__(self):
+        return len(self.locations)
+
+    def get(self, mac, default=None):
+        return self.locations.get(mac, default)
+
+    def learn(self, mac, loc):
+        old = self.locations.get(mac)
+        if old == loc:
+            return
+        if old is not None:
+            self._forget(mac, old)
+            self.moves += 1
+        self.locations[mac] = loc
+        self.on_port[loc].add(mac)
+
+    def unlearn(self, mac):
+        loc = self.locations.pop(mac, None)
+        if loc is not None:
+            self._forget(mac, loc)
+            self.unlearns += 1
+
+    def unlearn_port(self, sw, port):
+        """
+        Unlearn every ethaddr learned on sw.port; return them
+        """
+        macs = self.on_port.pop((sw, port), ())
+        for mac in macs:
+            del self.locations[mac]
+        self.unlearns += len(macs)
+        return macs
+
+    def _forget(self, mac, loc):
+        macs = self.on_port[loc]
+        macs.discard(mac)
+        if not macs:
+            del self.on_port[loc]
+
+
+# Where ethaddrs were learned; ethaddr -> (switch, port)
+mac_map = MacMap()
 
 # [sw1][sw2] -> (distance, intermediate)
 path_map = defaultdict(lambda: defaultdict(lambda: [(None, None)]))
 
+# The adjacency path_map was computed from, [sw1][sw2] -> port, so paths
+# and ports agree while a newer topology is being computed
+path_adjacency = None
+
 # Waiting path.  (dpid,xid)->WaitingPath
 waiting_paths = {}
 
+# IPv4 flows installed per path.  [(src dpid, dst dpid)][dpids on path] -> n
+# Counted down again when the flow's ingress entry is removed.
+path_flows = defaultdict(lambda: defaultdict(int))
+
+# The path each counted flow is on, to count it down.
+# [(ingress dpid, match fields)] -> ((src dpid, dst dpid), dpids on path)
+path_entries = {}
+
 # Time to not flood in seconds
 FLOOD_HOLDDOWN = 5
 
@@ -62,14 +142,92 @@ FLOOD_HOLDDOWN = 5
 FLOW_IDLE_TIMEOUT = 1000
 FLOW_HARD_TIMEOUT = 2000
 
+# Idle timeout of per-flow IPv4 entries, which are far more numerous
+ECMP_IDLE_TIMEOUT = 10
+
 # How long is allowable to set up a path?
-PATH_SETUP_TIME = 1000
+PATH_SETUP_TIME = 5
+
+# Granularity in seconds of path setup expiry
+PATH_EXPIRY_RESOLUTION = 1
+
+# Seconds without link events before paths are recomputed...
+PATH_QUIET_PERIOD = 1
+# ...but never more than this after the first event of a burst
+PATH_MAX_DELAY = 5
+
 
+class ExpiryWheel(object):
+    """
+    Hashed timer wheel of objects with an expires_at time
 
-def _calc_paths():
+    Adding and removing are O(1), and expire() visits each slot once
+    per tick, so its cost is amortized O(1) per object.  Objects due
+    further out than the wheel spans stay until their slot comes round
+    again.
+    """
+
+    def __init__(self, span, resolution=PATH_EXPIRY_RESOLUTION):
+        self.resolution = resolution
+        self.slots = [set() for _ in xrange(int(span / resolution) + 2)]
+        self.cursor = int(time.time() / resolution)  # First unexpired tick
+        self.slot_of = {}  # [object] -> the slot holding it
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def add(self, obj):
+        tick = max(int(obj.expires_at / self.resolution), self.cursor)
+        slot = self.slots[tick % len(self.slots)]
+        slot.add(obj)
+        self.slot_of[obj] = slot
+
+    def remove(self, obj):
+        slot = self.slot_of.pop(obj, None)
+        if slot is not None:
+            slot.discard(obj)
+
+    def expire(self, now=None):
+        """
+        Remove and return the objects that expired before the current tick
+        """
+        if now is None:
+            now = time.time()
+        tick = int(now / self.resolution)
+        expired = []
+        # Every slot at most once, however long since the last call
+        start = max(self.cursor, tick - len(self.slots))
+        for t in xrange(start, tick):
+            slot = self.slots[t % len(self.slots)]
+            for obj in [o for o in slot if o.expires_at <= now]:
+                slot.discard(obj)
+                del self.slot_of[obj]
+                expired.append(obj)
+        self.cursor = max(self.cursor, tick)
+        return expired
+
+
+# WaitingPaths by expiry time
+pending_paths = ExpiryWheel(PATH_SETUP_TIME)
+
+# Path setups started, completed and given up on
+path_setup_stats = {'started': 0, 'completed': 0, 'expired': 0}
+
+
+def _copy_adjacency():
+    return dict((sw1, dict((sw2, port) for sw2, port in nbrs.iteritems()
+                           if port is not None))
+                for sw1, nbrs in adjacency.iteritems())
+
+
+def _calc_paths(sws, adj):
     """
     Essentially Floyd-Warshall algorithm
+
+    Returns a new path map for switches sws connected as in adj.  Touches
+    no globals, so it can run off the recoco thread.
     """
+    path_map = defaultdict(lambda: defaultdict(lambda: [(None, None)]))
 
     def dump():
         for i in sws:
@@ -80,12 +238,8 @@ def _calc_paths():
                 print a,
             print
     # print adjacency
-    sws = switches.values()
-    path_map.clear()
     for k in sws:
-        for j, port in adjacency[k].iteritems():
-            if port is None:
-                continue
+        for j, port in adj.get(k, {}).iteritems():
             path_map[k][j] = [(1, None)]
         path_map[k][k] = [(0, None)]  # distance, intermediate
     # dump()
@@ -111,6 +265,17 @@ def _calc_paths():
                             # print "--------------------"
                             # print path_map
                             # dump()
+    return path_map
+
+
+def _refresh_paths():
+    """
+    Recompute path_map right away from the current topology
+    """
+    global path_map, path_adjacency
+    adj = _copy_adjacency()
+    path_map = _calc_paths(switches.values(), adj)
+    path_adjacency = adj
 
 
 def _get_one_raw_path(src, dst):
@@ -118,7 +283,7 @@ def _get_one_raw_path(src, dst):
     Get a raw path (just a list of nodes to traverse)
     """
     if len(path_map) == 0:
-        _calc_paths()
+        _refresh_paths()
     if src is dst:
         # We're here!
         return []
@@ -138,7 +303,7 @@ def _get_multi_raw_path(src, dst):
     Get all raw paths (just multiple lists of nodes to traverse)
     """
     if len(path_map) == 0:
-        _calc_paths()
+        _refresh_paths()
     if src is dst:
         # We're here!
         return []
@@ -157,53 +322,162 @@ def _get_multi_raw_path(src, dst):
     return multi_path
 
 
-def _check_path(p):
+def _flow_match(packet):
+    """
+    Match for the IPv4 flow packet belongs to, per ecmp_match
+    """
+    ip = packet.find('ipv4')
+    match = of.ofp_match(dl_src=packet.src, dl_dst=packet.dst,
+                         dl_type=pkt.ethernet.IP_TYPE,
+                         nw_src=ip.srcip, nw_dst=ip.dstip)
+    if ecmp_match == 'flow':
+        match.nw_proto = ip.protocol
+        l4 = packet.find('tcp')
+        if l4 is None:
+            l4 = packet.find('udp')
+        if l4 is not None:
+            match.tp_src = l4.srcport
+            match.tp_dst = l4.dstport
+    return match
+
+
+def _entry_key(dpid, match):
+    """
+    Key of an IPv4 flow entry in path_entries; the fields it was installed
+    with, so a FlowRemoved match finds it however the switch wildcards it
+    """
+    return (dpid, match.in_port, match.dl_src, match.dl_dst, match.nw_src,
+            match.nw_dst, match.nw_proto, match.tp_src, match.tp_dst)
+
+
+def _count_path(key, path=None):
+    """
+    Move a counted flow onto path (a (pair, dpids) tuple), or off any
+    path when path is None
+    """
+    old = path_entries.pop(key, None)
+    if old is not None:
+        pair, dpids = old
+        counts = path_flows[pair]
+        counts[dpids] -= 1
+        if not counts[dpids]:
+            del counts[dpids]
+            if not counts:
+                del path_flows[pair]
+    if path is not None:
+        path_entries[key] = path
+        path_flows[path[0]][path[1]] += 1
+
+
+def _flow_hash(match):
+    """
+    Stable hash of an IPv4 flow, the same in both directions
+    """
+    ends = sorted([(match.nw_src.toUnsigned(), match.tp_src or 0),
+                   (match.nw_dst.toUnsigned(), match.tp_dst or 0)])
+    return crc32(struct.pack('!IHIHB', ends[0][0], ends[0][1], ends[1][0],
+                             ends[1][1], match.nw_proto or 0)) & 0xffffffff
+
+
+def _choose_raw_path(src, dst, flow_hash):
+    """
+    Pick one of the equal-cost raw paths between src and dst by flow_hash
+
+    Paths are ranked from the end with the lower dpid, so both directions
+    of a flow get the same path.
+    """
+    if dst.dpid < src.dpid:
+        path = _choose_raw_path(dst, src, flow_hash)
+        return None if path is None else path[::-1]
+    paths = _get_multi_raw_path(src, dst)
+    if not paths:
+        return None
+    paths = sorted(set(tuple(p) for p in paths),
+                   key=lambda p: [sw.dpid for sw in p])
+    return list(paths[flow_hash % len(paths)])
+
+
+def _get_structured_raw_path(src, dst, flow_hash):
+    """
+    Get a raw path from the confirmed fat-tree or BCube structure, if any
+    """
+    if not core.hasComponent("DCNStructure"):
+        return None
+    dpids = core.DCNStructure.route(src.dpid, dst.dpid, flow_hash)
+    if dpids is None:
+        return None
+    path = [switches.get(dpid) for dpid in dpids[1:-1]]
+    if None in path:
+        return None
+    return path
+
+
+def _host_seen(loc):
+    """
+    Tell structure inference, if running, where a host was seen
+    """
+    sw, port = loc
+    if core.hasComponent("DCNStructure") and \
+            core.openflow_discovery.is_edge_port(sw.dpid, port):
+        core.DCNStructure.host_at(sw.dpid)
+
+
+def _check_path(p, adj=None):
     """
     Make sure that a path is actually a string of nodes with connected ports
 
+    adj defaults to the adjacency path_map was computed from.
     returns True if path is valid
     """
+    if adj is None:
+        adj = path_adjacency
     for a, b in zip(p[:-1], p[1:]):
-        if adjacency[a[0]][b[0]] != a[2]:
+        if adj[a[0]].get(b[0]) != a[2]:
             return False
-        if adjacency[b[0]][a[0]] != b[1]:
+        if adj[b[0]].get(a[0]) != b[1]:
             return False
     return True
 
 
-def _get_path(src, dst, first_port, final_port):
+def _get_path(src, dst, first_port, final_port, flow_hash=None):
     """
     Gets a cooked path -- a list of (node,in_port,out_port)
+
+    With a flow_hash, the path is chosen among the equal-cost ones by it;
+    otherwise the first is used.  A confirmed fat-tree or BCube structure
+    gives the path directly; otherwise it comes from path_map.
     """
     # Start with a raw path...
+    structured = False
     if src == dst:
         path = [src]
-        log.info('********ALL PATHs********')
-        log.info(path)
     else:
         # print '*************', src, '******* ', dst
         # print _get_multi_raw_path(src, dst)
-        # TODO choice path
-        path = _get_multi_raw_path(src, dst)[0]
+        path = _get_structured_raw_path(src, dst, flow_hash or 0)
+        if path is not None:
+            structured = True
+        elif flow_hash is None:
+            paths = _get_multi_raw_path(src, dst)
+            path = paths[0] if paths else None
+        else:
+            path = _choose_raw_path(src, dst, flow_hash)
         if path is None:
             return None
-        log.info('********ALL PATHs********')
-        for p in _get_multi_raw_path(src, dst):
-
-            log.info([src] + p + [dst])
-
         path = [src] + path + [dst]
+        log.debug("Path %s", path)
     # print src, '---', dst, '---', path
     # Now add the ports
+    adj = adjacency if structured else path_adjacency
     r = []  # a list of (node,in_port,out_port)
     in_port = first_port
     for s1, s2 in zip(path[:-1], path[1:]):
-        out_port = adjacency[s1][s2]
+        out_port = adj[s1][s2]
         r.append((s1, in_port, out_port))
-        in_port = adjacency[s2][s1]
+        in_port = adj[s2][s1]
     r.append((dst, in_port, final_port))
 
-    assert _check_path(r), "Illegal path!"
+    assert _check_path(r, adj), "Illegal path!"
 
     return r
 
@@ -213,19 +487,22 @@ class WaitingPath(object):
     A path which is waiting for its path to be established
     """
 
-    def __init__(self, path, packet):
+    def __init__(self, path, packet, stamps=None):
         """
         xids is a sequence of (dpid,xid)
         first_switch is the DPID where the packet came from
         packet is something that can be sent in a packet_out
+        stamps is (received, parsed, routed) times for setup latency
         """
         self.expires_at = time.time() + PATH_SETUP_TIME
         self.path = path
         self.first_switch = path[0][0].dpid
         self.xids = set()
         self.packet = packet
-        if len(waiting_paths) > 1000:
-            WaitingPath.expire_waiting_paths()
+        self.stamps = stamps
+        self.sent = None  # When the last flow_mod and barrier were sent
+        pending_paths.add(self)
+        path_setup_stats['started'] += 1
 
     def add_xid(self, dpid, xid):
         self.xids.add((dpid, xid))
@@ -240,8 +517,24 @@ class WaitingPath(object):
         Called when a barrier has been received
         """
         self.xids.discard((event.dpid, event.xid))
+        latency = None
+        if self.stamps and core.hasComponent("SetupLatency"):
+            latency = core.SetupLatency
+            latency.record('DCNController', 'barrier',
+                           time.time() - self.sent, len(self.path))
         if len(self.xids) == 0:
             # Done!
+            pending_paths.remove(self)
+            path_setup_stats['completed'] += 1
+            if latency is not None:
+                received, parsed, routed = self.stamps
+                n = len(self.path)
+                latency.record('DCNController', 'parse', parsed - received, n)
+                latency.record('DCNController', 'route', routed - parsed, n)
+                latency.record('DCNController', 'install', self.sent - routed,
+                               n)
+                latency.record('DCNController', 'total',
+                               time.time() - received, n)
             if self.packet:
                 log.debug("Sending delayed packet out %s"
                           % (dpid_to_str(self.first_switch),))
@@ -253,15 +546,13 @@ class WaitingPath(object):
 
     @staticmethod
     def expire_waiting_paths():
-        packets = set(waiting_paths.values())
-        killed = 0
-        for p in packets:
-            if p.is_expired:
-                killed += 1
-                for entry in p.xids:
-                    waiting_paths.pop(entry, None)
+        killed = pending_paths.expire()
+        for p in killed:
+            for entry in p.xids:
+                waiting_paths.pop(entry, None)
         if killed:
-            log.error("%i paths failed to install" % (killed,))
+            path_setup_stats['expired'] += len(killed)
+            log.error("%i paths failed to install" % (len(killed),))
 
 
 class PathInstalled(Event):
@@ -326,34 +617,50 @@ class Switch(EventMixin):
     #     msg.actions.append(of.ofp_action_output(port=outport))
     #     self.connection.send(msg)
 
-    def _install(self, switch, in_port, out_port, match, buf=None):
+    def _install(self, switch, in_port, out_port, match, buf=None,
+                 idle_timeout=FLOW_IDLE_TIMEOUT, flags=0):
         msg = of.ofp_flow_mod()
         msg.match = match
         msg.match.in_port = in_port
-        msg.idle_timeout = FLOW_IDLE_TIMEOUT
+        msg.idle_timeout = idle_timeout
+        msg.flags = flags
         msg.hard_timeout = FLOW_HARD_TIMEOUT
         msg.actions.append(of.ofp_action_output(port=out_port))
         msg.buffer_id = buf
         switch.connection.send(msg)
 
-    def _install_path(self, p, match, packet_in=None):
-        wp = WaitingPath(p, packet_in)
-        for sw, in_port, out_port in p:
-            self._install(sw, in_port, out_port, match)
+    def _install_path(self, p, match, packet_in=None, stamps=None,
+                      idle_timeout=FLOW_IDLE_TIMEOUT, counted=False):
+        """
+        counted asks for a FlowRemoved from the ingress entry, to count
+        the flow off path_flows
+        """
+        wp = WaitingPath(p, packet_in, stamps)
+        for i, (sw, in_port, out_port) in enumerate(p):
+            flags = 0
+            if counted and i == 0:
+                flags = of.OFPFF_SEND_FLOW_REM
+            self._install(sw, in_port, out_port, match,
+                          idle_timeout=idle_timeout, flags=flags)
             msg = of.ofp_barrier_request()
             sw.connection.send(msg)
             wp.add_xid(sw.dpid, msg.xid)
+        wp.sent = time.time()
 
-    def install_path(self, dst_sw, last_port, match, event):
+    def install_path(self, dst_sw, last_port, match, event, received=None,
+                     parsed=None, flow_hash=None):
         """
         Attempts to install a path between this switch and some destination
+
+        received and parsed are when the packet-in arrived and was parsed.
+        IPv4 flows pass their flow_hash, to spread them over equal-cost
+        paths.
         """
-        p = _get_path(self, dst_sw, event.port, last_port)
+        p = _get_path(self, dst_sw, event.port, last_port, flow_hash)
+        routed = time.time()
         if p is None:
             log.warning("Can't get from %s to %s", match.dl_src, match.dl_dst)
 
-            import pox.lib.packet as pkt
-
             if (match.dl_type == pkt.ethernet.IP_TYPE and
                     event.parsed.find('ipv4')):
                 # It's IP -- let's send a destination unreachable
@@ -394,14 +701,32 @@ class Switch(EventMixin):
         #          match.dl_src, match.dl_dst, match.dl_type, p)
 
         # We have a path -- install it
-        self._install_path(p, match, event.ofp)
+        stamps = None
+        if received is not None:
+            stamps = (received, parsed, routed)
+        idle_timeout = FLOW_IDLE_TIMEOUT
+        counted = flow_hash is not None
+        if counted:
+            idle_timeout = ECMP_IDLE_TIMEOUT
+            match.in_port = event.port
+            _count_path(_entry_key(self.dpid, match),
+                        ((self.dpid, dst_sw.dpid),
+                         tuple(sw.dpid for sw, _, _ in p)))
+        self._install_path(p, match, event.ofp, stamps, idle_timeout,
+                           counted)
 
         # Now reverse it and install it backwards
         # (we'll just assume that will work)
         p = [(sw, out_port, in_port) for sw, in_port, out_port in p]
-        self._install_path(p, match.flip())
+        self._install_path(p, match.flip(), idle_timeout=idle_timeout)
+
+    def _handle_FlowRemoved(self, event):
+        # Only counted IPv4 ingress entries ask for these
+        _count_path(_entry_key(self.dpid, event.ofp.match))
 
     def _handle_PacketIn(self, event):
+            received = time.time()
+
             def flood():
                 """ Floods the packet """
                 if self.is_holding_down:
@@ -424,6 +749,7 @@ class Switch(EventMixin):
                     self.connection.send(msg)
 
             packet = event.parsed
+            parsed = time.time()
             if packet.find('arp'):
                 loc = (self, event.port)  # Place we saw this ethaddr
                 oldloc = mac_map.get(packet.src)  # Place we last saw this ethaddr
@@ -433,7 +759,8 @@ class Switch(EventMixin):
                     return
                 if oldloc is None:
                     if packet.src.is_multicast is False:
-                        mac_map[packet.src] = loc  # Learn position for ethaddr
+                        mac_map.learn(packet.src, loc)  # Learn position for ethaddr
+                        _host_seen(loc)
                         log.debug("Learned %s at %s.%i", packet.src, loc[0], loc[1])
                 elif oldloc != loc:
                     # ethaddr seen at different place!
@@ -443,7 +770,8 @@ class Switch(EventMixin):
                                   dpid_to_str(oldloc[0].dpid), oldloc[1],
                                   dpid_to_str(loc[0].dpid), loc[1])
                         if packet.src.is_multicast is False:
-                            mac_map[packet.src] = loc  # Learn position for ethaddr
+                            mac_map.learn(packet.src, loc)  # Learn position for ethaddr
+                            _host_seen(loc)
                             log.debug("Learned %s at %s.%i", packet.src, loc[0], loc[1])
                     elif packet.dst.is_multicast is False:
                         # New place is a switch-to-switch port!
@@ -475,9 +803,23 @@ class Switch(EventMixin):
                         # match = of.ofp_match.from_packet(packet)
                         match.dl_src = packet.src
                         match.dl_dst = packet.dst
+                        if ecmp_match != 'mac':
+                            # Leave IPv4 to per-flow entries
+                            match.dl_type = pkt.ethernet.ARP_TYPE
 
-                        self.install_path(dest[0], dest[1], match, event)
+                        self.install_path(dest[0], dest[1], match, event,
+                                          received, parsed)
                         # TODO
+            elif ecmp_match != 'mac' and packet.find('ipv4'):
+                if packet.dst.is_multicast or packet.dst not in mac_map:
+                    # Hosts ARP before sending, so this is rare; drop it
+                    log.debug("No path for IPv4 to %s", packet.dst)
+                    drop()
+                    return
+                dest = mac_map[packet.dst]
+                match = _flow_match(packet)
+                self.install_path(dest[0], dest[1], match, event, received,
+                                  parsed, _flow_hash(match))
 
     def disconnect(self):
         if self.connection is not None:
@@ -493,6 +835,9 @@ class Switch(EventMixin):
         if self.ports is None:
             self.ports = connection.features.ports
         self.disconnect()
+        # A reconnecting switch may have lost its entries without telling
+        for key in [k for k in path_entries if k[0] == self.dpid]:
+            _count_path(key)
         log.debug("Connect %s" % (connection,))
         self.connection = connection
         self._listeners = self.listenTo(connection)
@@ -515,10 +860,64 @@ class DCNController(EventMixin):
         PathInstalled,
     ])
 
-    def __init__(self):
+    def __init__(self, quiet_period=PATH_QUIET_PERIOD):
+        # Link events are coalesced; paths are recomputed on a worker
+        # thread once discovery has been quiet for quiet_period seconds.
+        self.quiet_period = quiet_period
+        self.topology_epoch = 0  # Bumped by every link change
+        self.path_epoch = 0  # Epoch path_map was computed for
+        self._burst_started = None  # First link event not yet recomputed
+        self._last_change = None
+        self.path_stats = {'link_events': 0, 'recomputes': 0,
+                           'discarded': 0, 'last_seconds': 0.0,
+                           'total_seconds': 0.0}
+
         # Listen to dependencies (specifying priority 0 for openflow)
         core.listen_to_dependencies(self, listen_args={'openflow': {'priority': 0}})  # TODO
 
+    def _topology_changed(self):
+        self.topology_epoch += 1
+        self.path_stats['link_events'] += 1
+        self._last_change = time.time()
+        if self._burst_started is None:
+            self._burst_started = self._last_change
+            core.callDelayed(self.quiet_period, self._check_quiet)
+
+    def _check_quiet(self):
+        due = min(self._last_change + self.quiet_period,
+                  self._burst_started + PATH_MAX_DELAY)
+        now = time.time()
+        if now < due:
+            core.callDelayed(due - now, self._check_quiet)
+            return
+        self._burst_started = None
+        epoch = self.topology_epoch
+        sws = switches.values()
+        adj = _copy_adjacency()
+
+        def work():
+            start = time.time()
+            pm = _calc_paths(sws, adj)
+            core.callLater(self._paths_ready, epoch, pm, adj,
+                           time.time() - start)
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+
+    def _paths_ready(self, epoch, pm, adj, seconds):
+        global path_map, path_adjacency
+        stats = self.path_stats
+        stats['recomputes'] += 1
+        stats['last_seconds'] = seconds
+        stats['total_seconds'] += seconds
+        if epoch < self.path_epoch:
+            stats['discarded'] += 1  # A newer computation finished first
+            return
+        path_map, path_adjacency = pm, adj
+        self.path_epoch = epoch
+        log.debug("Paths for topology epoch %i computed in %.3f s",
+                  epoch, seconds)
+
     def _handle_openflow_discovery_LinkEvent(self, event):
         def flip(link):
             return Discovery.Link(link[2], link[3], link[0], link[1])
@@ -538,7 +937,8 @@ class DCNController(EventMixin):
         #     if sw.connection is None:
         #         continue
         #     sw.connection.send(clear)
-        path_map.clear()
+        # Until the recompute finishes, the last path_map keeps serving.
+        self._topology_changed()
 
         if event.removed:
             # mac_map.clear()
@@ -571,15 +971,9 @@ class DCNController(EventMixin):
 
             # If we have learned a MAC on this port which we now know to
             # be connected to a switch, unlearn it.
-            bad_macs = set()
-            for mac, (sw, port) in mac_map.iteritems():
-                if sw is sw1 and port == l.port1:
-                    bad_macs.add(mac)
-                if sw is sw2 and port == l.port2:
-                    bad_macs.add(mac)
-            for mac in bad_macs:
-                log.debug("Unlearned %s", mac)
-                del mac_map[mac]
+            for sw, port in ((sw1, l.port1), (sw2, l.port2)):
+                for mac in mac_map.unlearn_port(sw, port):
+                    log.debug("Unlearned %s", mac)
 
     def _handle_openflow_ConnectionUp(self, event):
         sw = switches.get(event.dpid)
@@ -591,6 +985,30 @@ class DCNController(EventMixin):
         else:
             sw.connect(event.connection)
 
+    def setup_gauges(self):
+        """
+        Return path setups and barriers outstanding, plus setup and
+        ethaddr learning counters
+        """
+        gauges = {'outstanding_setups': len(pending_paths),
+                  'outstanding_barriers': len(waiting_paths),
+                  'macs_learned': len(mac_map),
+                  'mac_moves': mac_map.moves,
+                  'mac_unlearns': mac_map.unlearns}
+        gauges.update(path_setup_stats)
+        return gauges
+
+    def path_utilization(self):
+        """
+        Return IPv4 flows currently installed on each path between each
+        switch pair; flows leave the count when their ingress entry is
+        removed
+
+        [(src dpid, dst dpid)] -> {(dpids on path): flows}
+        """
+        return dict((pair, dict(counts))
+                    for pair, counts in path_flows.iteritems())
+
     def _handle_openflow_BarrierIn(self, event):
         wp = waiting_paths.pop((event.dpid, event.xid), None)
         if not wp:
@@ -600,17 +1018,36 @@ class DCNController(EventMixin):
         wp.notify(event)
 
 
-def launch(topo=None):
+def launch(topo=None, quiet_period=PATH_QUIET_PERIOD, ecmp='flow',
+           structured=True):
+    """
+    Launch DCNController
+
+    topo is the Mininet topology type, for switch names (ft or bc); it
+    also limits structure inference to that kind
+    quiet_period is how long in seconds link events must stop before
+    paths are recomputed
+    ecmp is what IPv4 flows are matched and spread over equal-cost paths
+    by: flow (5-tuple), ip (address pair) or mac (no spreading)
+    structured routes along an inferred fat-tree or BCube structure
+    while the topology matches one
+    """
+    if ecmp not in ('flow', 'ip', 'mac'):
+        raise RuntimeError("Unknown ecmp match '%s'" % (ecmp,))
 
     import pox.openflow.discovery
     pox.openflow.discovery.launch()
     import pox.openflow.spanning_tree
     pox.openflow.spanning_tree.launch()
+    if str_to_bool(structured) and not core.hasComponent("DCNStructure"):
+        import dcn_structure
+        dcn_structure.launch(expect=topo if topo in ('ft', 'bc') else None)
 
-    global topotype
+    global topotype, ecmp_match
     topotype = topo
+    ecmp_match = ecmp
     # time.sleep(10)
     # def foo():
-    core.registerNew(DCNController)
-    timeout = min(max(PATH_SETUP_TIME, 5) * 2, 15)
-    Timer(timeout, WaitingPath.expire_waiting_paths, recurring=True)
\ No newline at end of file
+    core.registerNew(DCNController, float(quiet_period))
+    Timer(PATH_EXPIRY_RESOLUTION, WaitingPath.expire_waiting_paths,
+          recurring=True)
\ No newline at end of file
@@ -0,0 +1,453 @@
+"""
+Infer fat-tree or BCube structure from the discovered topology.
+
+DCNController treats the fabric as an arbitrary graph.  This component
+watches openflow.discovery and recognizes the two structured topologies
+Mininet builds for it (see ripl.dctopo):
+
+  ft  FatTreeTopo(k): edge, aggregation and core layers, and pods
+  bc  BCubeTopo(k, n): relay switches (one per server) and level-0..k
+      switches, with each relay's digit coordinates
+
+Inference is incremental.  Each link event updates a degree histogram in
+O(1), and the full O(V+E) check only runs once the switch and link counts
+fit some k (or n and k).  Hosts learned by DCNController are reported
+with host_at(); they must sit on edge or relay switches, and they tell
+relays from level switches when BCube's degrees can't.
+
+While a structure is confirmed, route() returns a path in O(1) per flow
+(O(k) for BCube); otherwise it returns None and callers route generically.
+"""
+
+from collections import defaultdict
+
+from pox.core import core
+from pox.openflow.discovery import Discovery
+
+log = core.getLogger()
+
+
+class FatTree(object):
+    """
+    Layers, pods and routing tables of a confirmed fat-tree
+    """
+
+    def __init__(self, k, edges, pods, pod_aggs, agg_cores, core_aggs):
+        self.k = k
+        self.edges = edges  # Set of edge dpids
+        self.pod = pods  # [edge or agg dpid] -> pod
+        self.pod_aggs = pod_aggs  # [pod] -> aggs, in core group order
+        self.agg_cores = agg_cores  # [agg] -> sorted cores
+        self.core_aggs = core_aggs  # [core] -> {pod: agg}
+
+    def layer(self, dpid):
+        if dpid in self.edges:
+            return 'edge'
+        if dpid in self.pod:
+            return 'agg'
+        return 'core'
+
+    def route(self, src, dst, flow_hash):
+        if src not in self.edges or dst not in self.edges:
+            return None
+        if src == dst:
+            return [src]
+        src_pod = self.pod[src]
+        aggs = self.pod_aggs[src_pod]
+        agg = aggs[flow_hash % len(aggs)]
+        dst_pod = self.pod[dst]
+        if src_pod == dst_pod:
+            return [src, agg, dst]
+        cores = self.agg_cores[agg]
+        c = cores[(flow_hash // len(aggs)) % len(cores)]
+        return [src, agg, c, self.core_aggs[c][dst_pod], dst]
+
+
+class BCube(object):
+    """
+    Levels, coordinates and routing tables of a confirmed BCube
+    """
+
+    def __init__(self, n, k, coords, level_switch):
+        self.n = n
+        self.k = k
+        self.coords = coords  # [relay dpid] -> (digit 0, ..., digit k)
+        self.relay_at = dict((c, r) for r, c in coords.iteritems())
+        self.level_switch = level_switch  # [relay dpid] -> [switch per level]
+
+    def layer(self, dpid):
+        if dpid in self.coords:
+            return 'relay'
+        return 'level'
+
+    def route(self, src, dst, flow_hash):
+        """
+        Correct one differing digit at a time, starting from a digit
+        chosen by flow_hash, as BCube's parallel paths do
+        """
+        if src not in self.coords or dst not in self.coords:
+            return None
+        a = self.coords[src]
+        b = self.coords[dst]
+        levels = [l for l in xrange(self.k + 1) if a[l] != b[l]]
+        if levels:
+            start = flow_hash % len(levels)
+            levels = levels[start:] + levels[:start]
+        path = [src]
+        cur = list(a)
+        for l in levels:
+            path.append(self.level_switch[path[-1]][l])
+            cur[l] = b[l]
+            path.append(self.relay_at[tuple(cur)])
+        return path
+
+
+def _components(nodes, adj, keep):
+    """
+    Return connected components of nodes, moving only along edges to
+    neighbours for which keep() is true and back
+    """
+    seen = set()
+    comps = []
+    for start in sorted(nodes):
+        if start in seen:
+            continue
+        comp = set([start])
+        stack = [start]
+        while stack:
+            a = stack.pop()
+            for b in adj[a]:
+                if b in comp or not keep(b):
+                    continue
+                comp.add(b)
+                stack.append(b)
+        seen.update(comp)
+        comps.append(comp)
+    return comps
+
+
+def infer_fat_tree(adj, hosted):
+    """
+    Return a FatTree for the graph adj ([dpid] -> set of dpids), or None
+
+    hosted is the set of dpids hosts were seen on.
+    """
+    degrees = set(len(nbrs) for nbrs in adj.itervalues())
+    if len(degrees) != 2:
+        return None
+    half, k = sorted(degrees)
+    if k != 2 * half:
+        return None
+    edges = set(d for d, nbrs in adj.iteritems() if len(nbrs) == half)
+    aggs = set(d for d, nbrs in adj.iteritems()
+               if len(nbrs) == k and nbrs & edges)
+    cores = set(adj) - edges - aggs
+    if (len(edges), len(aggs), len(cores)) != \
+            (k * k / 2, k * k / 2, k * k / 4):
+        return None
+    if not hosted <= edges:
+        return None
+    for e in edges:
+        if not adj[e] <= aggs:
+            return None
+    for a in aggs:
+        if len(adj[a] & edges) != half or len(adj[a] & cores) != half:
+            return None
+    pods = {}
+    pod_sets = _components(edges | aggs, adj, lambda d: d not in cores)
+    if len(pod_sets) != k:
+        return None
+    for pod, members in enumerate(pod_sets):
+        if len(members & edges) != half:
+            return None
+        for d in members:
+            pods[d] = pod
+    core_aggs = {}
+    for c in cores:
+        by_pod = dict((pods[a], a) for a in adj[c])
+        if len(by_pod) != k:
+            return None
+        core_aggs[c] = by_pod
+    # Aggregation switches reaching the same cores are at the same
+    # position in every pod; order each pod's aggs by that position so
+    # the same flow_hash picks matching aggs and cores everywhere.
+    groups = sorted(set(frozenset(adj[a] & cores) for a in aggs), key=min)
+    if len(groups) != half:
+        return None
+    pod_aggs = defaultdict(lambda: [None] * half)
+    for a in aggs:
+        group = frozenset(adj[a] & cores)
+        if group not in groups:
+            return None
+        pod_aggs[pods[a]][groups.index(group)] = a
+    agg_cores = dict((a, sorted(adj[a] & cores)) for a in aggs)
+    return FatTree(k, edges, pods, dict(pod_aggs), agg_cores, core_aggs)
+
+
+def _bipartition(adj):
+    "Return the two sides of a connected bipartite graph, or None."
+    start = min(adj)
+    side = {start: 0}
+    stack = [start]
+    while stack:
+        a = stack.pop()
+        for b in adj[a]:
+            if b not in side:
+                side[b] = 1 - side[a]
+                stack.append(b)
+            elif side[b] == side[a]:
+                return None
+    if len(side) != len(adj):
+        return None
+    return (set(d for d in side if side[d] == 0),
+            set(d for d in side if side[d] == 1))
+
+
+def _bcube_levels(adj, relays):
+    """
+    Return [level switch] -> level, or None
+
+    The first relay's switches are given levels 0..k arbitrarily.  From a
+    relay u whose switches have levels, the other relays w on u's level-l
+    switch get theirs by squares: w's level-m switch W is the one whose
+    relays share a (level-l) switch with relays on u's level-m switch.
+    """
+    first = min(relays)
+    level = dict((s, l) for l, s in enumerate(sorted(adj[first])))
+    done = set([first])
+    stack = [first]
+    while stack:
+        u = stack.pop()
+        for s in adj[u]:
+            for w in adj[s]:
+                if w in done:
+                    continue
+                for us in adj[u]:
+                    if us == s:
+                        continue
+                    near = set()  # Switches of relays on us, except u
+                    for x in adj[us]:
+                        if x != u:
+                            near |= adj[x]
+                    found = [ws for ws in adj[w] if ws != s and
+                             any(adj[y] & near for y in adj[ws] if y != w)]
+                    if len(found) != 1:
+                        return None
+                    if level.setdefault(found[0], level[us]) != level[us]:
+                        return None
+                done.add(w)
+                stack.append(w)
+    if len(done) != len(relays):
+        return None
+    return level
+
+
+def infer_bcube(adj, hosted):
+    """
+    Return a BCube for the graph adj ([dpid] -> set of dpids), or None
+
+    hosted is the set of dpids hosts were seen on.
+    """
+    sides = _bipartition(adj)
+    if sides is None:
+        return None
+    for relays, switches in (sides, sides[::-1]):
+        if hosted and not hosted <= relays:
+            continue
+        k = len(adj[min(relays)]) - 1
+        n = len(adj[min(switches)])
+        if k < 1 or n < 2:
+            continue
+        if any(len(adj[r]) != k + 1 for r in relays) or \
+                any(len(adj[s]) != n for s in switches):
+            continue
+        if len(relays) != n ** (k + 1) or len(switches) != (k + 1) * n ** k:
+            continue
+        if not hosted and n == k + 1:
+            return None  # Either side could be the relays; wait for hosts
+        break
+    else:
+        return None
+    level = _bcube_levels(adj, relays)
+    if level is None or set(level) != switches:
+        return None
+    level_switch = {}
+    for r in relays:
+        by_level = [None] * (k + 1)
+        for s in adj[r]:
+            if by_level[level[s]] is not None:
+                return None
+            by_level[level[s]] = s
+        level_switch[r] = by_level
+    # A relay's digit at level l is which of the n groups it falls in
+    # when switches at every other level connect relays.
+    coords = dict((r, [None] * (k + 1)) for r in relays)
+    for l in xrange(k + 1):
+        comps = _components(relays, adj, lambda d: d in relays or
+                            (level[d] != l))
+        comps = [c & relays for c in comps if c & relays]
+        if len(comps) != n:
+            return None
+        for digit, comp in enumerate(comps):
+            for r in comp:
+                coords[r][l] = digit
+    coords = dict((r, tuple(c)) for r, c in coords.iteritems())
+    if len(set(coords.itervalues())) != len(relays):
+        return None
+    return BCube(n, k, coords, level_switch)
+
+
+def _fits_fat_tree(degrees, n_links):
+    "Could a degree histogram and link count be a fat-tree?"
+    if len(degrees) != 2:
+        return False
+    half, k = sorted(degrees)
+    return k == 2 * half and degrees[half] == k * k / 2 and \
+        degrees[k] == 3 * k * k / 4 and n_links == k ** 3 / 2
+
+
+def _fits_bcube(degrees, n_links):
+    "Could a degree histogram and link count be a BCube?"
+    if len(degrees) == 1:
+        # n == k + 1: (k + 1) ** (k + 1) relays and as many switches
+        d, count = degrees.items()[0]
+        return d >= 2 and count == 2 * d ** d and n_links == d ** (d + 1)
+    if len(degrees) != 2:
+        return False
+    (d1, c1), (d2, c2) = degrees.items()
+    for (k1, relays), (n, switches) in (((d1, c1), (d2, c2)),
+                                        ((d2, c2), (d1, c1))):
+        k = k1 - 1
+        if k < 1 or n < 2:
+            continue  # A star or a chain, not a DCN
+        if relays == n ** (k + 1) and switches == (k + 1) * n ** k and \
+                n_links == (k + 1) * n ** (k + 1):
+            return True
+    return False
+
+
+class DCNStructure(object):
+    """
+    Tracks the switch graph and the structure confirmed on it, if any
+    """
+
+    def __init__(self, expect=None):
+        self.expect = expect  # 'ft', 'bc' or None for either
+        self.adj = defaultdict(set)  # [dpid] -> set of neighbour dpids
+        self.degrees = defaultdict(int)  # [degree] -> number of switches
+        self.n_links = 0
+        self.hosted = set()  # dpids hosts were seen on
+        self.structure = None  # FatTree, BCube or None
+        self.stats = {'checks': 0, 'confirmed': 0, 'lost': 0}
+        core.listen_to_dependencies(self)
+
+    @property
+    def kind(self):
+        if isinstance(self.structure, FatTree):
+            return 'ft'
+        if isinstance(self.structure, BCube):
+            return 'bc'
+        return None
+
+    def layer(self, dpid):
+        "Return the confirmed layer of switch dpid, or None."
+        if self.structure is None or dpid not in self.adj:
+            return None
+        return self.structure.layer(dpid)
+
+    def route(self, src, dst, flow_hash=0):
+        """
+        Return the dpids on a structured path from src to dst, or None
+
+        Both directions of a flow_hash get the same path.
+        """
+        if self.structure is None:
+            return None
+        if dst < src:
+            path = self.structure.route(dst, src, flow_hash)
+            return None if path is None else path[::-1]
+        return self.structure.route(src, dst, flow_hash)
+
+    def host_at(self, dpid):
+        "Note that a host was seen on switch dpid."
+        if dpid in self.hosted:
+            return
+        self.hosted.add(dpid)
+        if self.structure is None or \
+                self.structure.layer(dpid) not in ('edge', 'relay'):
+            self._check()
+
+    def _set_degree(self, dpid, delta):
+        old = len(self.adj[dpid]) - delta
+        if old:
+            self.degrees[old] -= 1
+            if not self.degrees[old]:
+                del self.degrees[old]
+        if len(self.adj[dpid]):
+            self.degrees[len(self.adj[dpid])] += 1
+
+    def _handle_openflow_discovery_LinkEvent(self, event):
+        l = event.link
+        a, b = l.dpid1, l.dpid2
+        if event.added:
+            # Only links seen in both directions connect switches
+            flipped = Discovery.Link(l.dpid2, l.port2, l.dpid1, l.port1)
+            if flipped not in core.openflow_discovery.adjacency or \
+                    b in self.adj[a]:
+                return
+            self.adj[a].add(b)
+            self.adj[b].add(a)
+            self.n_links += 1
+            delta = 1
+        else:
+            if b not in self.adj[a]:
+                return
+            self.adj[a].discard(b)
+            self.adj[b].discard(a)
+            self.n_links -= 1
+            delta = -1
+        self._set_degree(a, delta)
+        self._set_degree(b, delta)
+        self._check()
+
+    def _check(self):
+        """
+        Confirm or drop the structure; a full check only runs when the
+        counts fit one
+        """
+        adj = dict((d, nbrs) for d, nbrs in self.adj.iteritems() if nbrs)
+        structure = None
+        if self.expect != 'bc' and _fits_fat_tree(self.degrees,
+                                                  self.n_links):
+            self.stats['checks'] += 1
+            structure = infer_fat_tree(adj, self.hosted)
+        if structure is None and self.expect != 'ft' and \
+                _fits_bcube(self.degrees, self.n_links):
+            self.stats['checks'] += 1
+            structure = infer_bcube(adj, self.hosted)
+        if structure is None and self.structure is not None:
+            self.stats['lost'] += 1
+            log.info("Topology no longer matches %s; routing generically",
+                     self.kind)
+        self.structure = structure
+        if structure is not None:
+            self.stats['confirmed'] += 1
+            if isinstance(structure, FatTree):
+                log.info("Confirmed fat-tree, k=%i", structure.k)
+            else:
+                log.info("Confirmed BCube, n=%i k=%i", structure.n,
+                         structure.k)
+
+
+def launch(expect=None):
+    """
+    Launch structure inference
+
+    expect limits inference to one kind of structure: ft or bc
+    """
+    if expect not in (None, 'ft', 'bc'):
+        raise RuntimeError("Unknown structure '%s'" % (expect,))
+    import pox.openflow.discovery
+    if not core.hasComponent("openflow_discovery"):
+        pox.openflow.discovery.launch()
+    core.registerNew(DCNStructure, expect)
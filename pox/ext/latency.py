@@ -0,0 +1,138 @@
+"""
+Flow setup latency histograms.
+
+Controllers that install paths on demand (riplpox, DCNController) report
+how long each stage of a flow setup took.  This component keeps one
+HDR-style histogram per controller, stage and path length:
+
+  parse    packet-in receipt to parsed packet
+  route    parsed packet to computed route
+  install  computed route to the last flow_mod and barrier sent
+  barrier  flow_mod sent to one switch's barrier reply (once per switch)
+  total    packet-in receipt to the last barrier reply
+
+Recording is a few dict operations per stage, cheap enough to leave on.
+With web.webcore running, GET /latency/ returns every histogram as JSON;
+with --dump=FILE they are also written to FILE on shutdown:
+
+  ./pox.py latency --dump=latency.json web.webcore riplpox.riplpox ...
+"""
+
+import json
+from collections import defaultdict
+
+from pox.core import core
+from pox.web.webcore import SplitRequestHandler
+
+log = core.getLogger()
+
+# Linear sub-buckets per power of two, as bits; 7 keeps bucket error <1%
+SUB_BITS = 7
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram(object):
+    "Log-linear histogram of durations in microseconds, as HdrHistogram."
+
+    def __init__(self, sub_bits=SUB_BITS):
+        self.sub_bits = sub_bits
+        self.counts = defaultdict(int)  # [bucket lower bound] -> count
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, seconds):
+        value = max(0, int(round(seconds * 1e6)))
+        shift = max(0, value.bit_length() - self.sub_bits)
+        self.counts[(value >> shift) << shift] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p, counts=None):
+        "Return the lower bound of the bucket holding the pth percentile."
+        if counts is None:
+            counts = self.counts
+        target = p / 100.0 * sum(counts.itervalues())
+        seen = 0
+        for bound in sorted(counts):
+            seen += counts[bound]
+            if seen >= target:
+                return bound
+        return 0
+
+    def to_dict(self):
+        counts = dict(self.counts)  # Copy; may be read off the recoco thread
+        d = {'count': self.count, 'min_us': self.min or 0,
+             'max_us': self.max,
+             'mean_us': self.total / self.count if self.count else 0,
+             'buckets': sorted(counts.items())}
+        for p in PERCENTILES:
+            d['p%s_us' % p] = self.percentile(p, counts)
+        return d
+
+
+class SetupLatency(object):
+    "Flow setup latency histograms, by controller, stage and path length."
+
+    def __init__(self, dump=None):
+        self.dump_file = dump
+        self.histograms = {}  # [(source, stage, path length)] -> Histogram
+        core.addListenerByName("GoingDownEvent", self._handle_GoingDownEvent)
+        core.call_when_ready(self._serve, "WebServer")
+
+    def record(self, source, stage, seconds, path_len=0):
+        key = (source, stage, path_len)
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = Histogram()
+        h.record(seconds)
+
+    def to_dict(self):
+        "Return {source: {stage: {path length: histogram summary}}}."
+        d = {}
+        for (source, stage, path_len), h in self.histograms.items():
+            d.setdefault(source, {}).setdefault(stage, {})[str(path_len)] = \
+                h.to_dict()
+        return d
+
+    def dump(self, filename):
+        f = open(filename, 'w')
+        try:
+            json.dump(self.to_dict(), f, sort_keys=True, indent=2)
+        finally:
+            f.close()
+
+    def _serve(self):
+        core.WebServer.set_handler("/latency/", LatencyHandler, self, True)
+
+    def _handle_GoingDownEvent(self, event):
+        if self.dump_file:
+            self.dump(self.dump_file)
+            log.info("Wrote setup latencies to %s" % self.dump_file)
+
+
+class LatencyHandler(SplitRequestHandler):
+    "Serve SetupLatency.to_dict() as JSON."
+
+    def do_GET(self):
+        body = json.dumps(self.args.to_dict(), sort_keys=True, indent=2)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def launch(dump=None):
+    """
+    Launch setup latency recording
+
+    dump is a file to write the histograms to on shutdown
+    """
+    core.registerNew(SetupLatency, dump)
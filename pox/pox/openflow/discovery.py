@@ -32,8 +32,7 @@ import pox.lib.packet as pkt
 
 import struct
 import time
-from collections import namedtuple
-from random import shuffle, random
+from collections import namedtuple, deque, OrderedDict
 
 
 log = core.getLogger()
@@ -46,14 +45,15 @@ class LLDPSender (object):
 
   SendItem = namedtuple("LLDPSenderItem", ('dpid','port_num','packet'))
 
-  #NOTE: This class keeps the packets to send in a flat list, which makes
-  #      adding/removing them on switch join/leave or (especially) port
-  #      status changes relatively expensive. Could easily be improved.
+  # Packets are indexed by (dpid,port), so adding and removing ports is
+  # O(1) and removing a switch is O(its ports).  Removed packets are left
+  # in the cycle queues and skipped when they come up.
 
   # Maximum times to run the timer per second
   _sends_per_sec = 15
 
-  def __init__ (self, send_cycle_time, ttl = 120):
+  def __init__ (self, send_cycle_time, ttl = 120, host_port_cycles = 0,
+                learn_cycles = 0):
     """
     Initialize an LLDP packet sender
 
@@ -64,19 +64,53 @@ class LLDPSender (object):
     ttl is the time (in seconds) for which a receiving LLDP agent should
       consider the rest of the data to be valid.  We don't use this, but
       other LLDP agents might.  Can't be 0 (this means revoke).
+
+    host_port_cycles is how many cycles pass between sends out of ports
+      facing hosts rather than switches; 0 means never send on them.
+
+    learn_cycles is how many cycles without hearing LLDP on a port it
+      takes to consider it host-facing; 0 means only ports given to
+      set_host_ports() are.
     """
+    # Packets to send.  (dpid,port) -> SendItem
+    self._items = {}
+
+    # Ports with packets, by switch.  dpid -> set of ports
+    self._ports = {}
+
     # Packets remaining to be sent in this cycle
-    self._this_cycle = []
+    self._this_cycle = deque()
 
     # Packets we've already sent in this cycle
-    self._next_cycle = []
+    self._next_cycle = deque()
+
+    # Packed frames, kept for ports that come back (e.g., on reconnect).
+    # (dpid,port) -> (port_addr, packet)
+    self._frames = {}
 
-    # Packets to send in a batch
-    self._send_chunk_size = 1
+    # Sends we're owed, for pacing
+    self._credit = 0.0
 
     self._timer = None
     self._ttl = ttl
     self._send_cycle_time = send_cycle_time
+
+    self._host_port_cycles = host_port_cycles
+    self._learn_cycles = learn_cycles
+    self._cycles = 0 # Cycles started
+    self._host_ports = set() # (dpid,port) known to face hosts
+    self._learned = set() # (dpid,port) that seem to face hosts
+    self._heard = {} # (dpid,port) -> cycle we last heard LLDP on it
+    # (dpid,port) with packets that face hosts -> the cycle (mod
+    # host_port_cycles) they're sent in, so they're spread over cycles
+    self._host_items = {}
+    self._phase_load = [0] * (host_port_cycles or 0) # Host ports per phase
+
+    self.sent = 0 # Discovery packets sent
+    self.suppressed = 0 # Sends skipped on host-facing ports
+    self.cycle_cpu = 0.0 # CPU seconds spent sending the last whole cycle
+    self._cycle_cpu = 0.0 # ...and so far in this one
+
     core.listen_to_dependencies(self)
 
   def _handle_openflow_PortStatus (self, event):
@@ -87,6 +121,9 @@ class LLDPSender (object):
       self.add_port(event.dpid, event.port, event.ofp.desc.hw_addr)
     elif event.deleted:
       self.del_port(event.dpid, event.port)
+    elif event.modified:
+      # Maybe it's been cabled to something new; look at it again
+      self._forget_port(event.dpid, event.port)
 
   def _handle_openflow_ConnectionUp (self, event):
     self.del_switch(event.dpid, set_timer = False)
@@ -102,63 +139,187 @@ class LLDPSender (object):
     self.del_switch(event.dpid)
 
   def del_switch (self, dpid, set_timer = True):
-    self._this_cycle = [p for p in self._this_cycle if p.dpid != dpid]
-    self._next_cycle = [p for p in self._next_cycle if p.dpid != dpid]
+    for port_num in list(self._ports.get(dpid, ())):
+      self.del_port(dpid, port_num, set_timer = False)
     if set_timer: self._set_timer()
 
   def del_port (self, dpid, port_num, set_timer = True):
     if port_num > of.OFPP_MAX: return
-    self._this_cycle = [p for p in self._this_cycle
-                        if p.dpid != dpid or p.port_num != port_num]
-    self._next_cycle = [p for p in self._next_cycle
-                        if p.dpid != dpid or p.port_num != port_num]
+    self._forget_port(dpid, port_num)
+    key = (dpid, port_num)
+    if self._items.pop(key, None) is None: return
+    ports = self._ports[dpid]
+    ports.discard(port_num)
+    if not ports: del self._ports[dpid]
+    self._unclassify(key)
     if set_timer: self._set_timer()
 
   def add_port (self, dpid, port_num, port_addr, set_timer = True):
     if port_num > of.OFPP_MAX: return
     self.del_port(dpid, port_num, set_timer = False)
-    self._next_cycle.append(LLDPSender.SendItem(dpid, port_num,
-          self.create_discovery_packet(dpid, port_num, port_addr)))
+    key = (dpid, port_num)
+    frame = self._frames.get(key)
+    if frame is None or frame[0] != port_addr:
+      frame = (port_addr,
+               self.create_discovery_packet(dpid, port_num, port_addr))
+      self._frames[key] = frame
+    item = LLDPSender.SendItem(dpid, port_num, frame[1])
+    self._items[key] = item
+    self._ports.setdefault(dpid, set()).add(port_num)
+    self._next_cycle.append(item)
+    self._classify(key)
     if set_timer: self._set_timer()
 
-  def _set_timer (self):
-    if self._timer: self._timer.cancel()
-    self._timer = None
-    num_packets = len(self._this_cycle) + len(self._next_cycle)
+  def set_host_ports (self, ports):
+    """
+    Set the (dpid,port) pairs known to face hosts, e.g., from a topology
+    """
+    old = self._host_ports
+    self._host_ports = set(ports)
+    for key in old ^ self._host_ports:
+      self._classify(key)
 
-    if num_packets == 0: return
+  def is_host_port (self, dpid, port_num):
+    key = (dpid, port_num)
+    return key in self._host_ports or key in self._learned
 
-    self._send_chunk_size = 1 # One at a time
-    interval = self._send_cycle_time / float(num_packets)
-    if interval < 1.0 / self._sends_per_sec:
-      # Would require too many sends per sec -- send more than one at once
-      interval = 1.0 / self._sends_per_sec
-      chunk = float(num_packets) / self._send_cycle_time / self._sends_per_sec
-      self._send_chunk_size = chunk
+  def heard (self, dpid, port_num):
+    """
+    Called when LLDP was sent or received on a port, so it faces a switch
+    """
+    key = (dpid, port_num)
+    self._heard[key] = self._cycles
+    if key in self._host_ports:
+      log.warning("Heard LLDP on host port %s.%s; treating it as a switch "
+                  "port", dpid_to_str(dpid), port_num)
+      self._host_ports.discard(key)
+      self._classify(key)
+    elif key in self._learned:
+      self._learned.discard(key)
+      self._classify(key)
+
+  def _forget_port (self, dpid, port_num):
+    key = (dpid, port_num)
+    self._heard.pop(key, None)
+    if key in self._learned:
+      self._learned.discard(key)
+      self._classify(key)
+
+  def _classify (self, key):
+    """
+    Keep _host_items up to date for one port
+
+    A new host port goes in the phase with the fewest host ports, so every
+    cycle sends about the same number of packets.
+    """
+    if key in self._items and self.is_host_port(*key):
+      if key in self._host_items: return
+      phase = None
+      if self._host_port_cycles:
+        load = self._phase_load
+        phase = load.index(min(load))
+        load[phase] += 1
+      self._host_items[key] = phase
+    else:
+      self._unclassify(key)
 
-    self._timer = Timer(interval,
+  def _unclassify (self, key):
+    phase = self._host_items.pop(key, None)
+    if phase is not None:
+      self._phase_load[phase] -= 1
+
+  @property
+  def _sends_per_cycle (self):
+    # Host ports only get one every few cycles, but no more than the
+    # busiest phase's worth in any one
+    sends = len(self._items) - len(self._host_items)
+    if self._host_port_cycles:
+      sends += max(self._phase_load)
+    return sends
+
+  def _set_timer (self):
+    """
+    Make sure the timer is running if there's anything to send
+    """
+    if self._timer or not self._items: return
+    self._credit = 0.0
+    self._timer = Timer(1.0 / self._sends_per_sec,
                         self._timer_handler, recurring=True)
 
   def _timer_handler (self):
     """
     Called by a timer to actually send packets.
 
-    Picks the first packet off this cycle's list, sends it, and then puts
-    it on the next-cycle list.  When this cycle's list is empty, starts
-    the next cycle.
-    """
-    num = int(self._send_chunk_size)
-    fpart = self._send_chunk_size - num
-    if random() < fpart: num += 1
+    Each tick earns the sends needed to get through a cycle in
+    send_cycle_time, so packets are paced evenly; unused sends carry over
+    to the next tick, but never more than two ticks' worth.
 
-    for _ in range(num):
-      if len(self._this_cycle) == 0:
-        self._this_cycle = self._next_cycle
-        self._next_cycle = []
-        #shuffle(self._this_cycle)
-      item = self._this_cycle.pop(0)
+    Picks the first packet off this cycle's queue, sends it, and then puts
+    it on the next-cycle queue.  When this cycle's queue is empty, starts
+    the next cycle.  Packets for ports since removed are dropped, and ones
+    for host-facing ports whose phase isn't this cycle's are passed over
+    without using up a send.
+    """
+    if not self._items:
+      self._timer = None
+      return False # Stop the timer
+
+    start = time.clock()
+    per_tick = (float(self._sends_per_cycle) / self._send_cycle_time
+                / self._sends_per_sec)
+    self._credit = min(self._credit + per_tick, max(1.0, 2 * per_tick))
+    num = int(self._credit)
+    self._credit -= num
+
+    items = self._items
+    host_items = self._host_items
+    send = core.openflow.sendToDPID
+    due = self._due_phase()
+    budget = len(self._this_cycle) + len(self._next_cycle)
+    while num > 0 and budget > 0:
+      budget -= 1
+      if not self._this_cycle:
+        self._start_cycle()
+        due = self._due_phase()
+      item = self._this_cycle.popleft()
+      key = item[:2]
+      if items.get(key) is not item:
+        continue # Removed (maybe since re-added)
       self._next_cycle.append(item)
-      core.openflow.sendToDPID(item.dpid, item.packet)
+      if key in host_items and host_items[key] != due:
+        self.suppressed += 1
+        continue
+      num -= 1
+      self.sent += 1
+      send(item[0], item[2])
+    self._cycle_cpu += time.clock() - start
+
+  def _due_phase (self):
+    """
+    The phase of the host-facing ports that get a packet this cycle
+    """
+    if not self._host_port_cycles: return -1 # None of them
+    return self._cycles % self._host_port_cycles
+
+  def _start_cycle (self):
+    """
+    Move on to the next cycle, learning which ports seem to face hosts
+    """
+    self._this_cycle = self._next_cycle
+    self._next_cycle = deque()
+    self._cycles += 1
+    self.cycle_cpu = self._cycle_cpu
+    self._cycle_cpu = 0.0
+    if not self._learn_cycles: return
+
+    for item in self._this_cycle:
+      key = (item.dpid, item.port_num)
+      if self._items.get(key) is not item: continue
+      # Whole cycles since we heard from it (or first saw it)
+      quiet = self._cycles - 1 - self._heard.setdefault(key, self._cycles - 1)
+      if quiet >= self._learn_cycles and not self.is_host_port(*key):
+        self._learned.add(key)
+        self._classify(key)
 
   def create_discovery_packet (self, dpid, port_num, port_addr):
     """
@@ -245,6 +406,8 @@ class Discovery (EventMixin):
   _flow_priority = 65000     # Priority of LLDP-catching flow (if any)
   _link_timeout = 4         # How long until we consider a link dead
   _timeout_check_period = 600  # How often to check for timeouts
+  _host_port_cycles = 8     # Send cycles per LLDP out of a host port
+  _learn_cycles = 3         # Quiet send cycles until a port is a host port
 
   _eventMixin_events = set([
     LinkEvent,
@@ -255,14 +418,29 @@ class Discovery (EventMixin):
   Link = Link
 
   def __init__ (self, install_flow = True, explicit_drop = True,
-                link_timeout = None, eat_early_packets = False):
+                link_timeout = None, eat_early_packets = False,
+                host_port_cycles = None, learn_cycles = None):
     self._eat_early_packets = eat_early_packets
     self._explicit_drop = explicit_drop
     self._install_flow = install_flow
     if link_timeout: self._link_timeout = link_timeout
+    if host_port_cycles is not None:
+      self._host_port_cycles = host_port_cycles
+    if learn_cycles is not None: self._learn_cycles = learn_cycles
 
     self.adjacency = {} # From Link to time.time() stamp
-    self._sender = LLDPSender(self.send_cycle_time)
+
+    # Links from least to most recently seen, which is also the order
+    # they'll time out in.  Link -> None
+    self._by_age = OrderedDict()
+
+    self._received = 0 # LLDP packets that refreshed or found a link
+    self._checked = (time.time(), 0) # Last expiry check and _received then
+    self._link_stats = {'received_per_sec':0.0, 'expired':0,
+                       'expiry_seconds':0.0}
+    self._sender = LLDPSender(self.send_cycle_time,
+                              host_port_cycles = self._host_port_cycles,
+                              learn_cycles = self._learn_cycles)
 
     # Listen with a high priority (mostly so we get PacketIns early)
     core.listen_to_dependencies(self,
@@ -274,6 +452,31 @@ class Discovery (EventMixin):
   def send_cycle_time (self):
     return self._link_timeout / 2.0
 
+  def set_host_ports (self, ports):
+    """
+    Tell discovery which (dpid,port) pairs face hosts
+
+    LLDP is sent out of them only every host_port_cycles cycles (or not
+    at all).  If LLDP turns up on one anyway, it's treated as a switch
+    port again.
+    """
+    self._sender.set_host_ports(ports)
+
+  @property
+  def lldp_stats (self):
+    """
+    LLDP packets sent and suppressed, ports sent on and how many of them
+    are treated as host-facing, and CPU seconds the last cycle took; LLDP
+    packets received (in total and per second between expiry checks),
+    links expired and CPU seconds the last expiry check took
+    """
+    s = self._sender
+    stats = {'sent':s.sent, 'suppressed':s.suppressed,
+             'ports':len(s._items), 'host_ports':len(s._host_items),
+             'cycle_cpu':s.cycle_cpu, 'received':self._received}
+    stats.update(self._link_stats)
+    return stats
+
   def install_flow (self, con_or_dpid, priority = None):
     if priority is None:
       priority = self._flow_priority
@@ -310,16 +513,28 @@ class Discovery (EventMixin):
     """
     Remove apparently dead links
     """
+    start = time.clock()
     now = time.time()
 
-    expired = [link for link,timestamp in self.adjacency.iteritems()
-               if timestamp + self._link_timeout < now]
+    # Only the links at the old end of _by_age can have timed out
+    expired = []
+    for link in self._by_age:
+      if self.adjacency[link] + self._link_timeout >= now: break
+      expired.append(link)
     if expired:
       for link in expired:
         log.info('link timeout: %s', link)
 
       self._delete_links(expired)
 
+    when, received = self._checked
+    if now > when:
+      rate = (self._received - received) / (now - when)
+      self._link_stats['received_per_sec'] = rate
+    self._checked = (now, self._received)
+    self._link_stats['expired'] += len(expired)
+    self._link_stats['expiry_seconds'] = time.clock() - start
+
   def _handle_openflow_PacketIn (self, event):
     """
     Receive and process LLDP packets
@@ -437,6 +652,13 @@ class Discovery (EventMixin):
     link = Discovery.Link(originatorDPID, originatorPort, event.dpid,
                           event.port)
 
+    # Both ends of this link face a switch
+    self._sender.heard(originatorDPID, originatorPort)
+    self._sender.heard(event.dpid, event.port)
+
+    self._received += 1
+    self._by_age.pop(link, None)
+    self._by_age[link] = None
     if link not in self.adjacency:
       self.adjacency[link] = time.time()
       log.info('link detected: %s', link)
@@ -452,6 +674,7 @@ class Discovery (EventMixin):
       self.raiseEventNoErrors(LinkEvent, False, link)
     for link in links:
       self.adjacency.pop(link, None)
+      self._by_age.pop(link, None)
 
   def is_edge_port (self, dpid, port):
     """
@@ -466,12 +689,23 @@ class Discovery (EventMixin):
 
 
 def launch (no_flow = False, explicit_drop = True, link_timeout = None,
-            eat_early_packets = False):
+            eat_early_packets = False, host_port_cycles = None,
+            learn_cycles = None):
+  """
+  host_port_cycles is how many send cycles pass between LLDP packets out
+  of host-facing ports (0 for never).  Ports are host-facing if a
+  component says so with set_host_ports(), or after learn_cycles cycles
+  without LLDP heard on them (0 disables learning).
+  """
   explicit_drop = str_to_bool(explicit_drop)
   eat_early_packets = str_to_bool(eat_early_packets)
   install_flow = not str_to_bool(no_flow)
   if link_timeout: link_timeout = int(link_timeout)
+  if host_port_cycles is not None: host_port_cycles = int(host_port_cycles)
+  if learn_cycles is not None: learn_cycles = int(learn_cycles)
 
   core.registerNew(Discovery, explicit_drop=explicit_drop,
                    install_flow=install_flow, link_timeout=link_timeout,
-                   eat_early_packets=eat_early_packets)
+                   eat_early_packets=eat_early_packets,
+                   host_port_cycles=host_port_cycles,
+                   learn_cycles=learn_cycles)
@@ -28,6 +28,12 @@ Glenn Gibb's spanning tree module for NOX:
 Note that this does not have much of a relationship to Spanning Tree
 Protocol.  They have similar purposes, but this is a rather different way
 of going about it.
+
+Rather than recomputing the whole tree on every link event, the tree is
+repaired in place: a new link joins two trees if it connects them, and a
+lost tree link is replaced by another link between the two halves if
+there is one.  Only ports whose flood setting actually changes get a
+port_mod.
 """
 
 from pox.core import core
@@ -117,6 +123,150 @@ def _calc_spanning_tree ():
   return tree
 
 
+class SpanningTree (object):
+  """
+  A spanning forest over the switches, repaired as links come and go
+
+  Like _calc_spanning_tree(), it only uses links that discovery has seen
+  in both directions.  add_link() and remove_link() return the
+  (dpid, port) pairs that joined or left the tree.
+  """
+  def __init__ (self):
+    # dpid1 -> dpid2 -> set of (port on dpid1, port on dpid2)
+    self.links = {}
+    # dpid1 -> dpid2 -> (port on dpid1, port on dpid2) for tree links
+    self.tree = {}
+    # dpid -> set of the dpids in its tree (shared by all of them)
+    self._component = {}
+
+    self.repairs = 0 # Lost tree links that were replaced
+
+  def tree_ports (self, dpid):
+    """
+    Ports on dpid that are on the tree
+    """
+    return set(p[0] for p in self.tree.get(dpid, {}).itervalues())
+
+  def as_dict (self):
+    """
+    The tree in the form _calc_spanning_tree() returns
+    """
+    tree = defaultdict(set)
+    for s1, neighbors in self.tree.iteritems():
+      for s2, (p1, p2) in neighbors.iteritems():
+        tree[s1].add((s2, p1))
+    return tree
+
+  def add_link (self, dpid1, port1, dpid2, port2):
+    if dpid1 == dpid2: return []
+    ports = self.links.setdefault(dpid1, {}).setdefault(dpid2, set())
+    if (port1, port2) in ports: return []
+    ports.add((port1, port2))
+    self.links.setdefault(dpid2, {}).setdefault(dpid1, set()).add(
+        (port2, port1))
+
+    c1 = self._component_of(dpid1)
+    c2 = self._component_of(dpid2)
+    if c1 is c2: return []
+
+    # Merge the smaller tree into the bigger one
+    if len(c1) < len(c2): c1, c2 = c2, c1
+    c1.update(c2)
+    for dpid in c2:
+      self._component[dpid] = c1
+    return self._join(dpid1, port1, dpid2, port2)
+
+  def remove_link (self, dpid1, port1, dpid2, port2):
+    ports = self.links.get(dpid1, {}).get(dpid2)
+    if not ports or (port1, port2) not in ports: return []
+    ports.discard((port1, port2))
+    self.links[dpid2][dpid1].discard((port2, port1))
+    if not ports:
+      self._unlink(dpid1, dpid2)
+      self._unlink(dpid2, dpid1)
+
+    if self.tree.get(dpid1, {}).get(dpid2) != (port1, port2):
+      # Wasn't on the tree
+      self._forget_unlinked(dpid1, dpid2)
+      return []
+
+    changed = self._cut(dpid1, dpid2)
+    if ports:
+      # A parallel link can take its place
+      p1, p2 = min(ports)
+      changed += self._join(dpid1, p1, dpid2, p2)
+      self.repairs += 1
+      return changed
+
+    # Look for another link between the two halves, from the smaller one
+    side = self._side(dpid1, dpid2)
+    best = None
+    for s1 in side:
+      for s2, ports in self.links.get(s1, {}).iteritems():
+        if s2 in side: continue
+        candidate = (s1, s2) + min(ports)
+        if best is None or candidate < best: best = candidate
+    if best is not None:
+      s1, s2, p1, p2 = best
+      changed += self._join(s1, p1, s2, p2)
+      self.repairs += 1
+    else:
+      # It's split in two
+      self._component[dpid1].difference_update(side)
+      for dpid in side:
+        self._component[dpid] = side
+
+    self._forget_unlinked(dpid1, dpid2)
+    return changed
+
+  def _component_of (self, dpid):
+    c = self._component.get(dpid)
+    if c is None:
+      c = self._component[dpid] = set([dpid])
+    return c
+
+  def _forget_unlinked (self, *dpids):
+    for dpid in dpids:
+      if dpid not in self.links:
+        self._component.pop(dpid, None)
+
+  def _unlink (self, dpid1, dpid2):
+    del self.links[dpid1][dpid2]
+    if not self.links[dpid1]: del self.links[dpid1]
+
+  def _join (self, dpid1, port1, dpid2, port2):
+    self.tree.setdefault(dpid1, {})[dpid2] = (port1, port2)
+    self.tree.setdefault(dpid2, {})[dpid1] = (port2, port1)
+    return [(dpid1, port1), (dpid2, port2)]
+
+  def _cut (self, dpid1, dpid2):
+    port1, port2 = self.tree[dpid1].pop(dpid2)
+    del self.tree[dpid2][dpid1]
+    for dpid in (dpid1, dpid2):
+      if not self.tree[dpid]: del self.tree[dpid]
+    return [(dpid1, port1), (dpid2, port2)]
+
+  def _side (self, dpid1, dpid2):
+    """
+    The switches on the smaller side of a just-cut tree link
+
+    Both sides are walked a switch at a time until one runs out, so this
+    takes time proportional to the smaller side.
+    """
+    seen = (set([dpid1]), set([dpid2]))
+    todo = ([dpid1], [dpid2])
+    while True:
+      for i in (0, 1):
+        if not todo[i]: return seen[i]
+        for dpid in self.tree.get(todo[i].pop(), ()):
+          if dpid not in seen[i]:
+            seen[i].add(dpid)
+            todo[i].append(dpid)
+
+
+_tree = SpanningTree()
+
+
 # Keep a list of previous port states so that we can skip some port mods
 # If other things mess with port states, these may not be correct.  We
 # could also refer to Connection.ports, but those are not guaranteed to
@@ -130,10 +280,17 @@ _noflood_by_default = False
 # cycle should have completed (mostly makes sense with _noflood_by_default).
 _hold_down = False
 
+# Switches that connected but haven't had all their ports set yet
+_unsynced = set()
+
+# Tree updates, port_mods sent in total and by the latest update
+update_stats = {'updates':0, 'port_mods':0, 'last_port_mods':0}
+
 
 def _handle_ConnectionUp (event):
   # When a switch connects, forget about previous port states
   _prev[event.dpid].clear()
+  _unsynced.add(event.dpid)
 
   if _noflood_by_default:
     con = event.connection
@@ -154,30 +311,41 @@ def _handle_ConnectionUp (event):
 
 
 def _handle_LinkEvent (event):
-  # When links change, update spanning tree
-
-  (dp1,p1),(dp2,p2) = event.link.end
-  if _prev[dp1][p1] is False:
-    if _prev[dp2][p2] is False:
-      # We're disabling this link; who cares if it's up or down?
-      #log.debug("Ignoring link status for %s", event.link)
-      return
-
-  _update_tree()
+  # When links change, repair the spanning tree around them
+  link = event.link
+  changed = set(link.end)
+  if event.added:
+    flip = Discovery.Link(link.dpid2, link.port2, link.dpid1, link.port1)
+    if flip in core.openflow_discovery.adjacency:
+      changed.update(_tree.add_link(*link))
+  else:
+    changed.update(_tree.remove_link(*link))
+
+  ports = defaultdict(set)
+  for dpid, port in changed:
+    ports[dpid].add(port)
+  _push(ports)
 
 
 def _update_tree (force_dpid = None):
   """
-  Update spanning tree
+  Update port flooding on every switch to match the spanning tree
 
   force_dpid specifies a switch we want to update even if we are supposed
   to be holding down changes.
   """
+  switches = set(_tree.links)
+  if force_dpid is not None: switches.add(force_dpid)
+  _push(dict((sw, None) for sw in switches), force_dpid)
 
-  # Get a spanning tree
-  tree = _calc_spanning_tree()
-  log.debug("Spanning tree updated")
 
+def _push (ports, force_dpid = None):
+  """
+  Send port_mods for ports whose flooding doesn't match the tree
+
+  ports maps DPIDs to the port numbers to check, or to None to check all
+  of a switch's ports.
+  """
   # Connections born before this time are old enough that a complete
   # discovery cycle should have completed (and, thus, all of their
   # links should have been discovered).
@@ -186,7 +354,7 @@ def _update_tree (force_dpid = None):
   # Now modify ports as needed
   try:
     change_count = 0
-    for sw, ports in tree.iteritems():
+    for sw, port_nos in ports.iteritems():
       con = core.openflow.getConnection(sw)
       if con is None: continue # Must have disconnected
       if con.connect_time is None: continue # Not fully connected
@@ -200,19 +368,23 @@ def _update_tree (force_dpid = None):
           else:
             continue
 
-      tree_ports = [p[1] for p in ports]
+      if sw in _unsynced:
+        # First time since it connected; check all its ports
+        _unsynced.discard(sw)
+        port_nos = None
+
+      tree_ports = _tree.tree_ports(sw)
       for p in con.ports.itervalues():
         if p.port_no < of.OFPP_MAX:
+          if port_nos is not None and p.port_no not in port_nos: continue
           flood = p.port_no in tree_ports
           if not flood:
             if core.openflow_discovery.is_edge_port(sw, p.port_no):
               flood = True
           if _prev[sw][p.port_no] is flood:
-            #print sw,p.port_no,"skip","(",flood,")"
             continue # Skip
           change_count += 1
           _prev[sw][p.port_no] = flood
-          #print sw,p.port_no,flood
           #TODO: Check results
 
           pm = of.ofp_port_mod(port_no=p.port_no,
@@ -222,8 +394,13 @@ def _update_tree (force_dpid = None):
           con.send(pm)
 
           _invalidate_ports(con.dpid)
+    update_stats['updates'] += 1
+    update_stats['port_mods'] += change_count
+    update_stats['last_port_mods'] = change_count
     if change_count:
       log.info("%i ports changed", change_count)
+    else:
+      log.debug("Spanning tree updated; no ports changed")
   except:
     _prev.clear()
     log.exception("Couldn't push spanning tree")
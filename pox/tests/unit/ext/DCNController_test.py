@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for ext/DCNController
+"""
+
+import unittest
+import sys
+import os.path
+
+here = os.path.dirname(__file__)
+sys.path.append(here + "/../../..")
+sys.path.append(here + "/../../../ext")
+from pox.core import core
+from pox.lib.addresses import EthAddr, IPAddr
+import pox.openflow.libopenflow_01 as of
+from pox.openflow.discovery import Discovery, LinkEvent
+import DCNController as dcn
+
+
+class FakeClock (object):
+  """
+  Stands in for the time module
+  """
+  def __init__ (self):
+    self.now = 1000.0
+
+  def time (self):
+    return self.now
+
+
+class FakeThread (object):
+  """
+  Holds worker threads until the test runs them
+  """
+  started = []
+
+  def __init__ (self, target):
+    self.target = target
+    self.daemon = False
+
+  def start (self):
+    self.started.append(self.target)
+
+
+class FakeThreading (object):
+  Thread = FakeThread
+
+
+class MockDiscovery (Discovery):
+  def __init__ (self):
+    # No listeners or LLDP sender; just the link table
+    self.adjacency = {}
+
+
+class RecomputeTest (unittest.TestCase):
+  def setUp (self):
+    self.clock = FakeClock()
+    self._time = dcn.time
+    self._threading = dcn.threading
+    dcn.time = self.clock
+    dcn.threading = FakeThreading
+    FakeThread.started = []
+    self.delayed = []  # (due time, func)
+    self.later = []  # (func, args)
+    core.callDelayed = lambda s, f, *a: self.delayed.append(
+        (self.clock.now + s, f))
+    core.callLater = lambda f, *a: self.later.append((f, a))
+    core.listen_to_dependencies = lambda *a, **kw: None
+    self.discovery = MockDiscovery()
+    core.register("openflow_discovery", self.discovery)
+    dcn.switches.clear()
+    dcn.adjacency.clear()
+    for dpid in (1, 2, 3, 4):
+      sw = dcn.Switch()
+      sw.dpid = dpid
+      dcn.switches[dpid] = sw
+    self.c = dcn.DCNController(quiet_period=1)
+
+  def tearDown (self):
+    dcn.time = self._time
+    dcn.threading = self._threading
+    del core.callDelayed
+    del core.callLater
+    del core.listen_to_dependencies
+    del core.components["openflow_discovery"]
+    dcn.switches.clear()
+    dcn.adjacency.clear()
+    dcn._refresh_paths()
+
+  def link (self, a, b):
+    """
+    Report the link between switches a and b in both directions
+    """
+    links = [Discovery.Link(a, b, b, a), Discovery.Link(b, a, a, b)]
+    for l in links:
+      self.discovery.adjacency[l] = 0
+      self.c._handle_openflow_discovery_LinkEvent(LinkEvent(True, l))
+
+  def run_delayed (self):
+    """
+    Advance the clock to each delayed call in turn and make it
+    """
+    while self.delayed:
+      due, func = self.delayed.pop(0)
+      self.clock.now = max(self.clock.now, due)
+      func()
+
+  def run_workers (self, order=None):
+    workers, FakeThread.started = FakeThread.started, []
+    if order is not None:
+      workers = [workers[i] for i in order]
+    for work in workers:
+      work()
+    later, self.later = self.later, []
+    for func, args in later:
+      func(*args)
+
+  def distance (self, a, b):
+    sws = dcn.switches
+    return dcn.path_map[sws[a]][sws[b]][0][0]
+
+  def test_burst_recomputes_once (self):
+    dcn._refresh_paths()
+    for a, b in ((1, 2), (2, 3), (3, 4)):
+      self.link(a, b)
+      self.clock.now += 0.1
+    self.assertEqual(self.c.topology_epoch, 6)
+    # One quiet-period check for the whole burst
+    self.assertEqual(len(self.delayed), 1)
+    # Until the recompute lands the old paths keep serving
+    self.assertEqual(self.distance(1, 4), None)
+    self.run_delayed()
+    self.assertEqual(len(FakeThread.started), 1)
+    self.run_workers()
+    self.assertEqual(self.c.path_stats['recomputes'], 1)
+    self.assertEqual(self.c.path_stats['link_events'], 6)
+    self.assertEqual(self.c.path_epoch, 6)
+    self.assertEqual(self.distance(1, 4), 3)
+    self.assertEqual(dcn.path_adjacency[dcn.switches[1]][dcn.switches[2]],
+                     2)
+
+  def test_quiet_period_extends (self):
+    """
+    Events during the quiet period postpone the check, up to the cap
+    """
+    start = self.clock.now
+    links = [(1, 2), (2, 3), (3, 4)]
+    # A link event every half second for seven seconds
+    for tick in range(70):
+      self.clock.now = start + tick * 0.1
+      if tick % 5 == 0:
+        self.link(*links[tick / 5 % 3])
+      if self.delayed and self.delayed[0][0] <= self.clock.now:
+        self.delayed.pop(0)[1]()
+        if FakeThread.started:
+          break
+    # Checks re-armed themselves until the cap from the first event
+    self.assertEqual(len(FakeThread.started), 1)
+    self.assertAlmostEqual(self.clock.now, start + dcn.PATH_MAX_DELAY)
+    self.assertEqual(self.delayed, [])
+
+  def test_older_epoch_discarded (self):
+    self.link(1, 2)
+    self.run_delayed()
+    self.link(2, 3)
+    self.run_delayed()
+    self.assertEqual(len(FakeThread.started), 2)
+    # The newer computation finishes first
+    self.run_workers(order=[1, 0])
+    self.assertEqual(self.c.path_stats['recomputes'], 2)
+    self.assertEqual(self.c.path_stats['discarded'], 1)
+    self.assertEqual(self.c.path_epoch, 4)
+    self.assertEqual(self.distance(1, 3), 2)
+
+
+class Expiring (object):
+  def __init__ (self, expires_at):
+    self.expires_at = expires_at
+
+
+class ExpiryWheelTest (unittest.TestCase):
+  def setUp (self):
+    self.clock = FakeClock()
+    self._time = dcn.time
+    dcn.time = self.clock
+    # Seven one-second slots
+    self.wheel = dcn.ExpiryWheel(5, resolution=1)
+
+  def tearDown (self):
+    dcn.time = self._time
+
+  def test_slot_boundaries (self):
+    """
+    Objects expire once the tick after their deadline's begins
+    """
+    on_tick = Expiring(1003.0)
+    mid_tick = Expiring(1003.5)
+    for o in (on_tick, mid_tick):
+      self.wheel.add(o)
+    self.assertEqual(len(self.wheel), 2)
+    self.assertEqual(self.wheel.expire(1003.0), [])
+    self.assertEqual(self.wheel.expire(1003.99), [])
+    self.assertEqual(set(self.wheel.expire(1004.0)),
+                     set([on_tick, mid_tick]))
+    self.assertEqual(len(self.wheel), 0)
+    self.assertEqual(self.wheel.expire(1010.0), [])
+
+  def test_cancel (self):
+    kept, cancelled = Expiring(1002.0), Expiring(1002.0)
+    self.wheel.add(kept)
+    self.wheel.add(cancelled)
+    self.wheel.remove(cancelled)
+    self.assertEqual(len(self.wheel), 1)
+    self.assertEqual(self.wheel.expire(1003.0), [kept])
+    # Removing twice, or after expiry, is harmless
+    self.wheel.remove(cancelled)
+    self.wheel.remove(kept)
+    self.assertEqual(len(self.wheel), 0)
+
+  def test_already_due (self):
+    """
+    Objects added past their deadline go in the current tick
+    """
+    late = Expiring(990.0)
+    self.wheel.add(late)
+    self.assertEqual(self.wheel.expire(1000.5), [])
+    self.assertEqual(self.wheel.expire(1001.0), [late])
+
+  def test_beyond_one_turn (self):
+    """
+    A deadline further out than the wheel spans waits out whole turns
+    """
+    far = Expiring(1020.5)
+    near = Expiring(1006.0)
+    self.wheel.add(far)
+    self.wheel.add(near)
+    # far's slot comes round at ticks 1006 and 1013 before its own
+    self.assertEqual(self.wheel.expire(1007.0), [near])
+    self.assertEqual(self.wheel.expire(1014.0), [])
+    self.assertEqual(self.wheel.expire(1020.9), [])
+    self.assertEqual(len(self.wheel), 1)
+    self.assertEqual(self.wheel.expire(1021.0), [far])
+
+  def test_long_gap (self):
+    """
+    One call after many turns expires everything due
+    """
+    objs = [Expiring(1000.0 + i * 0.7) for i in range(20)]
+    for o in objs:
+      self.wheel.add(o)
+    self.assertEqual(set(self.wheel.expire(1100.0)), set(objs))
+    self.assertEqual(len(self.wheel), 0)
+
+
+class PathSetupExpiryTest (unittest.TestCase):
+  def setUp (self):
+    self.clock = FakeClock()
+    self._time = dcn.time
+    self._pending = dcn.pending_paths
+    dcn.time = self.clock
+    dcn.pending_paths = dcn.ExpiryWheel(dcn.PATH_SETUP_TIME)
+    self._stats = dict(dcn.path_setup_stats)
+    dcn.waiting_paths.clear()
+
+  def tearDown (self):
+    dcn.time = self._time
+    dcn.pending_paths = self._pending
+    dcn.path_setup_stats.update(self._stats)
+    dcn.waiting_paths.clear()
+
+  def test_unanswered_setup_expires (self):
+    """
+    A setup whose barriers never return is given up PATH_SETUP_TIME on
+    """
+    sw = dcn.Switch()
+    sw.dpid = 1
+    wp = dcn.WaitingPath([(sw, 1, 2)], None)
+    wp.add_xid(1, 7)
+    expired = dcn.path_setup_stats['expired']
+    self.assertEqual(dcn.PATH_SETUP_TIME, 5)
+    self.clock.now += dcn.PATH_SETUP_TIME - dcn.PATH_EXPIRY_RESOLUTION
+    dcn.WaitingPath.expire_waiting_paths()
+    self.assertFalse(wp.is_expired)
+    self.assertEqual(dcn.waiting_paths, {(1, 7): wp})
+    self.clock.now += 2 * dcn.PATH_EXPIRY_RESOLUTION
+    self.assertTrue(wp.is_expired)
+    dcn.WaitingPath.expire_waiting_paths()
+    self.assertEqual(dcn.waiting_paths, {})
+    self.assertEqual(len(dcn.pending_paths), 0)
+    self.assertEqual(dcn.path_setup_stats['expired'], expired + 1)
+
+
+class MacMapTest (unittest.TestCase):
+  def setUp (self):
+    self.m = dcn.MacMap()
+    self.macs = [EthAddr("00:00:00:00:00:%02x" % i) for i in range(1, 6)]
+
+  def check_indexes (self):
+    """
+    Both indexes describe the same locations
+    """
+    on_port = {}
+    for mac, loc in self.m.locations.items():
+      on_port.setdefault(loc, set()).add(mac)
+    self.assertEqual(dict(self.m.on_port), on_port)
+
+  def test_learn (self):
+    self.m.learn(self.macs[0], ('s1', 1))
+    self.m.learn(self.macs[0], ('s1', 1))
+    self.assertEqual(self.m[self.macs[0]], ('s1', 1))
+    self.assertEqual(len(self.m), 1)
+    self.assertEqual(self.m.moves, 0)
+    self.check_indexes()
+
+  def test_move (self):
+    a, b = self.macs[:2]
+    self.m.learn(a, ('s1', 1))
+    self.m.learn(b, ('s1', 1))
+    self.m.learn(a, ('s2', 3))
+    self.assertEqual(self.m.get(a), ('s2', 3))
+    self.assertEqual(self.m.on_port[('s1', 1)], set([b]))
+    self.assertEqual(self.m.on_port[('s2', 3)], set([a]))
+    self.assertEqual(self.m.moves, 1)
+    self.check_indexes()
+    # The last ethaddr leaving a port takes the port with it
+    self.m.learn(b, ('s2', 3))
+    self.assertFalse(('s1', 1) in self.m.on_port)
+    self.check_indexes()
+
+  def test_unlearn_port (self):
+    for i, mac in enumerate(self.macs):
+      self.m.learn(mac, ('s1', 1 + i % 2))
+    self.m.learn(self.macs[4], ('s2', 1))
+    gone = self.m.unlearn_port('s1', 1)
+    self.assertEqual(set(gone), set([self.macs[0], self.macs[2]]))
+    self.assertEqual(sorted(self.m.locations),
+                     sorted([self.macs[1], self.macs[3], self.macs[4]]))
+    self.assertEqual(self.m.unlearns, 2)
+    self.check_indexes()
+    self.assertEqual(list(self.m.unlearn_port('s1', 1)), [])
+    self.assertEqual(self.m.unlearns, 2)
+
+  def test_unlearn (self):
+    a, b = self.macs[:2]
+    self.m.learn(a, ('s1', 1))
+    self.m.learn(b, ('s1', 1))
+    self.m.unlearn(a)
+    self.m.unlearn(a)
+    self.assertFalse(a in self.m)
+    self.assertEqual(self.m.unlearns, 1)
+    self.check_indexes()
+
+
+class FakeConnection (object):
+  """
+  Records flow_mods as they go out; matches are shared and reused
+  """
+  def __init__ (self, dpid):
+    self.dpid = dpid
+    self.flow_mods = []
+
+  def addListeners (self, sink):
+    return []
+
+  def removeListeners (self, listeners):
+    pass
+
+  def send (self, msg):
+    if isinstance(msg, of.ofp_flow_mod):
+      match = of.ofp_match()
+      match.unpack(msg.match.pack())
+      self.flow_mods.append((match, msg.flags))
+
+
+class FakePacketIn (object):
+  def __init__ (self, port):
+    self.port = port
+    self.ofp = None
+
+
+class FakeFlowRemoved (object):
+  def __init__ (self, match):
+    self.ofp = of.ofp_flow_removed(match=match)
+
+
+def flow_match (sport, proto=6):
+  return of.ofp_match(dl_src=EthAddr("00:00:00:00:00:01"),
+                      dl_dst=EthAddr("00:00:00:00:00:02"), dl_type=0x800,
+                      nw_src=IPAddr("10.0.0.1"), nw_dst=IPAddr("10.0.0.2"),
+                      nw_proto=proto, tp_src=sport, tp_dst=80)
+
+
+class ECMPTest (unittest.TestCase):
+  """
+  Switches 1 and 4 are joined through 2 and through 3
+  """
+  def setUp (self):
+    self._pending = dcn.pending_paths
+    dcn.pending_paths = dcn.ExpiryWheel(dcn.PATH_SETUP_TIME)
+    dcn.switches.clear()
+    dcn.adjacency.clear()
+    for dpid in (1, 2, 3, 4):
+      sw = dcn.Switch()
+      sw.dpid = dpid
+      sw.ports = []
+      sw.connection = FakeConnection(dpid)
+      dcn.switches[dpid] = sw
+    sws = dcn.switches
+    for a, b in ((1, 2), (1, 3), (2, 4), (3, 4)):
+      dcn.adjacency[sws[a]][sws[b]] = b
+      dcn.adjacency[sws[b]][sws[a]] = a
+    dcn._refresh_paths()
+
+  def tearDown (self):
+    dcn.pending_paths = self._pending
+    dcn.waiting_paths.clear()
+    dcn.path_flows.clear()
+    dcn.path_entries.clear()
+    dcn.switches.clear()
+    dcn.adjacency.clear()
+    dcn._refresh_paths()
+
+  def test_hash_symmetric (self):
+    for sport in range(1000, 1020):
+      for proto in (6, 17):
+        match = flow_match(sport, proto)
+        self.assertEqual(dcn._flow_hash(match),
+                         dcn._flow_hash(match.flip()))
+    # Swapping only the ports is another flow
+    a = flow_match(1000)
+    b = flow_match(80)
+    b.tp_dst = 1000
+    self.assertNotEqual(dcn._flow_hash(a), dcn._flow_hash(b))
+
+  def test_choice_stable (self):
+    src, dst = dcn.switches[1], dcn.switches[4]
+    middles = set()
+    for flow_hash in range(8):
+      path = dcn._choose_raw_path(src, dst, flow_hash)
+      self.assertEqual(len(path), 1)
+      # The same on every call, and in both directions
+      self.assertEqual(dcn._choose_raw_path(src, dst, flow_hash), path)
+      self.assertEqual(dcn._choose_raw_path(dst, src, flow_hash), path[::-1])
+      middles.add(path[0].dpid)
+    self.assertEqual(middles, set([2, 3]))
+    self.assertEqual(dcn._choose_raw_path(src, src, 0), None)
+
+  def install (self, sport):
+    match = flow_match(sport)
+    sw = dcn.switches[1]
+    sw.install_path(dcn.switches[4], 9, match, FakePacketIn(8),
+                    flow_hash=dcn._flow_hash(match))
+
+  def remove_all (self):
+    """
+    Remove every entry installed so far, reporting those that asked
+    """
+    for sw in dcn.switches.values():
+      for match, flags in sw.connection.flow_mods:
+        if flags & of.OFPFF_SEND_FLOW_REM:
+          sw._handle_FlowRemoved(FakeFlowRemoved(match))
+      sw.connection.flow_mods = []
+
+  def test_count_down (self):
+    for sport in (1000, 1001, 1002, 1003):
+      self.install(sport)
+    # Only the ingress entry asks to be told of its removal
+    for sw in dcn.switches.values():
+      flagged = [m for m, flags in sw.connection.flow_mods
+                 if flags & of.OFPFF_SEND_FLOW_REM]
+      self.assertEqual(len(flagged), 4 if sw.dpid == 1 else 0)
+    counts = dcn.path_flows
+    self.assertEqual(list(counts), [(1, 4)])
+    self.assertEqual(sum(counts[(1, 4)].values()), 4)
+    for path in counts[(1, 4)]:
+      self.assertTrue(path in ((1, 2, 4), (1, 3, 4)))
+    # Reinstalling a flow moves it rather than counting it twice
+    self.install(1000)
+    self.assertEqual(sum(dcn.path_flows[(1, 4)].values()), 4)
+    # One flow's ingress entry going counts just that flow off
+    sw = dcn.switches[1]
+    sw._handle_FlowRemoved(FakeFlowRemoved(sw.connection.flow_mods[0][0]))
+    self.assertEqual(sum(dcn.path_flows[(1, 4)].values()), 3)
+    self.remove_all()
+    self.assertEqual(dict(dcn.path_flows), {})
+    self.assertEqual(dcn.path_entries, {})
+
+  def test_reconnect_forgets (self):
+    self.install(1000)
+    self.install(1001)
+    self.assertEqual(len(dcn.path_entries), 2)
+    # The ingress switch may have lost its entries without telling
+    sw = dcn.switches[1]
+    sw.connect(FakeConnection(1))
+    self.assertEqual(dict(dcn.path_flows), {})
+    self.assertEqual(dcn.path_entries, {})
+
+
+if __name__ == '__main__':
+  unittest.main()
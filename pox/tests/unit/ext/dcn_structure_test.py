@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for fat-tree and BCube inference in ext/dcn_structure, on the
+topologies ripl builds for Mininet
+"""
+
+import unittest
+import sys
+import os.path
+
+here = os.path.dirname(__file__)
+sys.path.append(here + "/../../..")
+sys.path.append(here + "/../../../ext")
+sys.path.append(here + "/../../../../ripl")
+sys.path.append(here + "/../../../../mininet")
+from pox.core import core
+from pox.openflow.discovery import Discovery, LinkEvent
+from ripl.dctopo import FatTreeTopo, BCubeTopo
+from dcn_structure import DCNStructure, FatTree, BCube
+from dcn_structure import infer_fat_tree, infer_bcube
+
+
+def switch_graph (topo):
+  """
+  Return the switch graph of a ripl topology as [dpid] -> set of dpids,
+  and the set of dpids that hosts attach to
+  """
+  dpid = lambda name: topo.id_gen(name=name).dpid
+  switches = set(topo.switches())
+  adj = dict((dpid(s), set(dpid(n) for n in topo.g[s] if n in switches))
+             for s in switches)
+  hosted = set(dpid(s) for s in switches
+               if any(n not in switches for n in topo.g[s]))
+  return adj, hosted
+
+
+def fat_tree_layers (topo):
+  layers = {FatTreeTopo.LAYER_CORE: 'core', FatTreeTopo.LAYER_AGG: 'agg',
+            FatTreeTopo.LAYER_EDGE: 'edge'}
+  return dict((topo.id_gen(name=s).dpid, layers[topo.layer(s)])
+              for s in topo.switches())
+
+
+class InferenceTest (unittest.TestCase):
+  def check_path (self, adj, path, src, dst):
+    self.assertEqual(path[0], src)
+    self.assertEqual(path[-1], dst)
+    for a, b in zip(path[:-1], path[1:]):
+      self.assertTrue(b in adj[a])
+    self.assertEqual(len(set(path)), len(path))
+
+  def check_fat_tree (self, k):
+    topo = FatTreeTopo(k)
+    adj, hosted = switch_graph(topo)
+    ft = infer_fat_tree(adj, hosted)
+    self.assertTrue(isinstance(ft, FatTree))
+    self.assertEqual(ft.k, k)
+    layers = fat_tree_layers(topo)
+    for d in adj:
+      self.assertEqual(ft.layer(d), layers[d])
+    edges = sorted(ft.edges)
+    for src in edges:
+      for dst in edges:
+        paths = set()
+        for flow_hash in xrange(k * k):
+          path = ft.route(src, dst, flow_hash)
+          self.check_path(adj, path, src, dst)
+          paths.add(tuple(path))
+        # Every equal-cost path gets used
+        if src == dst:
+          self.assertEqual(paths, set([(src,)]))
+        elif ft.pod[src] == ft.pod[dst]:
+          self.assertEqual(len(paths), k / 2)
+        else:
+          self.assertEqual(len(paths), k * k / 4)
+    self.assertEqual(ft.route(edges[0], min(ft.core_aggs), 0), None)
+
+  def check_bcube (self, k, n):
+    topo = BCubeTopo(k, n)
+    adj, hosted = switch_graph(topo)
+    bc = infer_bcube(adj, hosted)
+    self.assertTrue(isinstance(bc, BCube))
+    self.assertEqual((bc.k, bc.n), (k, n))
+    self.assertEqual(set(bc.coords), hosted)
+    for d in adj:
+      self.assertEqual(bc.layer(d), 'relay' if d in hosted else 'level')
+    relays = sorted(hosted)
+    for src in relays:
+      for dst in relays:
+        differ = sum(1 for a, b in zip(bc.coords[src], bc.coords[dst])
+                     if a != b)
+        firsts = set()
+        for flow_hash in xrange(k + 1):
+          path = bc.route(src, dst, flow_hash)
+          self.check_path(adj, path, src, dst)
+          self.assertEqual(len(path), 2 * differ + 1)
+          if differ:
+            firsts.add(path[1])
+        # Each differing digit can be corrected first
+        self.assertEqual(len(firsts), differ)
+
+  def test_fat_tree_4 (self):
+    self.check_fat_tree(4)
+
+  def test_fat_tree_6 (self):
+    self.check_fat_tree(6)
+
+  def test_bcube_1_4 (self):
+    self.check_bcube(1, 4)
+
+  def test_bcube_2_3 (self):
+    self.check_bcube(2, 3)
+
+  def test_bcube_1_2 (self):
+    self.check_bcube(1, 2)
+
+  def test_not_a_fat_tree (self):
+    adj, hosted = switch_graph(FatTreeTopo(4))
+    self.assertEqual(infer_bcube(adj, hosted), None)
+    edge = min(d for d in hosted)
+    agg = min(adj[edge])
+    adj[edge].discard(agg)
+    adj[agg].discard(edge)
+    self.assertEqual(infer_fat_tree(adj, hosted), None)
+
+  def test_degenerate_bcube (self):
+    """
+    Chains and stars fit BCube's counts with n == 1 or k == 0
+    """
+    chain = {1: set([2]), 2: set([1, 3]), 3: set([2])}
+    self.assertEqual(infer_bcube(chain, set()), None)
+    self.assertEqual(infer_bcube(chain, set([2])), None)
+    star = {1: set([2, 3]), 2: set([1]), 3: set([1])}
+    self.assertEqual(infer_bcube(star, set([2, 3])), None)
+
+  def test_ambiguous_bcube (self):
+    """
+    With n == k + 1 both sides of a BCube look alike; hosts decide
+    """
+    adj, hosted = switch_graph(BCubeTopo(1, 2))
+    self.assertEqual(infer_bcube(adj, set()), None)
+    levels = set(adj) - hosted
+    # One host is enough to pick a side, from either side
+    bc = infer_bcube(adj, set([min(hosted)]))
+    self.assertEqual(set(bc.coords), hosted)
+    bc = infer_bcube(adj, set([min(levels)]))
+    self.assertEqual(set(bc.coords), levels)
+    # Hosts on both sides can't be a BCube
+    self.assertEqual(infer_bcube(adj, set([min(hosted), min(levels)])),
+                     None)
+
+
+class MockDiscovery (Discovery):
+  def __init__ (self):
+    # No listeners or LLDP sender; just the link table
+    self.adjacency = {}
+
+
+class IncrementalTest (unittest.TestCase):
+  def setUp (self):
+    self.discovery = MockDiscovery()
+    core.register("openflow_discovery", self.discovery)
+    self.ports = {}  # [dpid] -> next free port
+
+  def tearDown (self):
+    del core.components["openflow_discovery"]
+
+  def port (self, dpid):
+    self.ports[dpid] = self.ports.get(dpid, 0) + 1
+    return self.ports[dpid]
+
+  def link (self, s, added, a, b):
+    """
+    Report the link between switches a and b in both directions
+    """
+    if added:
+      pa, pb = self.port(a), self.port(b)
+      links = [Discovery.Link(a, pa, b, pb), Discovery.Link(b, pb, a, pa)]
+    else:
+      links = [l for l in self.discovery.adjacency
+               if (l.dpid1, l.dpid2) in ((a, b), (b, a))]
+    for l in links:
+      if added:
+        self.discovery.adjacency[l] = 0
+      s._handle_openflow_discovery_LinkEvent(LinkEvent(added, l))
+      if not added:
+        del self.discovery.adjacency[l]
+
+  def build (self, s, topo):
+    adj, hosted = switch_graph(topo)
+    links = sorted(set(tuple(sorted((a, b))) for a in adj for b in adj[a]))
+    for a, b in links:
+      # No partial graph passes for either structure
+      self.assertEqual(s.structure, None)
+      self.link(s, True, a, b)
+    for d in hosted:
+      s.host_at(d)
+    return adj, hosted, links
+
+  def test_fat_tree (self):
+    s = DCNStructure()
+    adj, hosted, links = self.build(s, FatTreeTopo(4))
+    self.assertEqual(s.kind, 'ft')
+    self.assertEqual(s.stats['confirmed'], 1)
+    self.assertEqual(s.n_links, len(links))
+    self.assertEqual(dict(s.adj), adj)
+    # The full check only ran once the counts fit
+    self.assertEqual(s.stats['checks'], 1)
+    edges = sorted(hosted)
+    self.assertEqual(s.route(edges[0], edges[-1], 3),
+                     s.route(edges[-1], edges[0], 3)[::-1])
+    # Losing a link loses the structure; restoring it brings it back
+    a, b = links[0]
+    self.link(s, False, a, b)
+    self.assertEqual(s.structure, None)
+    self.assertEqual(s.route(edges[0], edges[-1]), None)
+    self.assertEqual(s.stats['lost'], 1)
+    self.assertEqual(s.n_links, len(links) - 1)
+    self.link(s, True, a, b)
+    self.assertEqual(s.kind, 'ft')
+    self.assertEqual(s.layer(edges[0]), 'edge')
+
+  def test_bcube (self):
+    s = DCNStructure(expect='bc')
+    adj, hosted, links = self.build(s, BCubeTopo(1, 4))
+    self.assertEqual(s.kind, 'bc')
+    self.assertEqual(s.layer(min(hosted)), 'relay')
+    self.assertEqual(s.layer(min(set(adj) - hosted)), 'level')
+
+  def test_one_direction_only (self):
+    s = DCNStructure()
+    l = Discovery.Link(1, 1, 2, 1)
+    self.discovery.adjacency[l] = 0
+    s._handle_openflow_discovery_LinkEvent(LinkEvent(True, l))
+    self.assertEqual(s.n_links, 0)
+
+  def test_ambiguous_bcube (self):
+    s = DCNStructure()
+    adj, hosted = switch_graph(BCubeTopo(1, 2))
+    for a in adj:
+      for b in adj[a]:
+        if a < b:
+          self.link(s, True, a, b)
+    self.assertEqual(s.structure, None)
+    s.host_at(min(hosted))
+    self.assertEqual(s.kind, 'bc')
+    self.assertEqual(set(s.structure.coords), hosted)
+
+  def test_expect_limits_kind (self):
+    s = DCNStructure(expect='bc')
+    self.build(s, FatTreeTopo(4))
+    self.assertEqual(s.structure, None)
+    self.assertEqual(s.stats['checks'], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for the setup latency histograms in ext/latency
+"""
+
+import unittest
+import sys
+import os.path
+
+here = os.path.dirname(__file__)
+sys.path.append(here + "/../../..")
+sys.path.append(here + "/../../../ext")
+from pox.core import core
+from latency import Histogram, SetupLatency
+import DCNController as dcn
+
+
+def us (n):
+  """
+  n microseconds in seconds
+  """
+  return n / 1e6
+
+
+class HistogramTest (unittest.TestCase):
+  def test_exact_below_sub_buckets (self):
+    h = Histogram(sub_bits=7)
+    for n in range(128):
+      h.record(us(n))
+    self.assertEqual(sorted(h.counts), range(128))
+    self.assertEqual(set(h.counts.values()), set([1]))
+
+  def test_bucket_boundaries (self):
+    """
+    Each power of two above the sub-buckets halves their resolution
+    """
+    h = Histogram(sub_bits=7)
+    for n in (128, 129, 130, 255, 256, 259, 260, 1000000):
+      h.record(us(n))
+    self.assertEqual(dict(h.counts), {128: 2, 130: 1, 254: 1, 256: 2,
+                                      260: 1, 999424: 1})
+    self.assertEqual((h.min, h.max, h.count), (128, 1000000, 8))
+
+  def test_bucket_error (self):
+    h = Histogram()
+    for n in xrange(1, 100000, 37):
+      h.counts.clear()
+      h.record(us(n))
+      bound = h.counts.keys()[0]
+      self.assertTrue(bound <= n)
+      self.assertTrue(n - bound < n / 64.0 + 1)
+
+  def test_percentiles (self):
+    h = Histogram()
+    for n in range(1, 101):
+      h.record(us(n))
+    self.assertEqual(h.percentile(50), 50)
+    self.assertEqual(h.percentile(90), 90)
+    self.assertEqual(h.percentile(99.9), 100)
+    self.assertEqual(h.percentile(100), 100)
+    self.assertEqual(h.percentile(0), 1)
+    d = h.to_dict()
+    self.assertEqual(d['count'], 100)
+    self.assertEqual(d['mean_us'], 50)
+    self.assertEqual((d['min_us'], d['max_us']), (1, 100))
+    self.assertEqual(d['p99_us'], 99)
+    self.assertEqual(len(d['buckets']), 100)
+
+  def test_empty (self):
+    h = Histogram()
+    self.assertEqual(h.percentile(50), 0)
+    d = h.to_dict()
+    self.assertEqual(d['count'], 0)
+    self.assertEqual((d['min_us'], d['max_us'], d['mean_us']), (0, 0, 0))
+    self.assertEqual(d['buckets'], [])
+    for p in ('p50_us', 'p90_us', 'p99_us', 'p99.9_us'):
+      self.assertEqual(d[p], 0)
+
+  def test_negative_clamped (self):
+    h = Histogram()
+    h.record(-0.5)
+    self.assertEqual(dict(h.counts), {0: 1})
+
+
+class FakeController (object):
+  """
+  Stands in for core.DCNController; takes PathInstalled
+  """
+  def raiseEvent (self, event, *args, **kw):
+    pass
+
+
+class SetupLatencyTest (unittest.TestCase):
+  def setUp (self):
+    self.latency = SetupLatency()
+    core.register("SetupLatency", self.latency)
+
+  def tearDown (self):
+    del core.components["SetupLatency"]
+
+  def test_keys (self):
+    record = self.latency.record
+    record('riplpox', 'route', us(10), 3)
+    record('riplpox', 'route', us(20), 3)
+    record('riplpox', 'route', us(30), 5)
+    record('riplpox', 'barrier', us(40), 3)
+    record('DCNController', 'total', us(50))
+    self.assertEqual(sorted(self.latency.histograms),
+                     [('DCNController', 'total', 0),
+                      ('riplpox', 'barrier', 3),
+                      ('riplpox', 'route', 3),
+                      ('riplpox', 'route', 5)])
+    d = self.latency.to_dict()
+    self.assertEqual(sorted(d['riplpox']), ['barrier', 'route'])
+    self.assertEqual(sorted(d['riplpox']['route']), ['3', '5'])
+    self.assertEqual(d['riplpox']['route']['3']['count'], 2)
+    self.assertEqual(d['DCNController']['total']['0']['max_us'], 50)
+
+  def test_dcn_controller_stages (self):
+    """
+    A DCNController path setup records every stage by path length
+    """
+    core.register("DCNController", FakeController())
+    try:
+      sws = []
+      for dpid in (1, 2, 3):
+        sw = dcn.Switch()
+        sw.dpid = dpid
+        sws.append(sw)
+      path = [(sw, 1, 2) for sw in sws]
+      wp = dcn.WaitingPath(path, None, stamps=(100.0, 100.001, 100.002))
+      wp.sent = 100.003
+      for sw in sws:
+        wp.add_xid(sw.dpid, 7)
+
+      class Barrier (object):
+        xid = 7
+      for sw in sws:
+        event = Barrier()
+        event.dpid = sw.dpid
+        dcn.waiting_paths.pop((sw.dpid, 7)).notify(event)
+    finally:
+      del core.components["DCNController"]
+    h = self.latency.histograms
+    self.assertEqual(sorted(h),
+                     [('DCNController', stage, 3) for stage in
+                      ('barrier', 'install', 'parse', 'route', 'total')])
+    self.assertEqual(h[('DCNController', 'barrier', 3)].count, 3)
+    self.assertEqual(dict(h[('DCNController', 'parse', 3)].counts),
+                     {1000: 1})
+    self.assertEqual(len(dcn.pending_paths), 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for LLDP sending and link expiry in openflow.discovery
+"""
+
+import unittest
+import sys
+import os.path
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+from pox.core import core
+from pox.lib.revent import EventMixin
+from pox.lib.addresses import EthAddr
+from pox.lib.packet import ethernet
+import pox.openflow.libopenflow_01 as of
+from pox.openflow import PortStatus, ConnectionUp, ConnectionDown, PacketIn
+from pox.openflow.discovery import LLDPSender, Discovery
+
+class MockOpenFlow (EventMixin):
+  _eventMixin_events = set([PortStatus, ConnectionUp, ConnectionDown,
+                            PacketIn])
+
+  def __init__ (self):
+    self.sent = []
+    self.frames = []
+    self.connections = {1:None, 2:None}
+
+  def sendToDPID (self, dpid, data):
+    self.sent.append(dpid)
+    self.frames.append(data)
+
+
+# Switch 1 ports 1 and 2 lead to switch 2; ports 3 and 4 face hosts
+SWITCH_PORTS = [(1, 1), (1, 2)]
+HOST_PORTS = [(1, 3), (1, 4)]
+
+
+class SlowLLDPSender (LLDPSender):
+  # Ticks so far apart that the sender's own timer stays out of the way
+  _sends_per_sec = 0.0001
+
+
+class LLDPSenderTest (unittest.TestCase):
+  def setUp (self):
+    self.of = MockOpenFlow()
+    core.register("openflow", self.of)
+
+  def tearDown (self):
+    del core.components["openflow"]
+
+  def sender (self, **kw):
+    s = SlowLLDPSender(1, **kw)
+    for dpid, port in SWITCH_PORTS + HOST_PORTS:
+      s.add_port(dpid, port, EthAddr("00:00:00:00:00:%02x" % port))
+    return s
+
+  def cycle (self, s, heard = SWITCH_PORTS):
+    """
+    Run one send cycle, hear LLDP on the heard ports; return sends
+    """
+    s._credit = len(s._items)
+    before = len(self.of.sent)
+    s._timer_handler()
+    for dpid, port in heard:
+      s.heard(dpid, port)
+    return len(self.of.sent) - before
+
+  def test_no_host_ports (self):
+    s = self.sender()
+    self.assertEqual(self.cycle(s), 4)
+    self.assertEqual(s.sent, 4)
+    self.assertEqual(s.suppressed, 0)
+
+  def test_static_host_ports_silenced (self):
+    s = self.sender(host_port_cycles = 0)
+    s.set_host_ports(HOST_PORTS)
+    for _ in range(3):
+      self.cycle(s)
+    self.assertEqual(s.sent, 6)
+    self.assertEqual(s.suppressed, 6)
+    self.assertEqual(len(self.of.sent), 6)
+
+  def test_static_host_ports_slowed (self):
+    s = self.sender(host_port_cycles = 2)
+    s.set_host_ports(HOST_PORTS)
+    for _ in range(4):
+      self.cycle(s)
+    # Switch ports every cycle, host ports every other cycle
+    self.assertEqual(s.sent, 4 * 2 + 2 * 2)
+
+  def test_learned_host_ports (self):
+    s = self.sender(host_port_cycles = 0, learn_cycles = 2)
+    self.cycle(s)
+    self.cycle(s)
+    self.assertFalse(s.is_host_port(1, 3))
+    # Two whole cycles without LLDP on the host ports; learned as the
+    # third starts, so only the switch ports are sent on in it
+    self.assertEqual(self.cycle(s), 2)
+    self.assertTrue(s.is_host_port(1, 3))
+    self.assertTrue(s.is_host_port(1, 4))
+    self.assertFalse(s.is_host_port(1, 1))
+
+  def test_heard_on_host_port (self):
+    s = self.sender(host_port_cycles = 0, learn_cycles = 1)
+    s.set_host_ports([(1, 3)])
+    self.cycle(s)
+    self.cycle(s)
+    self.assertTrue(s.is_host_port(1, 4))
+    # A switch turned up on both; they're switch ports again
+    s.heard(1, 3)
+    s.heard(1, 4)
+    self.assertFalse(s.is_host_port(1, 3))
+    self.assertFalse(s.is_host_port(1, 4))
+    self.assertEqual(self.cycle(s, SWITCH_PORTS + HOST_PORTS), 4)
+
+  def test_del_port_forgets_learning (self):
+    s = self.sender(host_port_cycles = 0, learn_cycles = 1)
+    self.cycle(s)
+    self.cycle(s)
+    self.assertTrue(s.is_host_port(1, 3))
+    s.del_port(1, 3)
+    s.add_port(1, 3, EthAddr("00:00:00:00:00:03"))
+    self.assertFalse(s.is_host_port(1, 3))
+
+  def test_readded_port_sent_once (self):
+    s = self.sender()
+    self.cycle(s)
+    packet = s._items[(1, 1)].packet
+    s.del_port(1, 1)
+    s.add_port(1, 1, EthAddr("00:00:00:00:00:01"))
+    self.assertTrue(s._items[(1, 1)].packet is packet)
+    self.assertEqual(self.cycle(s), 4)
+
+  def test_del_switch (self):
+    s = self.sender()
+    s.add_port(2, 1, EthAddr("00:00:00:00:01:01"))
+    self.cycle(s)
+    s.del_switch(1)
+    self.assertEqual(self.cycle(s), 1)
+    self.assertEqual(self.of.sent[-1], 2)
+
+  def test_paced_sends (self):
+    s = self.sender()
+    for port in range(5, 26):
+      s.add_port(1, port, EthAddr("00:00:00:00:00:%02x" % port))
+    # 25 sends per one-second cycle at 10 ticks per second
+    s._sends_per_sec = 10
+    per_tick = []
+    for _ in range(10):
+      before = len(self.of.sent)
+      s._timer_handler()
+      per_tick.append(len(self.of.sent) - before)
+    self.assertEqual(sum(per_tick), 25)
+    self.assertTrue(max(per_tick) <= 3)
+
+  def test_paced_sends_with_host_ports (self):
+    s = self.sender(host_port_cycles = 8, learn_cycles = 0)
+    for port in range(5, 25):
+      s.add_port(1, port, EthAddr("00:00:00:00:00:%02x" % port))
+    s.set_host_ports(HOST_PORTS + [(1, port) for port in range(5, 25)])
+    # 2 switch ports, and 22 host ports over 8 phases of at most 3 each:
+    # 5 sends per one-second cycle at 10 ticks per second
+    s._sends_per_sec = 10
+    s._timer_handler()
+    per_cycle = {}
+    ticks = {}
+    for _ in range(80):
+      before = len(self.of.sent)
+      s._timer_handler()
+      sends = len(self.of.sent) - before
+      self.assertTrue(sends <= 1)
+      per_cycle[s._cycles] = per_cycle.get(s._cycles, 0) + sends
+      ticks[s._cycles] = ticks.get(s._cycles, 0) + 1
+    del per_cycle[s._cycles], per_cycle[1] # Partly seen
+    del ticks[s._cycles], ticks[1]
+    self.assertTrue(set(per_cycle.values()) <= set([4, 5]))
+    self.assertTrue(max(ticks.values()) <= 10)
+
+  def gaps (self, switch_ports, host_ports, cycles = 20):
+    """
+    Run a sender with default settings at its own pace; return the
+    longest time between sends on any switch port and on any host port
+    """
+    s = SlowLLDPSender(Discovery._link_timeout / 2.0,
+                       host_port_cycles = Discovery._host_port_cycles,
+                       learn_cycles = 0)
+    ports = range(1, switch_ports + host_ports + 1)
+    for port in ports:
+      s.add_port(1, port, EthAddr("00:00:00:00:00:%02x" % port))
+    s.set_host_ports((1, port) for port in ports[switch_ports:])
+    port_of = dict((frame[1], key[1]) for key, frame in s._frames.items())
+
+    s._sends_per_sec = 100
+    ticks = int(cycles * s._send_cycle_time * s._sends_per_sec)
+    last = {}
+    gap = {}
+    for tick in range(ticks):
+      before = len(self.of.frames)
+      s._timer_handler()
+      now = float(tick) / s._sends_per_sec
+      for data in self.of.frames[before:]:
+        port = port_of[data]
+        gap[port] = max(gap.get(port, 0), now - last.get(port, 0))
+        last[port] = now
+    self.assertEqual(sorted(last), ports)
+    return (max(gap[p] for p in ports[:switch_ports]),
+            max(gap[p] for p in ports[switch_ports:]))
+
+  def test_host_ports_keep_switch_ports_alive (self):
+    cycle = Discovery._link_timeout / 2.0
+    for hosts in (4, 8, 40):
+      switch_gap, host_gap = self.gaps(4, hosts)
+      self.assertTrue(switch_gap < Discovery._link_timeout,
+                      "%s hosts: %ss between sends" % (hosts, switch_gap))
+      self.assertTrue(host_gap <= (Discovery._host_port_cycles + 1) * cycle)
+
+
+class MockPacketIn (object):
+  def __init__ (self, dpid, port, data):
+    self.dpid = dpid
+    self.port = port
+    self.parsed = ethernet(data)
+    self.ofp = of.ofp_packet_in(buffer_id = None)
+
+
+class LinkExpiryTest (unittest.TestCase):
+  def setUp (self):
+    self.of = MockOpenFlow()
+    core.register("openflow", self.of)
+    self.d = Discovery(install_flow = False)
+    self.events = []
+    self.d.addListenerByName("LinkEvent", self.events.append)
+
+  def tearDown (self):
+    del core.components["openflow"]
+
+  def receive (self, dpid1, port1, dpid2, port2):
+    """
+    Have an LLDP packet from dpid1.port1 arrive at dpid2.port2
+    """
+    po = of.ofp_packet_out()
+    po.unpack(self.d._sender.create_discovery_packet(dpid1, port1,
+        EthAddr("00:00:00:00:00:01")))
+    self.d._handle_openflow_PacketIn(MockPacketIn(dpid2, port2, po.data))
+    return Discovery.Link(dpid1, port1, dpid2, port2)
+
+  def age (self, link, seconds):
+    self.d.adjacency[link] -= seconds
+
+  def test_expire_oldest (self):
+    a = self.receive(1, 1, 2, 1)
+    b = self.receive(2, 1, 1, 1)
+    self.assertEqual([e.link for e in self.events if e.added], [a, b])
+    self.age(a, 100)
+    self.d._expire_links()
+    self.assertEqual(self.d.adjacency.keys(), [b])
+    self.assertEqual([e.link for e in self.events if e.removed], [a])
+
+  def test_refresh_moves_link (self):
+    a = self.receive(1, 1, 2, 1)
+    b = self.receive(2, 1, 1, 1)
+    self.age(b, 100)
+    # Heard from a again, so b is now the oldest
+    self.age(a, 100)
+    self.receive(1, 1, 2, 1)
+    self.d._expire_links()
+    self.assertEqual(self.d.adjacency.keys(), [a])
+    self.assertEqual([e.link for e in self.events if e.removed], [b])
+
+  def test_nothing_expired (self):
+    self.receive(1, 1, 2, 1)
+    self.receive(1, 1, 2, 1)
+    self.d._expire_links()
+    stats = self.d.lldp_stats
+    self.assertEqual(len(self.d.adjacency), 1)
+    self.assertEqual(stats['received'], 2)
+    self.assertEqual(stats['expired'], 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
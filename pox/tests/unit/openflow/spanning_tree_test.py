@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for incremental tree repair in openflow.spanning_tree
+"""
+
+import unittest
+import sys
+import os.path
+import random
+
+sys.path.append(os.path.dirname(__file__) + "/../../..")
+from pox.core import core
+from pox.lib.addresses import EthAddr
+import pox.openflow.libopenflow_01 as of
+from pox.openflow.discovery import Discovery, LinkEvent
+import pox.openflow.spanning_tree as spanning_tree
+from pox.openflow.spanning_tree import SpanningTree
+
+
+def components (links):
+  """
+  Sets of switches connected by links, as dpid -> set
+  """
+  comp = {}
+  for start in links:
+    if start in comp: continue
+    seen = set([start])
+    todo = [start]
+    while todo:
+      for dpid in links.get(todo.pop(), ()):
+        if dpid not in seen:
+          seen.add(dpid)
+          todo.append(dpid)
+    for dpid in seen:
+      comp[dpid] = seen
+  return comp
+
+
+class SpanningTreeTest (unittest.TestCase):
+  def check (self, t):
+    """
+    Check t.tree is a spanning forest of t.links
+    """
+    edges = 0
+    for s1, neighbors in t.tree.iteritems():
+      for s2, (p1, p2) in neighbors.iteritems():
+        self.assertTrue((p1, p2) in t.links[s1][s2])
+        self.assertEqual(t.tree[s2][s1], (p2, p1))
+        edges += 1
+    comp = components(t.links)
+    self.assertEqual(components(t.tree), dict((s, c) for s, c in
+                                              comp.iteritems() if len(c) > 1))
+    n_comps = len(set(id(c) for c in comp.itervalues()))
+    self.assertEqual(edges / 2, len(comp) - n_comps)
+    for dpid, c in comp.iteritems():
+      self.assertEqual(t._component[dpid], c)
+    self.assertEqual(set(t._component), set(comp))
+
+  def test_ring (self):
+    t = SpanningTree()
+    self.assertEqual(t.add_link(1, 1, 2, 1), [(1, 1), (2, 1)])
+    self.assertEqual(t.add_link(2, 2, 3, 1), [(2, 2), (3, 1)])
+    # Closes the ring; not on the tree
+    self.assertEqual(t.add_link(3, 2, 1, 2), [])
+    self.assertEqual(t.tree_ports(1), set([1]))
+    self.check(t)
+
+  def test_repair (self):
+    t = SpanningTree()
+    t.add_link(1, 1, 2, 1)
+    t.add_link(2, 2, 3, 1)
+    t.add_link(3, 2, 1, 2)
+    changed = t.remove_link(2, 2, 3, 1)
+    self.assertEqual(sorted(changed), [(1, 2), (2, 2), (3, 1), (3, 2)])
+    self.assertEqual(t.repairs, 1)
+    self.check(t)
+
+  def test_non_tree_removal (self):
+    t = SpanningTree()
+    t.add_link(1, 1, 2, 1)
+    t.add_link(2, 2, 3, 1)
+    t.add_link(3, 2, 1, 2)
+    self.assertEqual(t.remove_link(1, 2, 3, 2), [])
+    self.check(t)
+
+  def test_split (self):
+    t = SpanningTree()
+    t.add_link(1, 1, 2, 1)
+    t.add_link(2, 2, 3, 1)
+    t.add_link(3, 2, 4, 1)
+    t.remove_link(3, 1, 2, 2)
+    self.assertEqual(t.repairs, 0)
+    self.assertFalse(t._component[1] is t._component[4])
+    self.check(t)
+    t.remove_link(1, 1, 2, 1)
+    self.assertFalse(1 in t._component)
+    self.check(t)
+
+  def test_parallel_link (self):
+    t = SpanningTree()
+    t.add_link(1, 1, 2, 1)
+    t.add_link(1, 2, 2, 2)
+    self.assertEqual(t.remove_link(2, 1, 1, 1),
+                     [(2, 1), (1, 1), (2, 2), (1, 2)])
+    self.assertEqual(t.tree[1][2], (2, 2))
+    self.check(t)
+
+  def test_random_churn (self):
+    rng = random.Random(7)
+    t = SpanningTree()
+    up = set()
+    for _ in range(2000):
+      s1, s2 = rng.sample(range(1, 13), 2)
+      link = (s1, rng.randint(1, 2), s2, rng.randint(1, 2))
+      if link in up or rng.random() < 0.4:
+        if up:
+          link = rng.choice(sorted(up))
+          up.discard(link)
+          t.remove_link(*link)
+      else:
+        flip = (link[2], link[3], link[0], link[1])
+        if flip in up: continue
+        up.add(link)
+        t.add_link(*link)
+      self.check(t)
+
+
+class MockConnection (object):
+  def __init__ (self, dpid, n_ports):
+    self.dpid = dpid
+    self.connect_time = 0
+    self.ports = dict((i, of.ofp_phy_port(port_no = i,
+        hw_addr = EthAddr("00:00:00:00:%02x:%02x" % (dpid, i))))
+        for i in range(1, n_ports + 1))
+    self.sent = []
+
+  def send (self, msg):
+    self.sent.append((msg.port_no, msg.config == 0))
+
+
+class MockOpenFlow (object):
+  def __init__ (self):
+    self.connections = {}
+
+  def getConnection (self, dpid):
+    return self.connections.get(dpid)
+
+
+class MockDiscovery (Discovery):
+  def __init__ (self):
+    # No listeners or LLDP sender; just the link table
+    self.adjacency = {}
+    self._link_timeout = 2
+
+
+class LinkEventTest (unittest.TestCase):
+  def setUp (self):
+    self.of = MockOpenFlow()
+    self.discovery = MockDiscovery()
+    core.register("openflow", self.of)
+    core.register("openflow_discovery", self.discovery)
+    self._invalidate_ports = spanning_tree._invalidate_ports
+    spanning_tree._invalidate_ports = lambda dpid: None
+    spanning_tree._tree = SpanningTree()
+    spanning_tree._prev.clear()
+    spanning_tree._unsynced.clear()
+    for dpid in (1, 2, 3):
+      self.of.connections[dpid] = MockConnection(dpid, 3)
+
+  def tearDown (self):
+    spanning_tree._invalidate_ports = self._invalidate_ports
+    del core.components["openflow"]
+    del core.components["openflow_discovery"]
+
+  def link (self, added, dpid1, port1, dpid2, port2):
+    link = Discovery.Link(dpid1, port1, dpid2, port2)
+    if added:
+      self.discovery.adjacency[link] = 0
+    spanning_tree._handle_LinkEvent(LinkEvent(added, link))
+    if not added:
+      del self.discovery.adjacency[link]
+    return spanning_tree.update_stats['last_port_mods']
+
+  def both (self, added, dpid1, port1, dpid2, port2):
+    return (self.link(added, dpid1, port1, dpid2, port2) +
+            self.link(added, dpid2, port2, dpid1, port1))
+
+  def sent (self, dpid):
+    return self.of.connections[dpid].sent
+
+  def test_only_changed_ports (self):
+    # Ports 1 and 2 link the switches in a ring; port 3 faces hosts
+    self.both(True, 1, 1, 2, 1)
+    self.both(True, 2, 2, 3, 1)
+    self.assertEqual(self.both(True, 3, 2, 1, 2), 2)
+    self.assertEqual(self.sent(1)[-1], (2, False))
+    self.assertEqual(self.sent(3)[-1], (2, False))
+    # Losing a tree link turns the ring link on; nothing else changes
+    n = len(self.sent(1)) + len(self.sent(2)) + len(self.sent(3))
+    self.assertEqual(self.link(False, 1, 1, 2, 1), 4)
+    self.assertEqual(self.sent(1)[-1], (2, True))
+    self.assertEqual(self.sent(3)[-1], (2, True))
+    self.assertEqual(len(self.sent(1)) + len(self.sent(2)) +
+                     len(self.sent(3)), n + 4)
+
+  def test_first_update_checks_all_ports (self):
+    spanning_tree._unsynced.add(1)
+    self.link(True, 1, 1, 2, 1)
+    self.assertEqual(sorted(self.sent(1)), [(1, False), (2, True),
+                                            (3, True)])
+    self.assertEqual(self.sent(2), [(1, False)])
+
+
+if __name__ == '__main__':
+  unittest.main()
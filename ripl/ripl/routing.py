@@ -8,6 +8,7 @@ Routing engine base class.
 from copy import copy
 from random import choice
 from collections import defaultdict
+from time import time
 
 import logging
 lg = logging.getLogger('ripl.routing')
@@ -44,6 +45,34 @@ class Routing(object):
         '''
         raise NotImplementedError
 
+    def get_routes(self, src, dst):
+        '''Return all candidate flow paths.
+
+        @param src source host
+        @param dst destination host
+
+        @return flow_paths list of flow paths, empty if none found
+        '''
+        raise NotImplementedError
+
+    # Links routes must avoid, as (node1, node2) pairs in both directions
+    down_links = frozenset()
+
+    def set_link_down(self, a, b):
+        '''Exclude the link between a and b from future routes.'''
+        self.down_links = self.down_links | set([(a, b), (b, a)])
+
+    def set_link_up(self, a, b):
+        '''Allow routes over the link between a and b again.'''
+        self.down_links = self.down_links - set([(a, b), (b, a)])
+
+    def _live_paths(self, paths):
+        '''Return the paths that avoid every down link.'''
+        if not self.down_links:
+            return paths
+        return [p for p in paths
+                if not any(l in self.down_links for l in zip(p[:-1], p[1:]))]
+
 
 class StructuredRouting(Routing):
     '''Route flow through a StructuredTopo and return one path.
@@ -141,14 +170,15 @@ class StructuredRouting(Routing):
                                 new_path = src_path + dst_path_rev
                                 lg.info('adding path: %s' % new_path)
                                 complete_paths.append(new_path)
-                    else:
-                        if frontier_node not in src_paths_next:
-                            src_paths_next[frontier_node] = []
-                        for src_path in src_path_list:
-                            extended_path = src_path + [frontier_node]
-                            src_paths_next[frontier_node].append(extended_path)
-                            lg.info("adding to self.paths[%s] %s: " % \
-                                      (frontier_node, extended_path))
+                    # Extend it too, in case a deeper layer is needed:
+                    # get_routes goes on if every path found here is down
+                    if frontier_node not in src_paths_next:
+                        src_paths_next[frontier_node] = []
+                    for src_path in src_path_list:
+                        extended_path = src_path + [frontier_node]
+                        src_paths_next[frontier_node].append(extended_path)
+                        lg.info("adding to self.paths[%s] %s: " % \
+                                  (frontier_node, extended_path))
 
             # filter paths to only those in the most recently seen layer
             lg.info("src_paths_next: %s" % src_paths_next)
@@ -194,14 +224,15 @@ class StructuredRouting(Routing):
                                 lg.info('adding path: %s' % new_path)
                                 complete_paths.append(new_path)
 
-                    else:
-                        if frontier_node not in dst_paths_next:
-                            dst_paths_next[frontier_node] = []
-                        for dst_path in dst_path_list:
-                            extended_path = dst_path + [frontier_node]
-                            dst_paths_next[frontier_node].append(extended_path)
-                            lg.info("adding to self.paths[%s] %s: " % \
-                                      (frontier_node, extended_path))
+                    # Extend it too, in case a deeper layer is needed:
+                    # get_routes goes on if every path found here is down
+                    if frontier_node not in dst_paths_next:
+                        dst_paths_next[frontier_node] = []
+                    for dst_path in dst_path_list:
+                        extended_path = dst_path + [frontier_node]
+                        dst_paths_next[frontier_node].append(extended_path)
+                        lg.info("adding to self.paths[%s] %s: " % \
+                                  (frontier_node, extended_path))
 
             # filter paths to only those in the most recently seen layer
             lg.info("dst_paths_next: %s" % dst_paths_next)
@@ -211,18 +242,21 @@ class StructuredRouting(Routing):
         lg.info("complete paths = %s" % complete_paths)
         return complete_paths
 
-    def get_route(self, src, dst, hash_):
-        '''Return flow path.
+    def get_routes(self, src, dst):
+        '''Return all valid flow paths.
 
         @param src source dpid (for host or switch)
         @param dst destination dpid (for host or switch)
-        @param hash_ hash value
 
-        @return flow_path list of DPIDs to traverse (including inputs), or None
+        @return paths list of flow paths, empty if none found
+
+        Paths crossing a down link are left out.  If every path through
+        the lowest layer joining src and dst is down, higher layers are
+        tried.
         '''
 
         if src == dst:
-          return [src]
+            return [[src]]
 
         self.src_paths = {src: [[src]]}
         self.dst_paths = {dst: [[dst]]}
@@ -242,10 +276,32 @@ class StructuredRouting(Routing):
         for depth in range(lowest_starting_layer - 1, -1, -1):
             lg.info('-------------------------------------------')
             paths_found = self._extend_reachable(depth)
-            if paths_found:
-                path_choice = self.path_choice(paths_found, src, dst, hash_)
-                lg.info('path_choice = %s' % path_choice)
-                return path_choice
+            # Frontiers that already met carry on up, so deeper paths may
+            # turn back on themselves; those are no detour.
+            paths_found = [p for p in paths_found if len(set(p)) == len(p)]
+            live = self._live_paths(paths_found)
+            if live:
+                return live
+        return []
+
+    def get_route(self, src, dst, hash_):
+        '''Return flow path.
+
+        @param src source dpid (for host or switch)
+        @param dst destination dpid (for host or switch)
+        @param hash_ hash value
+
+        @return flow_path list of DPIDs to traverse (including inputs), or None
+        '''
+
+        if src == dst:
+          return [src]
+
+        paths_found = self.get_routes(src, dst)
+        if paths_found:
+            path_choice = self.path_choice(paths_found, src, dst, hash_)
+            lg.info('path_choice = %s' % path_choice)
+            return path_choice
         return None
 
 # Disable unused argument warnings in the classes below
@@ -318,6 +374,77 @@ class HashedStructuredRouting(StructuredRouting):
             return path
 
         super(HashedStructuredRouting, self).__init__(topo, choose_hashed)
+
+
+class LoadAwareStructuredRouting(StructuredRouting):
+    '''Least-loaded Structured Routing.
+
+    Chooses the path whose busiest link carries the least traffic, using
+    per-link load estimates fed in by the controller.  Links without a
+    fresh estimate count as idle; ties are broken by the hash value, so
+    flows still spread across equally loaded paths.
+    '''
+
+    def __init__(self, topo, stale_after=None):
+        '''Create StructuredRouting object.
+
+        @param topo Topo object
+        @param stale_after seconds after which a load estimate is ignored;
+            None to keep estimates forever
+        '''
+        self.stale_after = stale_after
+        self.link_loads = {}  # [(node1, node2)] -> (load, timestamp)
+
+        def choose_least_loaded(paths, src, dst, hash_):
+            '''Choose path with the smallest bottleneck load
+
+            @param path paths of dpids generated by a routing engine
+            @param src src dpid
+            @param dst dst dpid
+            @param hash_ hash value
+            '''
+            now = time()
+            costs = {}
+            for path in paths:
+                costs[tuple(path)] = self.path_load(path, now)
+            best = min(costs.itervalues())
+            candidates = sorted(p for p in paths if costs[tuple(p)] == best)
+            return candidates[hash_ % len(candidates)]
+
+        super(LoadAwareStructuredRouting, self).__init__(topo,
+                                                         choose_least_loaded)
+
+    def set_link_load(self, src, dst, load, now=None):
+        '''Record the load of the directed link src -> dst.
+
+        @param src node name at the sending end
+        @param dst node name at the receiving end
+        @param load load estimate (e.g. bytes/sec)
+        @param now timestamp of the estimate; defaults to current time
+        '''
+        if now is None:
+            now = time()
+        self.link_loads[(src, dst)] = (load, now)
+
+    def link_load(self, src, dst, now=None):
+        '''Return the current load estimate of src -> dst, or 0 if unknown.'''
+        entry = self.link_loads.get((src, dst))
+        if entry is None:
+            return 0
+        load, stamp = entry
+        if self.stale_after is not None:
+            if now is None:
+                now = time()
+            if now - stamp > self.stale_after:
+                return 0
+        return load
+
+    def path_load(self, path, now=None):
+        '''Return the load of the busiest link along path.'''
+        if now is None:
+            now = time()
+        loads = [self.link_load(a, b, now) for a, b in zip(path[:-1], path[1:])]
+        return max(loads) if loads else 0
 # pylint: enable-msg=W0613
 
 
@@ -425,18 +552,24 @@ class DCRouting(Routing):
                     multi_path.append(path1 + [intermediate] + path2)
         return multi_path
 
+    def get_routes(self, src, dst):
+        '''Return all shortest flow paths, empty if src and dst are not connected.'''
+        if src == dst:
+            return [[src]]
+        raw_paths_found = self._get_multi_raw_path(src, dst)
+        if raw_paths_found is None:
+            return []
+        return self._live_paths([[src] + p + [dst] for p in raw_paths_found])
+
     def get_route(self, src, dst, hash_):
         # Start with a raw path...
         if src == dst:
             path = [src]
             return path
         else:
-            raw_paths_found = self._get_multi_raw_path(src, dst)
-            if raw_paths_found is None:
+            paths_found = self.get_routes(src, dst)
+            if not paths_found:
                 return None
-            paths_found = []
-            for p in raw_paths_found:
-                paths_found.append([src] + p + [dst])
 
             path_chosen = self.path_choice(paths_found, src, dst, hash_)
 
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+'''Test routing engines.'''
+
+import unittest
+
+from ripl.dctopo import FatTreeTopo, StructuredTopo
+from ripl.routing import HashedStructuredRouting, LoadAwareStructuredRouting
+
+
+class testLoadAwareStructuredRouting(unittest.TestCase):
+    '''Test LoadAwareStructuredRouting on a k=4 FatTreeTopo.'''
+
+    def setUp(self):
+        self.topo = FatTreeTopo(4, 1)
+        edges = sorted(self.topo.layer_nodes(FatTreeTopo.LAYER_EDGE))
+        # First and last edge switch sit in different pods.
+        self.src = edges[0]
+        self.dst = edges[-1]
+
+    def testIdleMatchesHashed(self):
+        '''Without load estimates, choose the same path as hashed routing.'''
+        load = LoadAwareStructuredRouting(self.topo)
+        hashed = HashedStructuredRouting(self.topo)
+        for hash_ in xrange(8):
+            self.assertEqual(load.get_route(self.src, self.dst, hash_),
+                             hashed.get_route(self.src, self.dst, hash_))
+
+    def testAvoidsLoadedLink(self):
+        '''Never pick a path crossing the only loaded link.'''
+        r = LoadAwareStructuredRouting(self.topo)
+        route = r.get_route(self.src, self.dst, 0)
+        r.set_link_load(route[1], route[2], 1e9)
+        for hash_ in xrange(8):
+            new_route = r.get_route(self.src, self.dst, hash_)
+            self.assertNotEqual(new_route[1:3], route[1:3])
+
+    def testStaleLoadIgnored(self):
+        '''Estimates older than stale_after count as idle.'''
+        r = LoadAwareStructuredRouting(self.topo, stale_after=5)
+        r.set_link_load('a', 'b', 100, now=0)
+        self.assertEqual(r.link_load('a', 'b', now=1), 100)
+        self.assertEqual(r.link_load('a', 'b', now=10), 0)
+
+
+
+class testDownLinks(unittest.TestCase):
+    '''Test that routing engines avoid links marked down.'''
+
+    def testRoutesAvoidDownLink(self):
+        '''No route crosses a down link; bringing it up restores it.'''
+        topo = FatTreeTopo(4, 1)
+        edges = sorted(topo.layer_nodes(FatTreeTopo.LAYER_EDGE))
+        r = HashedStructuredRouting(topo)
+        all_routes = r.get_routes(edges[0], edges[-1])
+        a, b = all_routes[0][1], all_routes[0][2]
+        r.set_link_down(b, a)
+        routes = r.get_routes(edges[0], edges[-1])
+        self.assertTrue(routes)
+        for route in routes:
+            self.assertFalse((a, b) in zip(route[:-1], route[1:]))
+        for hash_ in xrange(8):
+            route = r.get_route(edges[0], edges[-1], hash_)
+            self.assertFalse((a, b) in zip(route[:-1], route[1:]))
+        r.set_link_up(a, b)
+        self.assertEqual(r.get_routes(edges[0], edges[-1]), all_routes)
+
+
+class DetourTopo(StructuredTopo):
+    '''Edges e1 and e2 share aggregation a1; e2 also hangs off a2, and
+    core c joins a1 and a2.'''
+
+    def __init__(self):
+        StructuredTopo.__init__(self, [], [])
+        for name, layer in (('c', 0), ('a1', 1), ('a2', 1), ('e1', 2),
+                            ('e2', 2)):
+            self.addSwitch(name, **self.def_nopts(layer))
+        for a, b in (('c', 'a1'), ('c', 'a2'), ('a1', 'e1'), ('a1', 'e2'),
+                     ('a2', 'e2')):
+            self.addLink(a, b)
+
+
+class testDeeperRoutes(unittest.TestCase):
+    '''When every shortest path is down, longer ones are searched.'''
+
+    def testThroughCore(self):
+        r = HashedStructuredRouting(DetourTopo())
+        self.assertEqual(r.get_routes('e1', 'e2'), [['e1', 'a1', 'e2']])
+        r.set_link_down('a1', 'e2')
+        detour = ['e1', 'a1', 'c', 'a2', 'e2']
+        self.assertEqual(r.get_routes('e1', 'e2'), [detour])
+        self.assertEqual(r.get_route('e1', 'e2', 0), detour)
+        self.assertEqual(r.get_route('e2', 'e1', 0), detour[::-1])
+        r.set_link_up('a1', 'e2')
+        self.assertEqual(r.get_routes('e1', 'e2'), [['e1', 'a1', 'e2']])
+
+    def testNoLoops(self):
+        '''Going up and back down the same links is no detour.'''
+        topo = FatTreeTopo(4, 1)
+        r = HashedStructuredRouting(topo)
+        edges = sorted(topo.layer_nodes(FatTreeTopo.LAYER_EDGE))
+        src = edges[0]
+        dst = [e for e in edges[1:] if set(topo.up_nodes(e)) ==
+               set(topo.up_nodes(src))][0]
+        agg1, agg2 = sorted(topo.up_nodes(src))
+        r.set_link_down(src, agg1)
+        self.assertEqual(r.get_routes(src, dst), [[src, agg2, dst]])
+        r.set_link_down(agg2, dst)
+        self.assertEqual(r.get_routes(src, dst), [])
+        self.assertEqual(r.get_route(src, dst, 0), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+'''Report how far destination-based switch tables compress.
+
+Builds the {host IP: out_port} table each switch would need to forward
+toward every host (as in hybrid mode) and compresses it into prefix
+rules.  Each compressed table is checked against the original before
+the rule counts are printed:
+
+  python compress_tables.py --topo ft,8 --routing hashed
+  python compress_tables.py --topo ft,4 --dont_care
+
+With --dont_care, addresses that belong to no host may be forwarded
+anywhere.  That gives smaller tables for switches with a small TCAM.
+'''
+
+from optparse import OptionParser
+
+from ripl.mn import topos
+from riplpox.util import buildTopo, getRouting
+from riplpox.compress import forwarding_tables, report
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--topo', dest='topo', default='ft,4',
+                      help='topology, as passed to RipL-POX')
+    parser.add_option('--routing', dest='routing', default='hashed',
+                      help='routing, as passed to RipL-POX')
+    parser.add_option('--dont_care', dest='dont_care', action='store_true',
+                      default=False,
+                      help='let addresses of no host match any rule')
+    options, args = parser.parse_args()
+
+    topo = buildTopo(options.topo, topos)
+    routing = getRouting(options.routing, topo)
+    counts = report(forwarding_tables(topo, routing), options.dont_care)
+    for sw, before, after in counts:
+        print '%-8s %6i -> %6i' % (sw, before, after)
+    before = sum(c[1] for c in counts)
+    after = sum(c[2] for c in counts)
+    print 'total    %6i -> %6i (%.0f%%)' % (before, after,
+                                            100.0 * after / before)
+
+
+if __name__ == '__main__':
+    main()
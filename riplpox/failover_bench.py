@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''Measure data-plane recovery time after a link failure.
+
+Start RipL-POX in reactive mode first, once plain and once with --backup,
+then run this script against it with the same topology:
+
+  ~/pox/pox.py riplpox.riplpox --topo=ft,4 --routing=hashed --mode=reactive
+  sudo python failover_bench.py --topo ft,4
+
+The first host pings the last one every --interval seconds while each
+uplink of its edge switch fails in turn.  The longest run of lost replies
+per failure approximates how long traffic was blackholed.  The controller
+logs its own view of each failover (see RipLController.failover_times).
+'''
+
+from optparse import OptionParser
+from time import sleep
+import re
+
+from mininet.net import Mininet
+from mininet.node import RemoteController
+from mininet.log import setLogLevel, info
+
+from ripl.mn import topos
+from riplpox.util import buildTopo
+
+
+def longest_gap(output):
+    "Return the longest run of missing icmp_seq numbers in ping output."
+    seqs = sorted(int(s) for s in re.findall(r'icmp_seq=(\d+)', output))
+    gap = 0
+    for a, b in zip(seqs[:-1], seqs[1:]):
+        gap = max(gap, b - a - 1)
+    return gap
+
+
+def bench(topo, interval, settle, duration):
+    '''Fail each uplink of the first host's edge switch in turn.
+
+    @param topo topology, as for RipL-POX
+    @param interval seconds between pings
+    @param settle seconds to ping before failing the link
+    @param duration seconds to ping in total per failure
+    @return list of (edge, uplink, seconds without replies)
+    '''
+    net = Mininet(topo=topo, controller=RemoteController, autoSetMacs=True)
+    net.start()
+    hosts = topo.hosts()
+    src, dst = net.get(hosts[0]), net.get(hosts[-1])
+    edge = topo.g[hosts[0]].keys()[0]
+    uplinks = [n for n in topo.g[edge] if n not in hosts]
+    results = []
+    try:
+        src.cmd('ping -c 3 %s' % dst.IP())  # Warm ARP and reactive paths
+        for uplink in uplinks:
+            count = int(duration / interval)
+            proc = src.popen('ping -i %s -c %i %s' %
+                             (interval, count, dst.IP()))
+            sleep(settle)
+            net.configLinkStatus(edge, uplink, 'down')
+            out, err = proc.communicate()
+            net.configLinkStatus(edge, uplink, 'up')
+            results.append((edge, uplink, longest_gap(out) * interval))
+            sleep(settle)
+    finally:
+        net.stop()
+    return results
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--topo', dest='topo', default='ft,4',
+                      help='topology, as passed to RipL-POX')
+    parser.add_option('--interval', dest='interval', type='float',
+                      default=0.01, help='seconds between pings')
+    parser.add_option('--settle', dest='settle', type='float', default=2,
+                      help='seconds of pinging before each failure')
+    parser.add_option('--duration', dest='duration', type='float',
+                      default=6, help='seconds of pinging per failure')
+    options, args = parser.parse_args()
+
+    setLogLevel('info')
+    topo = buildTopo(options.topo, topos)
+    for edge, uplink, lost in bench(topo, options.interval, options.settle,
+                                    options.duration):
+        info('%s-%s down: %.0f ms without replies\n' %
+             (edge, uplink, lost * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,17 @@
 """
 RipL+POX.  As simple a data center controller as possible.
+
+This one drives the HP E3800 testbed (TestBedTopo).  The port joining each
+pair of switches comes from openflow.discovery, not from a table in the
+code.  Discovered ports are saved to a cache file, keyed by DPID, so that
+a restart can route from the cached ports right away.  Once every switch
+is up and discovery has had a full cycle, the cache is checked against
+what LLDP found, and links it didn't confirm are dropped.
 """
 
+import json
 import logging
+import os
 import random
 from struct import pack
 from zlib import crc32
@@ -14,6 +23,8 @@ from pox.core import core
 import pox.openflow.libopenflow_01 as of
 from pox.lib.revent import EventMixin
 from pox.lib.addresses import EthAddr
+from pox.lib.recoco import Timer
+from pox.lib.util import dpid_to_str, str_to_dpid
 from pox.lib.packet.ipv4 import ipv4
 from pox.lib.packet.udp import udp
 from pox.lib.packet.tcp import tcp
@@ -33,6 +44,13 @@ DEF_MODE = MODES[0]
 IDLE_TIMEOUT = 20
 HARD_TIMEOUT = 60
 
+# Where discovered switch ports are kept between restarts
+DEF_PORT_CACHE = 'testbed_ports.json'
+
+# Switch names by the digit _dpidToStr() picks out of a DPID
+SWITCH_NAMES = {1: 'sc1', 2: 'sc2', 3: 'sa3', 4: 'sa4', 5: 'se5', 6: 'se6',
+                7: 'sa7', 8: 'sa8', 9: 'se9', 0: 'se10'}
+
 # Borrowed from pox/forwarding/l2_multi
 
 
@@ -99,28 +117,132 @@ class Switch(object):
 
 
 class TestBedController(object):
-    def __init__(self, t, r, mode):
+    def __init__(self, t, r, mode, port_cache=None):
         self.switches = {}  # Switches seen: [dpid] -> Switch
         self.t = t  # Master Topo object, passed in and never modified.
         self.r = r  # Master Routing object, passed in and reused.
         self.mode = mode  # One in MODES.
         self.macTable = {}  # [mac] -> (dpid, port)
-        self.portsMap = {
-            'sc1': {'sa3': (41, 33), 'sa4': (43, 29), 'sa7': (42, 17), 'sa8': (44, 13)},
-            'sc2': {'sa3': (37, 35), 'sa4': (39, 31), 'sa7': (38, 19), 'sa8': (40, 15)},
-            'sa3': {'sc1': (33, 41), 'sc2': (35, 37), 'se5': (34, 27), 'se6': (36, 21)},
-            'sa4': {'sc1': (29, 43), 'sc2': (31, 39), 'se5': (30, 26), 'se6': (32, 23)},
-            'se5': {'sa3': (27, 34), 'sa4': (26, 30)},
-            'se6': {'sa3': (21, 36), 'sa4': (23, 32)},
-            'sa7': {'sc1': (17, 42), 'sc2': (19, 38), 'se9': (18, 9), 'se10': (20, 7)},
-            'sa8': {'sc1': (13, 44), 'sc2': (15, 40), 'se9': (16, 11), 'se10': (14, 6)},
-            'se9': {'sa7': (9, 18), 'sa8': (11, 16)},
-            'se10': {'sa7': (7, 20), 'sa8': (6, 14)}
-            }
+
+        # [(dpid, neighbor dpid)] -> (port, neighbor's port), for links
+        # discovered or cached.  portsMap holds the same by switch name.
+        self.links = {}
+        self.portsMap = defaultdict(dict)
+        self.port_cache = port_cache  # File name, or None to not cache
+        self.verified = False  # Has discovery checked the cached links?
+        self.discovered = set()  # Links LLDP has confirmed, as keys above
+        for key, ports in self._load_port_cache().iteritems():
+            self._set_link(key, ports)
 
         # TODO: generalize all_switches_up to a more general state machine.
         self.all_switches_up = False  # Sequences event handling.
         core.openflow.addListeners(self, priority=0)
+        core.call_when_ready(self._listen_to_discovery, "openflow_discovery")
+
+    def _listen_to_discovery(self):
+        core.openflow_discovery.addListenerByName("LinkEvent",
+                                                  self._handle_LinkEvent)
+
+    def _load_port_cache(self):
+        "Return the links in the port cache, as self.links."
+        if not self.port_cache or not os.path.exists(self.port_cache):
+            return {}
+        try:
+            f = open(self.port_cache)
+            try:
+                cache = json.load(f)
+            finally:
+                f.close()
+            links = {}
+            for dpid1, neighbors in cache.iteritems():
+                for dpid2, (port1, port2) in neighbors.iteritems():
+                    key = (str_to_dpid(dpid1), str_to_dpid(dpid2))
+                    links[key] = (port1, port2)
+        except (IOError, ValueError, TypeError, AttributeError) as e:
+            log.warn("Ignoring unreadable port cache %s: %s" %
+                     (self.port_cache, e))
+            return {}
+        log.info("Loaded %i links from port cache %s" %
+                 (len(links), self.port_cache))
+        return links
+
+    def _save_port_cache(self):
+        if not self.port_cache:
+            return
+        cache = {}
+        for (dpid1, dpid2), ports in self.links.iteritems():
+            cache.setdefault(dpid_to_str(dpid1), {})[dpid_to_str(dpid2)] = \
+                ports
+        # Write it whole, then move it into place, so a restart never
+        # sees half a file.
+        tmp = self.port_cache + '.tmp'
+        try:
+            f = open(tmp, 'w')
+            try:
+                json.dump(cache, f, sort_keys=True, indent=2)
+            finally:
+                f.close()
+            os.rename(tmp, self.port_cache)
+        except (IOError, OSError) as e:
+            log.warn("Couldn't write port cache %s: %s" % (self.port_cache, e))
+
+    def _set_link(self, key, ports):
+        "Use ports for the link from key[0] to key[1]; False if unknown."
+        try:
+            name1, name2 = [self._dpidToStr(dpid) for dpid in key]
+        except (ValueError, KeyError):
+            log.warn("Ignoring link between unknown switches %s and %s" %
+                     tuple(dpid_to_str(dpid) for dpid in key))
+            return False
+        if name2 not in self.t.g[name1]:
+            log.warn("Link %s.%i -> %s.%i is not in the topology" %
+                     (name1, ports[0], name2, ports[1]))
+        self.links[key] = ports
+        self.portsMap[name1][name2] = ports
+        return True
+
+    def _drop_link(self, key):
+        if self.links.pop(key, None) is None:
+            return
+        name1, name2 = [self._dpidToStr(dpid) for dpid in key]
+        del self.portsMap[name1][name2]
+
+    def _handle_LinkEvent(self, event):
+        link = event.link
+        key = (link.dpid1, link.dpid2)
+        if event.added:
+            ports = (link.port1, link.port2)
+            old = self.links.get(key)
+            if old == ports:
+                self.discovered.add(key)
+                return
+            if not self._set_link(key, ports):
+                return
+            self.discovered.add(key)
+            if old is not None:
+                log.warn("Link %s -> %s moved from ports %s to %s" %
+                         (dpid_to_str(key[0]), dpid_to_str(key[1]), old,
+                          ports))
+        else:
+            self.discovered.discard(key)
+            if key not in self.links:
+                return
+            self._drop_link(key)
+        if self.verified:
+            self._save_port_cache()
+
+    def _verify_ports(self):
+        "Drop cached links discovery didn't find, and save the rest."
+        stale = [key for key in self.links if key not in self.discovered]
+        for key in stale:
+            log.warn("Cached link %s.%i -> %s.%i not seen by discovery" %
+                     (dpid_to_str(key[0]), self.links[key][0],
+                      dpid_to_str(key[1]), self.links[key][1]))
+            self._drop_link(key)
+        log.info("Port map verified: %i links, %i stale cached links "
+                 "dropped" % (len(self.links), len(stale)))
+        self.verified = True
+        self._save_port_cache()
 
     def _ecmp_hash(self, packet):
         "Return an ECMP-style 5-tuple hash for TCP/IP packets, otherwise 0."
@@ -149,6 +271,11 @@ class TestBedController(object):
         match = of.ofp_match()
         match.dl_src = packet.src
         match.dl_dst = packet.dst
+        for node, next_node in zip(route, route[1:]):
+            if self._getports(node, next_node) is None:
+                log.debug("No port known from %s to %s; flooding" %
+                          (node, next_node))
+                return False
         for i, node in enumerate(route):
             if i < len(route) - 1:
                 next_node = route[i + 1]
@@ -158,16 +285,19 @@ class TestBedController(object):
                 # print final_out_port
                 out_port = final_out_port
             self.switches[node].install(out_port, match, idle_timeout=IDLE_TIMEOUT, hard_timeout=HARD_TIMEOUT)
+        return True
 
     def _getports(self, node1, node2):
-        return self.portsMap[node1][node2]
+        "Return (port on node1, port on node2) joining them, or None."
+        return self.portsMap[node1].get(node2)
 
     def _connToStr(self, conn_name):
+        return self._dpidToStr(conn_name.dpid)
+
+    def _dpidToStr(self, dpid):
+        # Named by the same character of str(connection) as always:
         # [f0-92-1c-22-ca-c0|24 2]
-        conn2name = {1: 'sc1', 2: 'sc2', 3: 'sa3', 4: 'sa4', 5: 'se5', 6: 'se6',
-                     7: 'sa7', 8: 'sa8', 9: 'se9', 0: 'se10'}
-        # print str(conn_name)
-        return conn2name[int(str(conn_name)[20:21])]
+        return SWITCH_NAMES[int(('[%s ' % dpid_to_str(dpid))[20:21])]
 
     def _drop(self, event):
         # Kill the buffer
@@ -222,10 +352,13 @@ class TestBedController(object):
 
             out_sw_str, out_port = self.macTable[packet.dst]
             # log.info("%s-->%s" % (src_h_name, dst_h_name))
-            self._install_reactive_path(event, out_sw_str, out_port, packet)
-
-            # log.info("sending to entry in mactable: %s %s" % (out_dpid, out_port))
-            self.switches[out_sw_str].send_packet_data(out_port, event.data)
+            if self._install_reactive_path(event, out_sw_str, out_port,
+                                           packet):
+                # log.info("sending to entry in mactable: %s %s" % (out_dpid, out_port))
+                self.switches[out_sw_str].send_packet_data(out_port,
+                                                           event.data)
+            else:
+                self._flood(event)
 
         else:
             self._flood(event)
@@ -259,9 +392,28 @@ class TestBedController(object):
         if len(self.switches) == len(self.t.switches()):
             log.info("Woo!  All switches up")
             self.all_switches_up = True
+            self._start_verify()
+
+    def _start_verify(self):
+        "Check the port map once discovery has had a full cycle."
+        if self.verified:
+            return
+        if not core.hasComponent("openflow_discovery"):
+            log.warn("openflow.discovery isn't running; the port map is "
+                     "only what was cached")
+            return
+        Timer(core.openflow_discovery.send_cycle_time + 1,
+              self._verify_ports)
+
 
+def launch(topo=None, routing=None, mode=None, port_cache=DEF_PORT_CACHE):
+    """
+    Launch the testbed controller
 
-def launch(topo=None, routing=None, mode=None):
+    port_cache is the file discovered switch ports are kept in between
+    restarts; give it empty to not keep them.  openflow.discovery is
+    started too, unless it is already running.
+    """
 
     if not mode:
         mode = DEF_MODE
@@ -271,6 +423,9 @@ def launch(topo=None, routing=None, mode=None):
     else:
         t = buildTopo(topo, topos)
         r = getRouting(routing, t)
-    core.registerNew(TestBedController, t, r, mode)
+    if not core.hasComponent("openflow_discovery"):
+        import pox.openflow.discovery
+        pox.openflow.discovery.launch()
+    core.registerNew(TestBedController, t, r, mode, port_cache or None)
 
     log.info("TestBedController running with topo=%s." % topo)
@@ -0,0 +1,183 @@
+"""
+Forwarding table compression for RipL-POX.
+
+A switch that forwards on destination IP needs one exact entry per host,
+but many hosts share an output port.  compress() turns a table of
+{host IP: out_port} into the fewest prefix rules that forward every
+address the same way under longest-prefix match.  It uses ORTC (Draves
+et al., "Constructing Optimal IP Routing Tables", INFOCOM 1999), which is
+optimal for prefix tables.  Topology hosts are numbered hierarchically
+(10.layer.id for FatTreeTopo and BCubeTopo), so hosts behind the same
+downstream switch tend to share prefixes.
+
+Rules are (network, prefix length, out_port) and must be installed with
+priorities increasing with prefix length.  An out_port of None means
+"as if no entry matched", for regions inside a broader rule that the
+original table doesn't forward; install those as output to the
+controller.  With dont_care=True, addresses not in the table may be
+forwarded anywhere, which usually gives fewer rules.
+
+verify() checks a compressed table against the original over every
+address, and report() gives before/after rule counts per switch.
+"""
+
+from collections import defaultdict
+
+from pox.lib.addresses import IPAddr
+
+ADDR_BITS = 32
+
+# Set of out_ports meaning "any will do", for don't-care regions
+ANY = 'any'
+
+
+def _intersect_or_union(a, b):
+    if a is ANY:
+        return b
+    if b is ANY:
+        return a
+    return (a & b) or (a | b)
+
+
+class _Node(object):
+    __slots__ = ('net', 'bits', 'hops', 'children')
+
+    def __init__(self, net, bits, hops, children=None):
+        self.net = net
+        self.bits = bits
+        self.hops = hops  # Set of out_ports this node may forward to
+        self.children = children  # (zero child, one child) or None
+
+
+def _build(entries, net, bits, empty):
+    "Build the ORTC trie over sorted (addr, port) entries inside net/bits."
+    if not entries:
+        return _Node(net, bits, empty)
+    size = 1 << (ADDR_BITS - bits)
+    ports = set(port for addr, port in entries)
+    if len(ports) == 1 and (len(entries) == size or empty is ANY):
+        return _Node(net, bits, frozenset(ports))
+    half = size >> 1
+    split = 0
+    while split < len(entries) and entries[split][0] < net + half:
+        split += 1
+    zero = _build(entries[:split], net, bits + 1, empty)
+    one = _build(entries[split:], net + half, bits + 1, empty)
+    return _Node(net, bits, _intersect_or_union(zero.hops, one.hops),
+                 (zero, one))
+
+
+def _emit(node, inherited, rules):
+    "Top-down ORTC pass: add a rule wherever inheriting would be wrong."
+    hops = node.hops
+    if hops is ANY or inherited in hops:
+        hop = inherited
+    else:
+        hop = sorted(hops)[0]
+        rules.append((node.net, node.bits, hop))
+    if node.children is not None:
+        for child in node.children:
+            _emit(child, hop, rules)
+
+
+def compress(table, dont_care=False):
+    """Return the fewest prefix rules equivalent to table.
+
+    table maps addresses (unsigned ints) to out_ports.  Addresses not in
+    it are misses, or don't-cares if dont_care.
+    """
+    entries = sorted(table.iteritems())
+    empty = ANY if dont_care else frozenset([None])
+    root = _build(entries, 0, 0, empty)
+    rules = []
+    _emit(root, None, rules)
+    return rules
+
+
+def verify(table, rules, dont_care=False):
+    """Return the addresses rules forward differently than table does.
+
+    Every region of the address space in which neither table changes
+    behavior is checked once, so the check is exhaustive.
+    """
+    by_len = defaultdict(dict)  # [prefix length] -> {network: out_port}
+    for net, bits, port in rules:
+        by_len[bits][net] = port
+    lengths = sorted(by_len, reverse=True)
+
+    def forward(addr):
+        for bits in lengths:
+            shift = ADDR_BITS - bits
+            port = by_len[bits].get(addr >> shift << shift, ANY)
+            if port is not ANY:
+                return port
+        return None
+
+    # Every prefix along the way to a table address or rule.
+    nodes = set()
+    for net, bits in [(a, ADDR_BITS) for a in table] + \
+            [(n, b) for n, b, p in rules]:
+        for b in xrange(bits + 1):
+            shift = ADDR_BITS - b
+            nodes.add((net >> shift << shift, b))
+    samples = set(table)
+    for net, bits in nodes:
+        if bits == ADDR_BITS:
+            samples.add(net)
+            continue
+        half = 1 << (ADDR_BITS - bits - 1)
+        for child in (net, net + half):
+            if (child, bits + 1) not in nodes:
+                samples.add(child)  # Uniform region; any address will do
+    wrong = []
+    for addr in sorted(samples):
+        if addr not in table and dont_care:
+            continue
+        if forward(addr) != table.get(addr):
+            wrong.append(addr)
+    return wrong
+
+
+def forwarding_tables(t, r):
+    """Return [switch name] -> {host IP: out_port} for every switch.
+
+    These are the tables RipL-POX's hybrid mode installs.  Edge switches
+    forward only to their own hosts; every other switch forwards toward
+    a destination host's edge switch along r.get_route(switch, edge,
+    edge dpid).
+    """
+    edge_hosts = defaultdict(list)
+    for h in t.hosts():
+        edge_hosts[t.g[h].keys()[0]].append(h)
+    tables = defaultdict(dict)
+    for edge, hosts in edge_hosts.iteritems():
+        edge_dpid = t.id_gen(name=edge).dpid
+        addrs = [IPAddr(t.id_gen(name=h).ip_str()).toUnsigned()
+                 for h in hosts]
+        for h, addr in zip(hosts, addrs):
+            tables[edge][addr] = t.port(edge, h)[0]
+        for node in t.switches():
+            if node in edge_hosts:
+                continue
+            route = r.get_route(node, edge, edge_dpid)
+            if not route:
+                continue
+            out_port = t.port(node, route[1])[0]
+            for addr in addrs:
+                tables[node][addr] = out_port
+    return tables
+
+
+def report(tables, dont_care=False):
+    """Compress and verify tables; return [(switch, before, after)].
+
+    Raises AssertionError if any compressed table is not equivalent.
+    """
+    counts = []
+    for sw in sorted(tables):
+        table = tables[sw]
+        rules = compress(table, dont_care)
+        wrong = verify(table, rules, dont_care)
+        assert not wrong, "%s: %i addresses misforwarded" % (sw, len(wrong))
+        counts.append((sw, len(table), len(rules)))
+    return counts
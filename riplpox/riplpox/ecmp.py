@@ -0,0 +1,121 @@
+"""
+ECMP hashes and path choices for RipL-POX, per flow or in batches.
+
+ecmp_hash() and src_dst_hash() are the reference: zlib.crc32 of the
+packed fields.  The batch versions compute the same CRC-32 over many
+flows at once with NumPy, one table lookup per byte column, and return
+identical values.  Without NumPy they call the reference once per flow.
+
+assign_paths() turns a batch of hashes into routes.  Hashed routing
+picks sorted(paths)[hash % len(paths)], so candidate paths are computed
+once per switch pair instead of once per flow.  Other routing engines
+choose by load or at random; they get one get_route() call per flow.
+"""
+
+from collections import defaultdict
+from struct import pack, calcsize
+from zlib import crc32
+
+from ripl.routing import HashedStructuredRouting
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Packed layouts; native, as struct.pack uses them
+ECMP_FORMAT = 'LLHHH'  # src IP, dst IP, IP protocol, src port, dst port
+SRC_DST_FORMAT = 'QQ'  # src dpid, dst dpid
+
+
+def ecmp_hash(src_ip, dst_ip, proto, sport, dport):
+    "Return the 5-tuple hash of one flow."
+    return crc32(pack(ECMP_FORMAT, src_ip, dst_ip, proto, sport, dport))
+
+
+def src_dst_hash(src, dst):
+    "Return the hash of a (src dpid, dst dpid) pair."
+    return crc32(pack(SRC_DST_FORMAT, src, dst))
+
+
+def _crc_table():
+    table = numpy.zeros(256, numpy.uint32)
+    for i in xrange(256):
+        c = i
+        for _ in xrange(8):
+            c = (c >> 1) ^ 0xedb88320 if c & 1 else c >> 1
+        table[i] = c
+    return table
+
+_CRC_TABLE = _crc_table() if numpy is not None else None
+
+
+def _crc32_rows(rows):
+    "Return zlib.crc32 (signed, as Python 2 has it) of each row of bytes."
+    crc = numpy.empty(len(rows), numpy.uint32)
+    crc.fill(0xffffffff)
+    for column in rows.T:
+        crc = _CRC_TABLE[(crc ^ column) & 0xff] ^ (crc >> 8)
+    crc ^= 0xffffffff
+    return crc.view(numpy.int32).astype(numpy.int64)
+
+
+def _packed_rows(fmt, columns):
+    "Return an array of one struct.pack(fmt, ...) per row, as bytes."
+    dtype = numpy.dtype([('f%i' % i, '=' + numpy.dtype(c).str[1:])
+                         for i, c in enumerate(fmt)])
+    assert dtype.itemsize == calcsize(fmt)
+    packed = numpy.empty(len(columns[0]), dtype)
+    for i, column in enumerate(columns):
+        packed['f%i' % i] = column
+    return packed.view(numpy.uint8).reshape(len(packed), dtype.itemsize)
+
+
+def ecmp_hashes(src_ips, dst_ips, protos, sports, dports):
+    "Return ecmp_hash() of every flow, given one sequence per field."
+    if numpy is None or not len(src_ips):
+        return [ecmp_hash(*f)
+                for f in zip(src_ips, dst_ips, protos, sports, dports)]
+    rows = _packed_rows(ECMP_FORMAT, (src_ips, dst_ips, protos, sports,
+                                      dports))
+    return _crc32_rows(rows).tolist()
+
+
+def src_dst_hashes(srcs, dsts):
+    "Return src_dst_hash() of every (srcs[i], dsts[i]) pair."
+    if numpy is None or not len(srcs):
+        return [src_dst_hash(s, d) for s, d in zip(srcs, dsts)]
+    return _crc32_rows(_packed_rows(SRC_DST_FORMAT, (srcs, dsts))).tolist()
+
+
+def path_indices(hashes, n_paths):
+    "Return hash % n_paths for every hash, as hashed routing chooses."
+    if numpy is None:
+        return [h % n_paths for h in hashes]
+    return (numpy.asarray(hashes, numpy.int64) % n_paths).tolist()
+
+
+def assign_paths(r, pairs, hashes):
+    """Return r.get_route(src, dst, hash) for every (src, dst) pair.
+
+    Flows between the same pair of switches may share one route list;
+    don't modify them.
+    """
+    if not isinstance(r, HashedStructuredRouting):
+        return [r.get_route(src, dst, h) for (src, dst), h in
+                zip(pairs, hashes)]
+    flows = defaultdict(list)  # [(src, dst)] -> indices into pairs
+    for i, pair in enumerate(pairs):
+        flows[pair].append(i)
+    routes = [None] * len(pairs)
+    for (src, dst), indices in flows.iteritems():
+        if src == dst:
+            paths = [[src]]
+        else:
+            paths = sorted(r.get_routes(src, dst))
+        if not paths:
+            continue
+        choices = path_indices([hashes[i] for i in indices], len(paths))
+        for i, choice in zip(indices, choices):
+            routes[i] = paths[choice]
+    return routes
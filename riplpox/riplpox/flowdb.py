@@ -0,0 +1,122 @@
+"""
+Controller-side record of the flow entries installed on each switch.
+
+Every flow_mod RipL-POX sends is mirrored into the sending switch's
+SwitchTable, and entries are installed with OFPFF_SEND_FLOW_REM so the
+switch reports when one goes away.  After a (re)connect one flow stats
+dump replaces the table wholesale, so entries added or lost while the
+controller wasn't listening are accounted for.
+
+pox.openflow.flow_table.FlowTable scans a list for every lookup; here
+entries are keyed by (packed match, priority) and indexed by output port,
+so both lookups are O(1).
+"""
+
+from collections import defaultdict
+
+from pox.openflow.flow_table import TableEntry
+import pox.openflow.libopenflow_01 as of
+
+
+def entry_key(match, priority=of.OFP_DEFAULT_PRIORITY):
+    "Return the key identifying an entry, as OFPFC_*_STRICT would."
+    return (match.pack(), priority)
+
+
+def _out_ports(actions):
+    return set(a.port for a in actions
+               if isinstance(a, of.ofp_action_output))
+
+
+class SwitchTable(object):
+    "Flow entries on one switch, indexed by match and by output port."
+
+    def __init__(self):
+        self.entries = {}  # [entry_key] -> TableEntry
+        self.by_port = defaultdict(set)  # [out_port] -> set of entry_keys
+        self.peak = 0  # Most entries held at once
+        self.stats = {'added': 0, 'removed': 0, 'reconciled': 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        "Record an entry, replacing any with the same match and priority."
+        key = entry_key(entry.match, entry.priority)
+        self._unindex(key)
+        self.entries[key] = entry
+        for port in _out_ports(entry.actions):
+            self.by_port[port].add(key)
+        self.peak = max(self.peak, len(self.entries))
+        self.stats['added'] += 1
+
+    def add_flow_mod(self, msg):
+        "Record the entry an OFPFC_ADD or OFPFC_MODIFY* flow_mod creates."
+        self.add(TableEntry.from_flow_mod(msg))
+
+    def remove(self, match, priority=of.OFP_DEFAULT_PRIORITY):
+        "Forget an entry; return it, or None if it wasn't recorded."
+        entry = self._unindex(entry_key(match, priority))
+        if entry is not None:
+            self.stats['removed'] += 1
+        return entry
+
+    def get(self, match, priority=of.OFP_DEFAULT_PRIORITY):
+        return self.entries.get(entry_key(match, priority))
+
+    def entries_to_port(self, port):
+        "Return the entries that output to port."
+        return [self.entries[k] for k in self.by_port.get(port, ())]
+
+    def reconcile(self, stats, since=None):
+        """Replace the table with a flow stats dump.
+
+        Entries recorded at or after since (when the dump was requested)
+        are newer than the dump and kept as they are.  Returns
+        (missing, unknown): entries recorded here but absent from the
+        switch, and entries on the switch that weren't recorded.
+        """
+        old = self.entries
+        self.entries = {}
+        self.by_port.clear()
+        if since is not None:
+            for key, entry in old.items():
+                if entry.created >= since:
+                    self.entries[key] = old.pop(key)
+        unknown = []
+        for stat in stats:
+            key = entry_key(stat.match, stat.priority)
+            if key in self.entries:
+                continue
+            entry = old.pop(key, None)
+            if entry is None:
+                entry = TableEntry(priority=stat.priority,
+                                   cookie=stat.cookie,
+                                   idle_timeout=stat.idle_timeout,
+                                   hard_timeout=stat.hard_timeout,
+                                   match=stat.match, actions=stat.actions)
+                unknown.append(entry)
+            entry.byte_count = stat.byte_count
+            entry.packet_count = stat.packet_count
+            self.entries[key] = entry
+        for key, entry in self.entries.iteritems():
+            for port in _out_ports(entry.actions):
+                self.by_port[port].add(key)
+        self.peak = max(self.peak, len(self.entries))
+        self.stats['reconciled'] += 1
+        return old.values(), unknown
+
+    def clear(self):
+        self.entries.clear()
+        self.by_port.clear()
+
+    def _unindex(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            for port in _out_ports(entry.actions):
+                keys = self.by_port.get(port)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.by_port[port]
+        return entry
@@ -0,0 +1,196 @@
+"""
+Hedera-style elephant flow scheduling for RipL-POX.
+
+Periodically reads flow counters of edge switches from the shared
+statistics service, treats reactive flows
+whose byte rate crosses a threshold as elephants, estimates their natural
+demand and re-places them over the equal-cost paths with Global First
+Fit.  Only hops whose output changes are rewritten, with
+OFPFC_MODIFY_STRICT, downstream first so packets never reach a switch
+before its entry does.
+
+Run after riplpox.riplpox in reactive mode:
+
+  ./pox.py riplpox.riplpox --topo=ft,4 --mode=reactive riplpox.hedera
+"""
+
+from collections import defaultdict
+
+from pox.core import core
+from pox.lib.recoco import Timer
+
+from riplpox import flow_key
+from stats import get_stats_service, FLOW
+
+log = core.getLogger()
+
+# Seconds between scheduling rounds (and flow stats polls)
+DEF_POLL_PERIOD = 5
+
+# Link and host NIC capacity in bytes/sec
+DEF_LINK_CAPACITY = 1e9 / 8
+
+# Fraction of NIC capacity above which a flow is an elephant
+DEF_THRESHOLD = 0.1
+
+
+def estimate_demands(flows):
+    """Estimate the natural demand of flows, as in Hedera.
+
+    flows is a list of (src, dst) host pairs, one per flow.  Returns a list
+    of demands, one per flow, as fractions of a host NIC's capacity: the
+    rate each flow would get if it were limited only by its sender and
+    receiver NICs.
+    """
+    demands = [0.0] * len(flows)
+    converged = [False] * len(flows)
+    by_src = defaultdict(list)
+    by_dst = defaultdict(list)
+    for i, (src, dst) in enumerate(flows):
+        by_src[src].append(i)
+        by_dst[dst].append(i)
+
+    changed = True
+    while changed:
+        changed = False
+
+        # Senders split their spare capacity among unconverged flows.
+        for idxs in by_src.itervalues():
+            done = sum(demands[i] for i in idxs if converged[i])
+            open_ = [i for i in idxs if not converged[i]]
+            if not open_:
+                continue
+            share = (1.0 - done) / len(open_)
+            for i in open_:
+                if demands[i] != share:
+                    demands[i] = share
+                    changed = True
+
+        # Oversubscribed receivers cap the flows that want the most.
+        for idxs in by_dst.itervalues():
+            if sum(demands[i] for i in idxs) <= 1.0:
+                continue
+            limited = set(idxs)
+            share = 1.0 / len(limited)
+            small = 0.0
+            shrinking = True
+            while shrinking and limited:
+                shrinking = False
+                for i in list(limited):
+                    if demands[i] < share:
+                        small += demands[i]
+                        limited.discard(i)
+                        shrinking = True
+                if limited:
+                    share = (1.0 - small) / len(limited)
+            for i in limited:
+                if demands[i] != share or not converged[i]:
+                    demands[i] = share
+                    converged[i] = True
+                    changed = True
+    return demands
+
+
+class ElephantScheduler(object):
+    "Detect elephant flows and re-place them with Global First Fit."
+
+    def __init__(self, controller, poll_period=DEF_POLL_PERIOD,
+                 link_capacity=DEF_LINK_CAPACITY, threshold=DEF_THRESHOLD):
+        self.c = controller
+        self.poll_period = poll_period
+        self.link_capacity = link_capacity
+        self.threshold = threshold
+        self.rates = {}  # [flow_key] -> bytes/sec at the ingress edge
+        self.stats = {'rounds': 0, 'elephants': 0, 'moved': 0,
+                      'flow_mods': 0}
+
+        t = controller.t
+        hosts = set(t.hosts())
+        self.edge_dpids = set()
+        for sw in t.switches():
+            if any(n in hosts for n in t.g[sw]):
+                self.edge_dpids.add(t.id_gen(name=sw).dpid)
+
+        self.switch_stats = get_stats_service()
+        for dpid in self.edge_dpids:
+            self.switch_stats.watch(dpid, FLOW, poll_period)
+        self._timer = Timer(poll_period, self._round, recurring=True)
+
+    def _round(self):
+        "Refresh ingress rates from the stats cache, then schedule."
+        self.rates.clear()
+        for dpid in self.edge_dpids:
+            sw_name = self.c.t.id_gen(dpid=dpid).name_str()
+            for match, rate, count, stamp in \
+                    self.switch_stats.flow_rates.get(dpid, ()):
+                key = flow_key(match)
+                flow = self.c.flows.get(key)
+                if flow is None or flow.route[0] != sw_name:
+                    # Only count a flow at its ingress edge switch.
+                    continue
+                self.rates[key] = rate
+        self.schedule()
+
+    def _host_of(self, mac):
+        return self.c.t.id_gen(dpid=self.c._eth_to_int(mac)).name_str()
+
+    def schedule(self):
+        "Re-place current elephants; return the number of flows moved."
+        self.stats['rounds'] += 1
+        limit = self.threshold * self.link_capacity
+        elephants = [k for k, rate in self.rates.iteritems()
+                     if rate >= limit and k in self.c.flows
+                     and len(self.c.flows[k].route) > 1]
+        self.stats['elephants'] = len(elephants)
+        if not elephants:
+            return 0
+
+        pairs = [(self._host_of(self.c.flows[k].match.dl_src),
+                  self._host_of(self.c.flows[k].match.dl_dst))
+                 for k in elephants]
+        demands = estimate_demands(pairs)
+        order = sorted(range(len(elephants)), key=lambda i: -demands[i])
+
+        reserved = defaultdict(float)  # [(node1, node2)] -> bytes/sec
+        moved = 0
+        for i in order:
+            flow = self.c.flows[elephants[i]]
+            demand = demands[i] * self.link_capacity
+            route = flow.route
+            candidates = [route] + [p for p in
+                                    self.c.r.get_routes(route[0], route[-1])
+                                    if p != route]
+            chosen = route
+            for path in candidates:
+                links = zip(path[:-1], path[1:])
+                if all(reserved[l] + demand <= self.link_capacity
+                       for l in links):
+                    chosen = path
+                    break
+            for l in zip(chosen[:-1], chosen[1:]):
+                reserved[l] += demand
+            if chosen != route:
+                self.stats['flow_mods'] += len(self.c.move_flow(flow, chosen))
+                moved += 1
+        self.stats['moved'] += moved
+        if moved:
+            log.info("Moved %i of %i elephant flows", moved, len(elephants))
+        return moved
+
+
+def launch(poll_period=DEF_POLL_PERIOD, capacity=DEF_LINK_CAPACITY,
+           threshold=DEF_THRESHOLD):
+    """
+    Launch the elephant flow scheduler
+
+    poll_period is the scheduling interval in seconds
+    capacity is the link and host NIC capacity in bytes/sec
+    threshold is the fraction of capacity that makes a flow an elephant
+    """
+    def start():
+        core.register("ElephantScheduler",
+                      ElephantScheduler(core.RipLController,
+                                        float(poll_period), float(capacity),
+                                        float(threshold)))
+        log.info("Elephant scheduler running")
+    core.call_when_ready(start, "RipLController")
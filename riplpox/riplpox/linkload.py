@@ -0,0 +1,50 @@
+"""
+Link load estimation from periodic OpenFlow port statistics.
+
+Feeds per-link transmit rates into a load-aware routing engine (one that
+implements set_link_load(), e.g. ripl.routing.LoadAwareStructuredRouting).
+Port counters come from the shared statistics service in stats.py.
+"""
+
+from pox.core import core
+
+from stats import get_stats_service, PORT
+
+log = core.getLogger()
+
+# Seconds between port stats requests
+DEF_POLL_PERIOD = 2
+
+
+class LinkLoadMonitor(object):
+    "Turn cached port tx rates into link loads."
+
+    def __init__(self, t, r, poll_period=DEF_POLL_PERIOD):
+        self.t = t  # Topo object, used to map ports to links.
+        self.r = r  # Routing object that receives the estimates.
+        self.poll_period = poll_period
+        self.port_links = {}  # [(dpid, port)] -> (node, neighbor)
+
+        switches = set(t.switches())
+        for sw in switches:
+            dpid = t.id_gen(name=sw).dpid
+            for port, (neighbor, neighbor_port) in t.ports[sw].items():
+                if neighbor in switches:
+                    self.port_links[(dpid, port)] = (sw, neighbor)
+
+        # Don't let steady links go quiet long enough to look stale.
+        max_interval = getattr(r, 'stale_after', None)
+        self.stats = get_stats_service()
+        for dpid in set(dpid for dpid, port in self.port_links):
+            self.stats.watch(dpid, PORT, poll_period, max_interval)
+        self.stats.addListenerByName("StatsUpdated",
+                                     self._handle_StatsUpdated)
+
+    def _handle_StatsUpdated(self, event):
+        if event.kind != PORT:
+            return
+        for port_no, (tx, rx, stamp) in \
+                self.stats.port_rates.get(event.dpid, {}).iteritems():
+            link = self.port_links.get((event.dpid, port_no))
+            if link is not None:
+                self.r.set_link_load(link[0], link[1], tx, stamp)
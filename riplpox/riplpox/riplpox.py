@@ -4,35 +4,58 @@ RipL+POX.  As simple a data center controller as possible.
 
 import logging
 import random
-from struct import pack
-from zlib import crc32
 
-from collections import defaultdict
+from collections import defaultdict, deque
 import time
 
 from pox.core import core
-from pox.lib.util import dpidToStr
+from pox.lib.util import dpidToStr, str_to_bool
+from pox.lib.recoco import Timer
 import pox.openflow.libopenflow_01 as of
 from pox.lib.revent import EventMixin
-from pox.lib.addresses import EthAddr
+from pox.lib.addresses import EthAddr, IPAddr
+from pox.lib.packet.ethernet import ethernet
 from pox.lib.packet.ipv4 import ipv4
 from pox.lib.packet.udp import udp
 from pox.lib.packet.tcp import tcp
 
 from ripl.mn import topos
 
-from util import buildTopo, getRouting
+from util import buildTopo, getRouting, ip_prefixes
+from linkload import LinkLoadMonitor, DEF_POLL_PERIOD
+from flowdb import SwitchTable
+from routepool import RoutePool, backup_route, DEF_DEADLINE
+from compress import compress
+from ecmp import ecmp_hash, src_dst_hash, src_dst_hashes, assign_paths
+from shard import RemoteSwitch, shard_of, start_peers, DEF_BASE_PORT
 
 log = core.getLogger()
 
 # Number of bytes to send for packet_ins
 MISS_SEND_LEN = 2000
 
-MODES = ['reactive', 'proactive']
+MODES = ['reactive', 'proactive', 'hybrid']
 DEF_MODE = MODES[0]
 
 IDLE_TIMEOUT = 10
 
+# Seconds a reactive flow setup may wait for its barrier replies
+SETUP_TIMEOUT = 5
+
+# Number of recent failover timings to keep
+FAILOVER_HISTORY = 100
+
+# Priority of precomputed backup entries; primaries use the default
+BACKUP_PRIORITY = of.OFP_DEFAULT_PRIORITY - 1
+
+# Priority of compressed fabric entries, plus their prefix length; below
+# the backup entries
+FABRIC_PRIORITY = of.OFP_DEFAULT_PRIORITY - 64
+
+# Packet-ins held per switch until all switches are up, and for how long
+DEF_QUEUE_SIZE = 100
+DEF_QUEUE_AGE = 5
+
 
 # Borrowed from pox/forwarding/l2_multi
 class Switch(object):
@@ -41,6 +64,9 @@ class Switch(object):
         self.ports = None
         self.dpid = None
         self._listeners = None
+        self.table = SwitchTable()  # Entries we installed on this switch
+        self.reconcile_xid = None  # Flow stats dump we are waiting for
+        self.reconcile_sent = None  # When that dump was requested
 
     def __repr__(self):
         return core.RipLController.t.id_gen(dpid=self.dpid).name_str()
@@ -68,6 +94,12 @@ class Switch(object):
         msg.actions.append(of.ofp_action_output(port=outport))
         self.connection.send(msg)
 
+    def send_packet_table(self, in_port, data):
+        "Send a packet through the switch's flow table, as if just received."
+        msg = of.ofp_packet_out(in_port=in_port, data=data)
+        msg.actions.append(of.ofp_action_output(port=of.OFPP_TABLE))
+        self.connection.send(msg)
+
     def send_packet_bufid(self, outport, buffer_id=None):
         msg = of.ofp_packet_out(in_port=of.OFPP_NONE)
         msg.actions.append(of.ofp_action_output(port=outport))
@@ -75,15 +107,31 @@ class Switch(object):
         self.connection.send(msg)
 
     def install(self, port, match, buf=None, idle_timeout=0, hard_timeout=0,
-                priority=of.OFP_DEFAULT_PRIORITY):
-        msg = of.ofp_flow_mod()
+                priority=of.OFP_DEFAULT_PRIORITY, command=of.OFPFC_ADD):
+        msg = of.ofp_flow_mod(command=command)
         msg.match = match
         msg.idle_timeout = idle_timeout
         msg.hard_timeout = hard_timeout
         msg.priority = priority
+        msg.flags = of.OFPFF_SEND_FLOW_REM
         msg.actions.append(of.ofp_action_output(port=port))
         msg.buffer_id = buf
         self.connection.send(msg)
+        self.table.add_flow_mod(msg)
+
+    def remove(self, match, priority=of.OFP_DEFAULT_PRIORITY):
+        "Delete the entry with exactly this match and priority."
+        msg = of.ofp_flow_mod(command=of.OFPFC_DELETE_STRICT)
+        msg.match = match
+        msg.priority = priority
+        self.connection.send(msg)
+        self.table.remove(match, priority)
+
+    def send_barrier(self):
+        "Send a barrier request and return its xid."
+        msg = of.ofp_barrier_request()
+        self.connection.send(msg)
+        return msg.xid
 
     def install_multiple(self, actions, match, buf=None, idle_timeout=0,
                          hard_timeout=0, priority=of.OFP_DEFAULT_PRIORITY):
@@ -92,10 +140,22 @@ class Switch(object):
         msg.idle_timeout = idle_timeout
         msg.hard_timeout = hard_timeout
         msg.priority = priority
+        msg.flags = of.OFPFF_SEND_FLOW_REM
         for a in actions:
             msg.actions.append(a)
         msg.buffer_id = buf
         self.connection.send(msg)
+        self.table.add_flow_mod(msg)
+
+    def request_reconcile(self):
+        "Ask for the flow stats dump that will resynchronize self.table."
+        msg = of.ofp_stats_request(body=of.ofp_flow_stats_request())
+        self.reconcile_xid = msg.xid
+        self.reconcile_sent = time.time()
+        self.connection.send(msg)
+
+    def _handle_FlowRemoved(self, event):
+        self.table.remove(event.ofp.match, event.ofp.priority)
 
     def _handle_ConnectionDown(self, event):
         self.disconnect()
@@ -106,22 +166,212 @@ def sep():
     log.info("************************************************")
 
 
+def flow_key(match):
+    "Return a hashable key for the flow fields of a reactive match."
+    return (match.dl_src, match.dl_dst, match.dl_type, match.nw_src,
+            match.nw_dst, match.nw_proto, match.tp_src, match.tp_dst)
+
+
+class InstalledFlow(object):
+    "A reactive flow and the route its entries were installed along."
+    def __init__(self, match, route, final_out_port, hash_=0):
+        self.match = match
+        self.route = route
+        self.final_out_port = final_out_port
+        self.hash_ = hash_  # Routing hash, reused when rerouting
+        self.backup = None  # Link-disjoint fallback route, if installed
+        self.backup_hops = []  # (dpid, out_port) of BACKUP_PRIORITY entries
+
+
+class PendingSetup(object):
+    """A reactive flow install still waiting for barrier replies.
+
+    Keyed by the flow match and its egress point; records the route being
+    installed and the (dpid, xid) barriers that must come back before the
+    flow entries are known to be in place.
+    """
+    def __init__(self, key, route):
+        self.key = key
+        self.route = route
+        self.xids = set()  # (dpid, xid) of outstanding barriers
+        self.expires_at = time.time() + SETUP_TIMEOUT
+        self.suppressed = 0  # Duplicate packet-ins absorbed by this setup
+        # When the packet-in arrived, was parsed, was routed and when its
+        # entries were sent, for setup latency.
+        self.received = self.parsed = self.routed = self.sent = None
+
+    @property
+    def is_expired(self):
+        return time.time() >= self.expires_at
+
+
+class Reroute(object):
+    "Flows being moved off a failed link, timed until the last barrier."
+    def __init__(self, link, started):
+        self.link = link
+        self.started = started  # When the failure was reported
+        self.flows = 0  # Flows rerouted by recomputing their path
+        self.local = 0  # Flows switched onto their pre-installed backups
+        self.xids = set()  # (dpid, xid) of outstanding barriers
+        self.expires_at = started + SETUP_TIMEOUT
+
+    @property
+    def is_expired(self):
+        return time.time() >= self.expires_at
+
+
+class PacketInQueue(object):
+    """Packet-ins that arrive before the controller is ready for them.
+
+    Each switch gets a bounded queue; when it is full the oldest event is
+    dropped, and events older than max_age are dropped on replay.  Events
+    keep their raw data, so replay doesn't depend on switch buffers that
+    may have expired.
+    """
+    def __init__(self, size=DEF_QUEUE_SIZE, max_age=DEF_QUEUE_AGE):
+        self.size = size
+        self.max_age = max_age
+        self.queues = defaultdict(deque)  # [dpid] -> deque of (time, event)
+        self.stats = {'queued': 0, 'dropped': 0, 'expired': 0,
+                      'truncated': 0, 'replayed': 0, 'resent': 0,
+                      'unroutable': 0}
+
+    def push(self, event):
+        if event.ofp.total_len > len(event.data):
+            # Sent before our miss_send_len took effect; can't forward it.
+            self.stats['truncated'] += 1
+            return
+        q = self.queues[event.dpid]
+        if len(q) >= self.size:
+            q.popleft()
+            self.stats['dropped'] += 1
+        q.append((time.time(), event))
+        self.stats['queued'] += 1
+
+    def drain(self):
+        "Empty the queues; return unexpired (arrival, event), oldest first."
+        horizon = time.time() - self.max_age
+        events = []
+        for q in self.queues.itervalues():
+            for arrived, event in q:
+                if arrived < horizon:
+                    self.stats['expired'] += 1
+                else:
+                    events.append((arrived, event))
+        self.queues.clear()
+        events.sort(key=lambda e: e[0])
+        return events
+
+
 class RipLController(object):
-    def __init__(self, t, r, mode):
+    def __init__(self, t, r, mode, poll_period=DEF_POLL_PERIOD,
+                 backup=False, queue_size=DEF_QUEUE_SIZE,
+                 queue_age=DEF_QUEUE_AGE, workers=0, deadline=DEF_DEADLINE,
+                 shard=0, shards=1, base_port=DEF_BASE_PORT,
+                 compress_fabric=False):
         self.switches = {}  # Switches seen: [dpid] -> Switch
         self.t = t  # Master Topo object, passed in and never modified.
         self.r = r  # Master Routing object, passed in and reused.
         self.mode = mode  # One in MODES.
-        self.macTable = {}  # [mac] -> (dpid, port)
+        self.backup = backup  # Pre-install backup routes for failover?
+        # Where every topology host attaches: [mac] -> (edge dpid, port,
+        # host name).  Built once and never modified.
+        self.host_locations = self._host_index()
+        self.macTable = {}  # Other hosts, as learned: [mac] -> (dpid, port)
+        self.host_moves = 0  # Times a host turned up somewhere else
+        self.pending_setups = {}  # [match key] -> PendingSetup
+        self.pending_xids = {}  # [(dpid, xid)] -> PendingSetup or Reroute
+        self.flows = {}  # [flow_key] -> InstalledFlow
+        self.link_flows = {}  # [(node1, node2)] -> set of flow_keys
+        # Hybrid mode: [(switch, edge switch)] -> route of fabric entries
+        self.fabric_routes = {}
+        # Compress each switch's fabric entries into overlapping prefixes?
+        self.compress_fabric = compress_fabric
+        # Reactive flow setup counters.
+        self.setup_stats = {'installed': 0, 'completed': 0,
+                            'suppressed': 0, 'expired': 0}
+        # (link, flows rerouted, flows on backups, seconds to last barrier)
+        # per failover.
+        self.failover_times = deque(maxlen=FAILOVER_HISTORY)
+        # Packet-ins held until all switches are up.
+        self.early_packets = PacketInQueue(queue_size, queue_age)
 
         # TODO: generalize all_switches_up to a more general state machine.
         self.all_switches_up = False  # Sequences event handling.
         core.openflow.addListeners(self, priority=0)
+        Timer(SETUP_TIMEOUT, self._expire_pending_setups, recurring=True)
+        core.call_when_ready(self._listen_to_discovery, "openflow_discovery")
+        self.latency = None  # SetupLatency component, if launched
+        core.call_when_ready(self._use_latency, "SetupLatency")
+
+        # Reactive routes are computed on worker threads if asked to.
+        self.route_pool = None
+        if workers > 0:
+            self.route_pool = RoutePool(t, r, workers, deadline)
+
+        # Sharded: this process controls only the switches shard_of gives
+        # it, and reaches the others through its peers.
+        self.shard = shard
+        self.shards = shards
+        self.peers = None
+        if shards > 1:
+            self.peers = start_peers(self, shard, shards, base_port)
+
+        # Load-aware routing engines need link utilization estimates.
+        self.link_loads = None
+        if hasattr(r, 'set_link_load'):
+            self.link_loads = LinkLoadMonitor(t, r, poll_period)
 
     def _raw_dpids(self, arr):
         "Convert a list of name strings (from Topo object) to numbers."
         return [self.t.id_gen(name=a).dpid for a in arr]
 
+    def _owns(self, dpid):
+        name = self.t.id_gen(dpid=dpid).name_str()
+        return shard_of(self.t, name, self.shards) == self.shard
+
+    def _host_index(self):
+        "Return [mac] -> (edge dpid, port, host name) for every host."
+        t = self.t
+        index = {}
+        for h in t.hosts():
+            edge = t.g[h].keys()[0]
+            index[EthAddr(t.id_gen(name=h).mac_str())] = \
+                (t.id_gen(name=edge).dpid, t.port(edge, h)[0], h)
+        return index
+
+    def _learn(self, mac, dpid, port):
+        "Record where a host outside the topology was seen."
+        old = self.macTable.get(mac)
+        if old == (dpid, port):
+            return
+        if old is not None:
+            self.host_moves += 1
+            log.warn("%s moved from %s.%i to %s.%i" %
+                     (mac, dpidToStr(old[0]), old[1], dpidToStr(dpid), port))
+        self.macTable[mac] = (dpid, port)
+
+    def local_dpids(self):
+        "Return the dpids of the connected switches this shard owns."
+        return [dpid for dpid, sw in self.switches.iteritems()
+                if not isinstance(sw, RemoteSwitch) and
+                sw.connection is not None]
+
+    def remote_switch_up(self, shard, dpid):
+        "Note a switch another shard has connected."
+        sw = self.switches.get(dpid)
+        if isinstance(sw, RemoteSwitch):
+            sw.up = True
+            return
+        log.info("Shard %i has switch %s" % (shard, dpidToStr(dpid)))
+        self.switches[dpid] = RemoteSwitch(self.peers, shard, dpid)
+        self._check_all_up()
+
+    def remote_switch_down(self, dpid):
+        sw = self.switches.get(dpid)
+        if isinstance(sw, RemoteSwitch):
+            sw.up = False
+
     def _ecmp_hash(self, packet):
         "Return an ECMP-style 5-tuple hash for TCP/IP packets, otherwise 0."
         hash_input = [0] * 5
@@ -134,19 +384,148 @@ class RipLController(object):
                 l4 = ip.next
                 hash_input[3] = l4.srcport
                 hash_input[4] = l4.dstport
-                return crc32(pack('LLHHH', *hash_input))
+                return ecmp_hash(*hash_input)
         return 0
 
-    def _install_reactive_path(self, event, out_dpid, final_out_port, packet):
-        "Install entries on route between two switches."
+    def _install_reactive_path(self, event, out_dpid, final_out_port, packet,
+                               received=None, parsed=None):
+        "Install entries on route between two switches, then deliver packet."
+        match = of.ofp_match.from_packet(packet)
+        key = (match.pack(), out_dpid, final_out_port)
+        setup = self.pending_setups.get(key)
+        if setup is not None:
+            if not setup.is_expired:
+                # Same flow is already being installed; don't redo it.
+                setup.suppressed += 1
+                self.setup_stats['suppressed'] += 1
+                self.switches[out_dpid].send_packet_data(final_out_port,
+                                                         event.data)
+                return
+            self._forget_setup(setup)
+            self.setup_stats['expired'] += 1
+
         in_name = self.t.id_gen(dpid=event.dpid).name_str()
         out_name = self.t.id_gen(dpid=out_dpid).name_str()
         hash_ = self._ecmp_hash(packet)
-        # log.info(("%s-->%s" % sr)
-        route = self.r.get_route(in_name, out_name, hash_)
+        # Registered before the route is known, so duplicates arriving
+        # while it is computed are suppressed too.
+        setup = PendingSetup(key, None)
+        setup.received, setup.parsed = received, parsed
+        self.pending_setups[key] = setup
+
+        def routed(route, backup):
+            self._setup_route(setup, event, match, out_dpid, final_out_port,
+                              hash_, route, backup)
+        if self.route_pool is not None:
+            self.route_pool.submit(in_name, out_name, hash_, self.backup,
+                                   routed)
+        else:
+            # log.info(("%s-->%s" % sr)
+            route = self.r.get_route(in_name, out_name, hash_)
+            backup = None
+            if route and self.backup:
+                backup = backup_route(self.r, route)
+            routed(route, backup)
 
+    def _setup_route(self, setup, event, match, out_dpid, final_out_port,
+                     hash_, route, backup):
+        "Install a computed route for a pending setup and deliver its packet."
+        if self.pending_setups.get(setup.key) is not setup:
+            return  # Timed out while the route was computed
+        if not route:
+            self._forget_setup(setup)
+            return
         # log.info("route: %s" % route)
-        match = of.ofp_match.from_packet(packet)
+        setup.routed = time.time()
+        out_name = route[-1]
+        hops = self.route_hops(route, final_out_port)
+        if self.mode == 'hybrid' and match.dl_type == ethernet.IP_TYPE \
+                and len(route) > 1:
+            # Past the ingress, IP packets follow the fabric entries.
+            fabric = self.fabric_routes.get((route[1], out_name))
+            if fabric and not any(l in self.r.down_links
+                                  for l in zip(fabric[:-1], fabric[1:])):
+                route = [route[0]] + fabric
+                hops = hops[:1]
+        setup.route = route
+        flow = InstalledFlow(match, route, final_out_port, hash_)
+        for node_dpid, out_port in hops:
+            sw = self.switches[node_dpid]
+            sw.install(out_port, match, idle_timeout=IDLE_TIMEOUT)
+            setup.xids.add((node_dpid, sw.send_barrier()))
+        if backup is not None and \
+                not set(zip(route[:-1], route[1:])) & \
+                set(zip(backup[:-1], backup[1:])):
+            flow.backup = backup
+            # Entries past the ingress, at switches off the primary route,
+            # at lower priority so they can't shadow it.  On the route
+            # they would: in hybrid mode the primary there is a fabric
+            # entry, below BACKUP_PRIORITY.  Failover rewrites those
+            # switches instead.  They have no idle timeout (they see no
+            # traffic until used) and are removed when the flow is retired.
+            primary = set(self.t.id_gen(name=node).dpid for node in route)
+            for node_dpid, out_port in self.route_hops(backup,
+                                                       final_out_port)[1:]:
+                if node_dpid in primary:
+                    continue
+                sw = self.switches[node_dpid]
+                sw.install(out_port, match, priority=BACKUP_PRIORITY)
+                setup.xids.add((node_dpid, sw.send_barrier()))
+                flow.backup_hops.append((node_dpid, out_port))
+        setup.sent = time.time()
+        for entry in setup.xids:
+            self.pending_xids[entry] = setup
+        self.setup_stats['installed'] += 1
+        self._add_flow(flow)
+        self.switches[out_dpid].send_packet_data(final_out_port, event.data)
+
+    def _add_flow(self, flow):
+        "Record an installed flow and index it by the links it crosses."
+        key = flow_key(flow.match)
+        self._remove_flow(key)
+        self.flows[key] = flow
+        for link in zip(flow.route[:-1], flow.route[1:]):
+            self.link_flows.setdefault(link, set()).add(key)
+
+    def _remove_flow(self, key):
+        flow = self.flows.pop(key, None)
+        if flow is None:
+            return
+        for link in zip(flow.route[:-1], flow.route[1:]):
+            keys = self.link_flows.get(link)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.link_flows[link]
+
+    def move_flow(self, flow, route):
+        """Move an installed flow onto a new route.
+
+        Rewrites only the hops whose output port changes, downstream first,
+        and returns the dpids that were sent a flow_mod.
+        """
+        old_hops = set(self.route_hops(flow.route, flow.final_out_port))
+        new_hops = self.route_hops(route, flow.final_out_port)
+        changed = []
+        for dpid, out_port in reversed(new_hops):
+            if (dpid, out_port) in old_hops:
+                continue
+            self.switches[dpid].install(out_port, flow.match,
+                                        idle_timeout=IDLE_TIMEOUT,
+                                        command=of.OFPFC_MODIFY_STRICT)
+            changed.append(dpid)
+        self._remove_flow(flow_key(flow.match))
+        flow.route = route
+        self._add_flow(flow)
+        if flow.backup is not None and set(zip(route[:-1], route[1:])) & \
+                set(zip(flow.backup[:-1], flow.backup[1:])):
+            # No longer disjoint; its entries stay until the flow retires.
+            flow.backup = None
+        return changed
+
+    def route_hops(self, route, final_out_port):
+        "Return the (dpid, out_port) of every switch along a route."
+        hops = []
         for i, node in enumerate(route):
             node_dpid = self.t.id_gen(name=node).dpid
             if i < len(route) - 1:
@@ -154,7 +533,208 @@ class RipLController(object):
                 out_port, next_in_port = self.t.port(node, next_node)
             else:
                 out_port = final_out_port
-            self.switches[node_dpid].install(out_port, match, idle_timeout=IDLE_TIMEOUT)
+            hops.append((node_dpid, out_port))
+        return hops
+
+    def _forget_setup(self, setup):
+        "Drop a pending setup and any barriers it is still waiting on."
+        self.pending_setups.pop(setup.key, None)
+        for entry in setup.xids:
+            self.pending_xids.pop(entry, None)
+
+    def _expire_pending_setups(self):
+        "Remove setups and reroutes whose barrier replies never arrived."
+        expired = [s for s in self.pending_setups.values() if s.is_expired]
+        for setup in expired:
+            self._forget_setup(setup)
+        if expired:
+            self.setup_stats['expired'] += len(expired)
+            log.warn("%i flow setups timed out" % len(expired))
+        reroutes = set(p for p in self.pending_xids.itervalues()
+                       if isinstance(p, Reroute) and p.is_expired)
+        for reroute in reroutes:
+            for entry in reroute.xids:
+                self.pending_xids.pop(entry, None)
+            log.warn("Reroute off %s-%s timed out waiting on %i barriers" %
+                     (reroute.link[0], reroute.link[1], len(reroute.xids)))
+
+    def _retire_flow(self, key):
+        "Forget a flow and delete the backup entries nothing else expires."
+        flow = self.flows.get(key)
+        if flow is None:
+            return
+        self._remove_flow(key)
+        for dpid, out_port in flow.backup_hops:
+            sw = self.switches.get(dpid)
+            if sw is not None and sw.connection is not None:
+                sw.remove(flow.match, BACKUP_PRIORITY)
+
+    def _is_ingress(self, flow, dpid):
+        return self.t.id_gen(name=flow.route[0]).dpid == dpid
+
+    def _handle_FlowRemoved(self, event):
+        # A reactive flow ends when its ingress entry times out.  Entries
+        # we deleted ourselves belonged to flows that were moved, not ended.
+        msg = event.ofp
+        if not event.timeout or msg.priority != of.OFP_DEFAULT_PRIORITY:
+            return
+        key = flow_key(msg.match)
+        flow = self.flows.get(key)
+        if flow is not None and self._is_ingress(flow, event.dpid):
+            self._retire_flow(key)
+
+    def _handle_FlowStatsReceived(self, event):
+        sw = self.switches.get(event.dpid)
+        if sw is None or sw.reconcile_xid != event.ofp[0].xid:
+            return
+        sw.reconcile_xid = None
+        missing, unknown = sw.table.reconcile(event.stats, sw.reconcile_sent)
+        for entry in missing:
+            key = flow_key(entry.match)
+            flow = self.flows.get(key)
+            if entry.priority == of.OFP_DEFAULT_PRIORITY and \
+                    flow is not None and self._is_ingress(flow, event.dpid):
+                self._retire_flow(key)
+        if missing or unknown:
+            log.info("%s: %i entries gone, %i not installed by us" %
+                     (sw, len(missing), len(unknown)))
+
+    def occupancy(self):
+        "Return [switch name] -> number of entries installed on it."
+        return dict((repr(sw), len(sw.table))
+                    for sw in self.switches.itervalues())
+
+    def _use_latency(self):
+        self.latency = core.SetupLatency
+
+    def _record_latency(self, setup):
+        "Report the stages of a completed setup to SetupLatency."
+        n = len(setup.route)
+        record = self.latency.record
+        record('riplpox', 'parse', setup.parsed - setup.received, n)
+        record('riplpox', 'route', setup.routed - setup.parsed, n)
+        record('riplpox', 'install', setup.sent - setup.routed, n)
+        record('riplpox', 'total', time.time() - setup.received, n)
+
+    def _listen_to_discovery(self):
+        core.openflow_discovery.addListenerByName("LinkEvent",
+                                                  self._handle_LinkEvent)
+        # The topology says which ports face hosts; no LLDP needed there
+        core.openflow_discovery.set_host_ports(
+            (dpid, port) for dpid, port, name in
+            self.host_locations.itervalues())
+
+    def _port_link(self, dpid, port):
+        "Return the (node, neighbor) switch link on a port, or None."
+        name = self.t.id_gen(dpid=dpid).name_str()
+        neighbor = self.t.ports.get(name, {}).get(port)
+        if neighbor is None or neighbor[0] not in self.t.switches():
+            return None
+        return (name, neighbor[0])
+
+    def _handle_PortStatus(self, event):
+        link = self._port_link(event.dpid, event.port)
+        if link is None:
+            return
+        desc = event.ofp.desc
+        down = event.deleted or bool(desc.state & of.OFPPS_LINK_DOWN) or \
+            bool(desc.config & of.OFPPC_PORT_DOWN)
+        if down:
+            self._link_down(link, time.time())
+        elif link in self.r.down_links:
+            self._link_up(link)
+        else:
+            return
+        if self.peers is not None:
+            # Other shards may have flows across it too.
+            self.peers.broadcast('link_down' if down else 'link_up',
+                                 link=link)
+
+    def _handle_LinkEvent(self, event):
+        if event.removed:
+            l = event.link
+            link = self._port_link(l.dpid1, l.port1)
+            if link is not None:
+                self._link_down(link, time.time())
+                if self.peers is not None:
+                    self.peers.broadcast('link_down', link=link)
+
+    def _link_up(self, link):
+        if link in self.r.down_links:
+            log.info("Link %s-%s is back up" % link)
+            self.r.set_link_up(*link)
+
+    def _link_down(self, link, started):
+        "Reroute every installed flow crossing a failed link."
+        if link in self.r.down_links:
+            return  # Already handled, e.g. from the other end's port status
+        log.info("Link %s-%s is down" % link)
+        self.r.set_link_down(*link)
+        affected = self.link_flows.get(link, set()) | \
+            self.link_flows.get((link[1], link[0]), set())
+        reroute = Reroute(link, started)
+        moving = []  # Flows without a usable backup
+        for key in list(affected):
+            flow = self.flows[key]
+            if flow.backup is not None and not any(
+                    l in self.r.down_links
+                    for l in zip(flow.backup[:-1], flow.backup[1:])):
+                # Point the primary entries wherever the backup leaves the
+                # primary at the backup's next hop: the ingress, and any
+                # switch the two share (which got no backup entries).
+                # Downstream first, and rewritten rather than deleted to
+                # keep the idle timeout that ends the flow.  This is still
+                # a controller round trip.
+                for dpid in set(self._switch_to_backup(flow)):
+                    reroute.xids.add((dpid,
+                                      self.switches[dpid].send_barrier()))
+                self._remove_flow(key)
+                flow.route, flow.backup = flow.backup, None
+                self._add_flow(flow)
+                reroute.local += 1
+                continue
+            moving.append(flow)
+        # New routes for all of them in one batch.
+        routes = assign_paths(self.r, [(f.route[0], f.route[-1])
+                                       for f in moving],
+                              [f.hash_ for f in moving])
+        for flow, route in zip(moving, routes):
+            if route is None:
+                log.warn("No route left for flow %s -> %s" %
+                         (flow.route[0], flow.route[-1]))
+                continue
+            for dpid in set(self.move_flow(flow, route)):
+                reroute.xids.add((dpid, self.switches[dpid].send_barrier()))
+            reroute.flows += 1
+        for entry in reroute.xids:
+            self.pending_xids[entry] = reroute
+        if not reroute.xids:
+            self._reroute_done(reroute)
+
+    def _switch_to_backup(self, flow):
+        """Point a flow's entries on its primary route at its backup.
+
+        Returns the dpids that were sent a flow_mod.
+        """
+        primary = dict(self.route_hops(flow.route, flow.final_out_port))
+        changed = []
+        for dpid, out_port in reversed(self.route_hops(flow.backup,
+                                                       flow.final_out_port)):
+            if dpid not in primary or primary[dpid] == out_port:
+                continue
+            self.switches[dpid].install(out_port, flow.match,
+                                        idle_timeout=IDLE_TIMEOUT,
+                                        command=of.OFPFC_MODIFY_STRICT)
+            changed.append(dpid)
+        return changed
+
+    def _reroute_done(self, reroute):
+        elapsed = time.time() - reroute.started
+        self.failover_times.append((reroute.link, reroute.flows,
+                                    reroute.local, elapsed))
+        log.info("Rerouted %i flows (%i onto backups) off %s-%s in %.1f ms" %
+                 (reroute.flows + reroute.local, reroute.local,
+                  reroute.link[0], reroute.link[1], elapsed * 1000))
 
     def _eth_to_int(self, eth):
         t = -1
@@ -172,24 +752,24 @@ class RipLController(object):
 
     def _src_dst_hash(self, src_dpid, dst_dpid):
         "Return a hash based on src and dst dpids."
-        return crc32(pack('QQ', src_dpid, dst_dpid))
+        return src_dst_hash(src_dpid, dst_dpid)
 
-    def _install_proactive_path(self, src, dst):
+    def _install_proactive_path(self, src, dst, route=None):
         """Install entries on route between two hosts based on MAC addrs.
 
-        src and dst are unsigned ints.
+        src and dst are unsigned ints.  route is computed if not given.
         """
         # time.sleep(10)
         if src == dst:
             return
         src_host_name = self.t.id_gen(dpid=src).name_str()
         dst_host_name = self.t.id_gen(dpid=dst).name_str()
-        src_sw_name = self.t.g[src_host_name].keys()[0]
-        dst_sw_name = self.t.g[dst_host_name].keys()[0]
-        hash_ = self._src_dst_hash(src, dst)
-        print
-        log.info("%s<-->%s" % (src_host_name, dst_host_name))
-        route = self.r.get_route(src_sw_name, dst_sw_name, hash_)
+        log.debug("%s<-->%s" % (src_host_name, dst_host_name))
+        if route is None:
+            src_sw_name = self.t.g[src_host_name].keys()[0]
+            dst_sw_name = self.t.g[dst_host_name].keys()[0]
+            hash_ = self._src_dst_hash(src, dst)
+            route = self.r.get_route(src_sw_name, dst_sw_name, hash_)
         count = len(route)
         route_reverse = []
         for i in range(count):
@@ -209,7 +789,9 @@ class RipLController(object):
                 out_port, next_in_port = self.t.port(node, next_node)
             else:
                 out_port = final_out_port
-            self.switches[node_dpid].install(out_port, match)
+            sw = self.switches[node_dpid]
+            if not isinstance(sw, RemoteSwitch):  # Its owner installs it
+                sw.install(out_port, match)
 
         # reverse
 
@@ -221,7 +803,9 @@ class RipLController(object):
                 out_port, next_in_port = self.t.port(node, next_node)
             else:
                 out_port = final_out_port
-            self.switches[node_dpid].install(out_port, match.flip())
+            sw = self.switches[node_dpid]
+            if not isinstance(sw, RemoteSwitch):
+                sw.install(out_port, match.flip())
 
     def _flood(self, event):
         packet = event.parsed
@@ -264,33 +848,25 @@ class RipLController(object):
                 self.switches[sw_dpid].send_packet_data(port, event.data)
                 #  buffer_id = None
 
-    def _handle_packet_reactive(self, event):
+    def _handle_packet_reactive(self, event, received):
         packet = event.parsed
-        dpid = event.dpid
+        parsed = time.time()
         # log.info("PacketIn: %s" % packet)
-        in_port = event.port
-        t = self.t
 
-        # Learn MAC address of the sender on every packet-in.
-        self.macTable[packet.src] = (dpid, in_port)
-        # print self.macTable
-        # log.info("mactable: %s" % self.macTable)
+        # Topology hosts are where the topology says; learn only the rest,
+        # and only on ports facing hosts.  Packet-ins on switch-to-switch
+        # ports come from partial paths whose entries expired, not hosts.
+        if packet.src not in self.host_locations and \
+                self._port_link(event.dpid, event.port) is None:
+            self._learn(packet.src, event.dpid, event.port)
 
         # Insert flow, deliver packet directly to destination.
-        if packet.dst in self.macTable:
-
-            src_dpid = self._eth_to_int(packet.src)
-            dst_dpid = self._eth_to_int(packet.dst)
-            src_h_name = self.t.id_gen(dpid=src_dpid).name_str()
-            dst_h_name = self.t.id_gen(dpid=dst_dpid).name_str()
-            out_dpid, out_port = self.macTable[packet.dst]
-            print
-            log.info("%s-->%s" % (src_h_name, dst_h_name))
-            self._install_reactive_path(event, out_dpid, out_port, packet)
-
-            # log.info("sending to entry in mactable: %s %s" % (out_dpid, out_port))
-            self.switches[out_dpid].send_packet_data(out_port, event.data)
-
+        dst = self.host_locations.get(packet.dst)
+        if dst is None:
+            dst = self.macTable.get(packet.dst)
+        if dst is not None:
+            self._install_reactive_path(event, dst[0], dst[1], packet,
+                                        received, parsed)
         else:
             self._flood(event)
 
@@ -310,23 +886,160 @@ class RipLController(object):
     def _handle_PacketIn(self, event):
         # log.info("Parsing PacketIn.")
         if not self.all_switches_up:
-            log.info("Saw PacketIn before all switches were up - ignoring.")
+            self.early_packets.push(event)
+            return
+        self._handle_packet(event, time.time())
+
+    def _handle_packet(self, event, received):
+        if self.mode in ('reactive', 'hybrid'):
+            self._handle_packet_reactive(event, received)
+        elif self.mode == 'proactive':
+            self._handle_packet_proactive(event)
+
+    def _replay_early_packets(self):
+        "Handle the packet-ins queued while switches were coming up."
+        events = self.early_packets.drain()
+        stats = self.early_packets.stats
+        hosts = set(self._raw_dpids(self.t.hosts()))
+        barriers = set()  # Switches sent a barrier ahead of resends
+        replayed = 0
+        for arrived, event in events:
+            sw = self.switches.get(event.dpid)
+            if sw is None or sw.connection is not event.connection:
+                stats['expired'] += 1
+                continue  # Switch reconnected since; its buffers are gone
+            packet = event.parsed
+            if self.mode == 'proactive' and not packet.dst.is_multicast:
+                # Entries for every host pair are pushed down by now, so
+                # the switch's table forwards it; the proactive handler
+                # takes known unicast to mean they're missing.
+                if self._eth_to_int(packet.src) not in hosts or \
+                        self._eth_to_int(packet.dst) not in hosts:
+                    stats['unroutable'] += 1
+                    continue
+                if event.dpid not in barriers:
+                    sw.send_barrier()  # After the entries, not before
+                    barriers.add(event.dpid)
+                sw.send_packet_table(event.port, event.data)
+                stats['resent'] += 1
+            else:
+                self._handle_packet(event, arrived)
+            replayed += 1
+        self.early_packets.stats['replayed'] += replayed
+        if events:
+            log.info("Replayed %i of %i early packet-ins" %
+                     (replayed, len(events)))
+
+    def _handle_BarrierIn(self, event):
+        pending = self.pending_xids.pop((event.dpid, event.xid), None)
+        if pending is None:
+            return
+        pending.xids.discard((event.dpid, event.xid))
+        is_setup = isinstance(pending, PendingSetup)
+        if is_setup and self.latency is not None:
+            self.latency.record('riplpox', 'barrier',
+                                time.time() - pending.sent, len(pending.route))
+        if pending.xids:
             return
+        if not is_setup:
+            self._reroute_done(pending)
         else:
-            if self.mode == 'reactive':
-                self._handle_packet_reactive(event)
-            elif self.mode == 'proactive':
-                self._handle_packet_proactive(event)
+            # Every switch on the route has the entry now.
+            self.pending_setups.pop(pending.key, None)
+            self.setup_stats['completed'] += 1
+            if self.latency is not None:
+                self._record_latency(pending)
 
     def _install_proactive_flows(self):
         t = self.t
         # Install L2 src/dst flow for every possible pair of hosts.
         hl = sorted(self._raw_dpids(t.hosts()))
-        hll = sorted(self._raw_dpids(t.hosts()))
-        for src in hl:
-            del hll[0]
-            for dst in hll:
-                self._install_proactive_path(src, dst)
+        pairs = [(src, dst) for i, src in enumerate(hl) for dst in hl[i + 1:]]
+        # Hash and route all pairs in one batch.
+        edge = dict((h, t.g[t.id_gen(dpid=h).name_str()].keys()[0])
+                    for h in hl)
+        hashes = src_dst_hashes([src for src, dst in pairs],
+                                [dst for src, dst in pairs])
+        routes = assign_paths(self.r, [(edge[src], edge[dst])
+                                       for src, dst in pairs], hashes)
+        for (src, dst), route in zip(pairs, routes):
+            self._install_proactive_path(src, dst, route)
+
+    def _install_fabric_flows(self):
+        """Install the proactive half of hybrid mode.
+
+        Edge switches get an entry per attached host.  Every other switch
+        gets entries per destination edge switch, matching the edge's
+        hosts by nw_dst prefix, along the route the routing engine picks
+        toward that edge.  That is O(switches x edges) entries, leaving
+        only the ingress edge entry to install per flow.  When sharded,
+        every shard computes all routes but installs only on its switches.
+        With compress_fabric, each switch instead gets the fewest prefix
+        entries that forward the same way.
+        """
+        t = self.t
+        edge_hosts = defaultdict(list)  # [edge switch] -> attached hosts
+        for h in t.hosts():
+            edge_hosts[t.g[h].keys()[0]].append(h)
+        tables = defaultdict(dict)  # [dpid] -> {host IP: out_port}
+        count = 0
+        for edge, hosts in edge_hosts.iteritems():
+            edge_dpid = t.id_gen(name=edge).dpid
+            sw = self.switches[edge_dpid]
+            addrs = []
+            for h in hosts:
+                ip = IPAddr(t.id_gen(name=h).ip_str())
+                addrs.append(ip.toUnsigned())
+                if self.compress_fabric:
+                    tables[edge_dpid][ip.toUnsigned()] = t.port(edge, h)[0]
+                    continue
+                if isinstance(sw, RemoteSwitch):
+                    continue
+                sw.install(t.port(edge, h)[0],
+                           of.ofp_match(dl_type=ethernet.IP_TYPE, nw_dst=ip))
+                count += 1
+            prefixes = ip_prefixes(addrs)
+            for node in t.switches():
+                if node in edge_hosts:
+                    continue
+                route = self.r.get_route(node, edge, edge_dpid)
+                if not route:
+                    continue
+                self.fabric_routes[(node, edge)] = route
+                out_port = t.port(node, route[1])[0]
+                node_dpid = t.id_gen(name=node).dpid
+                if self.compress_fabric:
+                    for addr in addrs:
+                        tables[node_dpid][addr] = out_port
+                    continue
+                sw = self.switches[node_dpid]
+                if isinstance(sw, RemoteSwitch):
+                    continue
+                for net, bits in prefixes:
+                    sw.install(out_port,
+                               of.ofp_match(dl_type=ethernet.IP_TYPE,
+                                            nw_dst=(IPAddr(net), bits)))
+                    count += 1
+        for dpid, table in tables.iteritems():
+            count += self._install_compressed(dpid, table)
+        log.info("Installed %i fabric entries" % count)
+
+    def _install_compressed(self, dpid, table):
+        "Install prefix entries forwarding like {IP: port}; return how many."
+        sw = self.switches[dpid]
+        if isinstance(sw, RemoteSwitch):
+            return 0
+        rules = compress(table)
+        for net, bits, out_port in rules:
+            if out_port is None:
+                out_port = of.OFPP_CONTROLLER  # As the table miss would
+            sw.install(out_port,
+                       of.ofp_match(dl_type=ethernet.IP_TYPE,
+                                    nw_dst=(IPAddr(net), bits)),
+                       priority=FABRIC_PRIORITY + bits)
+        log.debug("%s: %i fabric entries compressed to %i" %
+                  (sw, len(table), len(rules)))
+        return len(rules)
 
     def _handle_ConnectionUp(self, event):
         sw = self.switches.get(event.dpid)
@@ -336,6 +1049,10 @@ class RipLController(object):
         if name_str not in self.t.switches():
             log.warn("Ignoring unknown switch %s" % sw_str)
             return
+        if not self._owns(event.dpid):
+            log.warn("Ignoring switch %s, which shard %i owns" %
+                     (sw_str, shard_of(self.t, name_str, self.shards)))
+            return
         if sw is None:
             log.info("Added fresh switch %s" % sw_str)
             sw = Switch()
@@ -345,31 +1062,69 @@ class RipLController(object):
             log.info("Odd - already saw switch %s come up" % sw_str)
             sw.connect(event.connection)
         sw.connection.send(of.ofp_set_config(miss_send_len=MISS_SEND_LEN))
+        sw.request_reconcile()
+        if self.peers is not None:
+            self.peers.broadcast('switch_up', shard=self.shard,
+                                 dpid=event.dpid)
+        self._check_all_up()
+
+    def _handle_ConnectionDown(self, event):
+        if self.peers is not None and self._owns(event.dpid):
+            self.peers.broadcast('switch_down', dpid=event.dpid)
 
+    def _check_all_up(self):
         if len(self.switches) == len(self.t.switches()):
             log.info("Woo!  All switches up")
-            self.all_switches_up = True
             if self.mode == 'proactive':
                 # time.sleep(10)
                 self._install_proactive_flows()
+            elif self.mode == 'hybrid':
+                self._install_fabric_flows()
+            self.all_switches_up = True
+            self._replay_early_packets()
 
 
-def launch(topo=None, routing=None, mode=None):
+def launch(topo=None, routing=None, mode=None, poll_period=None,
+           stale_after=None, backup=False, queue_size=DEF_QUEUE_SIZE,
+           queue_age=DEF_QUEUE_AGE, workers=0, deadline=DEF_DEADLINE,
+           shard=0, shards=1, shard_port=DEF_BASE_PORT, compress=False):
     """
     Launch RipL-POX
 
     topo is in format toponame,arg1,arg2,...
-    routing is a routing type (e.g., st, random, hashed)
+    routing is a routing type (e.g., st, random, hashed, load)
     mode is a controller mode (e.g., proactive, reactive, hybrid)
+    poll_period is the port stats interval in seconds for load routing
+    stale_after is how long in seconds a link load estimate stays valid
+    backup pre-installs a link-disjoint backup route for every reactive flow
+    queue_size is how many packet-ins to hold per switch until all are up
+    queue_age is how long in seconds a held packet-in stays worth handling
+    workers is how many threads compute reactive routes (0: inline)
+    deadline is how long in seconds a worker may take before a fallback
+    shard is this process's number, of shards cooperating processes
+    shard_port is the messenger port of shard 0; shard i uses shard_port + i
+    compress packs each switch's hybrid fabric entries into fewer prefixes
     """
     if not mode:
         mode = DEF_MODE
+    shard, shards = int(shard), int(shards)
+    if not 0 <= shard < shards:
+        raise Exception("shard must be in 0..%i" % (shards - 1))
+    poll_period = float(poll_period) if poll_period else DEF_POLL_PERIOD
     # Instantiate a topo object from the passed-in file.
     if not topo:
         raise Exception("please specify topo and args on cmd line")
     else:
         t = buildTopo(topo, topos)
         r = getRouting(routing, t)
-    core.registerNew(RipLController, t, r, mode)
+    if hasattr(r, 'stale_after'):
+        if stale_after:
+            r.stale_after = float(stale_after)
+        else:
+            r.stale_after = 3 * poll_period
+    core.registerNew(RipLController, t, r, mode, poll_period,
+                     str_to_bool(backup), int(queue_size), float(queue_age),
+                     int(workers), float(deadline), shard, shards,
+                     int(shard_port), str_to_bool(compress))
 
     log.info("RipL-POX running with topo=%s." % topo)
@@ -0,0 +1,159 @@
+"""
+Route computation off the recoco thread for RipL-POX.
+
+Structured routing engines enumerate every candidate path per request,
+which can take long enough on large topologies to stall the cooperative
+loop that reads every OpenFlow socket.  RoutePool hands requests to worker
+threads instead.  Each worker has its own shallow copy of the routing
+object, because the engines keep per-search state on the instance.
+Results are passed back into the recoco thread with core.callLater.
+
+A request not answered within the deadline is answered with a shortest
+path from a breadth-first search of the topology.  The worker's late
+answer is then discarded.  The search crosses any node that forwards:
+every switch, including BCube's per-server relay switches, and any host
+linked to more than one switch.
+
+The workers are Python threads, so they hold the GIL while computing and
+contend with the recoco loop for it.  They keep a long computation from
+blocking the loop outright, but don't add CPU: the loop still slows while
+they run.
+
+pox.lib.threadpool is not used: it grows and shrinks its workers on
+demand, and a routing copy per worker needs a fixed set of threads.
+"""
+
+import copy
+import threading
+import time
+from collections import deque
+from Queue import Queue
+
+from pox.core import core
+from pox.lib.recoco import Timer
+
+log = core.getLogger()
+
+# Seconds a route request may take before the fallback path is used
+DEF_DEADLINE = 0.1
+
+
+def backup_route(r, route):
+    """Return a route sharing no links with route, or None.
+
+    Prefers routes that also avoid route's interior switches, so a
+    failure anywhere on the primary can be bypassed at the ingress.
+    """
+    if len(route) < 2:
+        return None
+    links = set(zip(route[:-1], route[1:]))
+    interior = set(route[1:-1])
+    backup = None
+    for path in r.get_routes(route[0], route[-1]):
+        if any(l in links for l in zip(path[:-1], path[1:])):
+            continue
+        if not interior.intersection(path[1:-1]):
+            return path
+        if backup is None:
+            backup = path
+    return backup
+
+
+class RouteRequest(object):
+    "One route computation and the callback waiting for its result."
+    def __init__(self, src, dst, hash_, backup, callback, deadline):
+        self.src = src
+        self.dst = dst
+        self.hash_ = hash_
+        self.backup = backup  # Also compute a backup route?
+        self.callback = callback  # Called as callback(route, backup)
+        self.deadline = deadline
+        self.done = False
+
+
+class RoutePool(object):
+    "Compute routes on worker threads, each with its own routing object."
+
+    def __init__(self, t, r, workers, deadline=DEF_DEADLINE):
+        self.t = t
+        self.r = r
+        self.deadline = deadline
+        # Hosts on one link can only end a path, never relay
+        self._leaves = set(h for h in t.hosts() if len(t.g[h]) == 1)
+        self._requests = Queue()
+        self._pending = deque()  # RouteRequests in deadline order
+        self.stats = {'submitted': 0, 'completed': 0, 'fallback': 0,
+                      'late': 0}
+        for i in xrange(workers):
+            worker = threading.Thread(target=self._work,
+                                      args=(copy.copy(r),))
+            worker.daemon = True
+            worker.start()
+        Timer(deadline / 2, self._check_deadlines, recurring=True)
+
+    def submit(self, src, dst, hash_, backup, callback):
+        "Compute a route from src to dst; call callback(route, backup)."
+        req = RouteRequest(src, dst, hash_, backup, callback,
+                           time.time() + self.deadline)
+        self._pending.append(req)
+        self._requests.put(req)
+        self.stats['submitted'] += 1
+
+    def _work(self, r):
+        while True:
+            req = self._requests.get()
+            if req.done:
+                continue  # Already answered with the fallback
+            # Pick up failures the recoco thread has seen since last time.
+            r.down_links = self.r.down_links
+            route = backup = None
+            try:
+                route = r.get_route(req.src, req.dst, req.hash_)
+                if route and req.backup:
+                    backup = backup_route(r, route)
+            except Exception:
+                log.exception("Route computation failed")
+            core.callLater(self._complete, req, route, backup)
+
+    def _complete(self, req, route, backup):
+        if req.done:
+            self.stats['late'] += 1
+            return
+        req.done = True
+        self.stats['completed'] += 1
+        if not route:
+            route = self.fallback_route(req.src, req.dst)
+        req.callback(route, backup)
+
+    def _check_deadlines(self):
+        now = time.time()
+        while self._pending and (self._pending[0].done or
+                                 self._pending[0].deadline <= now):
+            req = self._pending.popleft()
+            if req.done:
+                continue
+            req.done = True
+            self.stats['fallback'] += 1
+            req.callback(self.fallback_route(req.src, req.dst), None)
+
+    def fallback_route(self, src, dst):
+        "Return a shortest live path from src to dst, or None."
+        down = self.r.down_links
+        prev = {src: None}
+        frontier = deque([src])
+        while frontier:
+            node = frontier.popleft()
+            if node == dst:
+                route = []
+                while node is not None:
+                    route.append(node)
+                    node = prev[node]
+                route.reverse()
+                return route
+            for nbr in sorted(self.t.g[node].keys()):
+                if nbr in prev or nbr in self._leaves or \
+                        (node, nbr) in down:
+                    continue
+                prev[nbr] = node
+                frontier.append(nbr)
+        return None
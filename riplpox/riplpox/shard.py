@@ -0,0 +1,258 @@
+"""
+Sharded RipL-POX: several controller processes, each owning some switches.
+
+Switches are split between shards by fat-tree pod, so most reactive
+routes stay within the pod of the shard that sees the packet-in.  Core
+switches are dealt out round-robin.  Other topologies are split by
+switch index.
+
+Shards talk over pox.messenger TCP connections, on channel CHANNEL.
+Each shard listens on base_port + shard and connects to every shard
+numbered below it, so there is one connection per pair.  A switch
+another shard owns appears in RipLController.switches as a RemoteSwitch,
+which has the same install/remove/barrier/packet_out methods as a local
+Switch.  Its flow_mods are relayed to the owner, and barrier replies come
+back as if the switch had answered directly.  The flow setup and failover
+code therefore works on remote switches unchanged.
+"""
+
+import time
+from base64 import b64encode, b64decode
+
+from pox.core import core
+import pox.openflow.libopenflow_01 as of
+from pox.messenger import ChannelBot, MessengerNexus
+from pox.messenger.tcp_transport import TCPTransport, ActiveTCPTransport
+
+from flowdb import SwitchTable
+
+log = core.getLogger()
+
+CHANNEL = 'riplpox_shard'
+
+# Shard i's messenger listens on DEF_BASE_PORT + i
+DEF_BASE_PORT = 7790
+
+
+def shard_of(t, name, shards):
+    "Return the shard that owns switch name."
+    if shards == 1:
+        return 0
+    node = t.id_gen(name=name)
+    if hasattr(t, 'numPods') and hasattr(node, 'type'):
+        if node.type == t.LAYER_CORE:
+            return (node.ids - 1) % shards
+        # Pods are numbered consecutively after the core switches, each
+        # holding k/2 aggregation then k/2 edge switches.
+        n_core = len(t.layer_nodes(t.LAYER_CORE))
+        return ((node.ids - n_core - 1) // t.k) % shards
+    return sorted(t.switches()).index(name) % shards
+
+
+def pack_match(match):
+    return b64encode(match.pack())
+
+
+def unpack_match(data):
+    match = of.ofp_match()
+    match.unpack(b64decode(data))
+    return match
+
+
+class BarrierReply(object):
+    "Stands in for a BarrierIn event relayed from the owning shard."
+    def __init__(self, dpid, xid):
+        self.dpid = dpid
+        self.xid = xid
+
+
+class RemoteSwitch(object):
+    "A switch owned by another shard, driven through that shard."
+
+    def __init__(self, peers, shard, dpid):
+        self.peers = peers
+        self.shard = shard
+        self.dpid = dpid
+        self.up = True
+        self.table = SwitchTable()  # Entries we asked the owner to install
+
+    def __repr__(self):
+        return core.RipLController.t.id_gen(dpid=self.dpid).name_str()
+
+    @property
+    def connection(self):
+        "The messenger connection to the owner, or None while unusable."
+        if not self.up:
+            return None
+        return self.peers.connection(self.shard)
+
+    def _send(self, cmd, **kw):
+        kw['dpid'] = self.dpid
+        self.peers.send(self.shard, cmd, **kw)
+
+    def send_packet_data(self, outport, data=None):
+        self._send('packet_out', port=outport, data=b64encode(data))
+
+    def install(self, port, match, buf=None, idle_timeout=0, hard_timeout=0,
+                priority=of.OFP_DEFAULT_PRIORITY, command=of.OFPFC_ADD):
+        # buf is ignored; buffer ids are only meaningful to the owner.
+        self._send('flow_mod', port=port, match=pack_match(match),
+                   idle_timeout=idle_timeout, hard_timeout=hard_timeout,
+                   priority=priority, command=command)
+        msg = of.ofp_flow_mod(command=command, match=match,
+                              idle_timeout=idle_timeout,
+                              hard_timeout=hard_timeout, priority=priority)
+        msg.actions.append(of.ofp_action_output(port=port))
+        self.table.add_flow_mod(msg)
+
+    def remove(self, match, priority=of.OFP_DEFAULT_PRIORITY):
+        "Delete the entry with exactly this match and priority."
+        self._send('flow_mod', match=pack_match(match), priority=priority,
+                   command=of.OFPFC_DELETE_STRICT)
+        self.table.remove(match, priority)
+
+    def send_barrier(self):
+        "Ask the owner for a barrier; its reply arrives as a BarrierReply."
+        xid = of.generate_xid()
+        self._send('barrier', xid=xid)
+        return xid
+
+    def request_reconcile(self):
+        pass  # The owner reconciles its switches' tables itself
+
+
+class ShardPeers(ChannelBot):
+    """Connections to the other shards and the RPCs between them.
+
+    Requests carry a dpid the receiver owns.  Replies to barriers go back
+    on the connection the request came in on.
+    """
+
+    def _init(self, extra):
+        self.controller = extra['controller']
+        self.shard = extra['shard']
+        self.shards = extra['shards']
+        self.cons = {}  # [shard] -> set of connections
+        self.relayed = {}  # [(dpid, our xid)] -> (connection, peer's xid)
+        self.stats = {'sent': 0, 'received': 0}
+        self._nexus.addListenerByName("ConnectionOpened",
+                                      self._handle_ConnectionOpened)
+        core.openflow.addListenerByName("BarrierIn", self._handle_BarrierIn)
+
+    def connection(self, shard):
+        for con in self.cons.get(shard, ()):
+            if con.is_connected:
+                return con
+        return None
+
+    def send(self, shard, cmd, **kw):
+        con = self.connection(shard)
+        if con is None:
+            log.warn("No connection to shard %i; dropped %s" % (shard, cmd))
+            return
+        kw['CHANNEL'] = CHANNEL
+        kw['cmd'] = cmd
+        con.send(kw)
+        self.stats['sent'] += 1
+
+    def broadcast(self, cmd, **kw):
+        for shard in self.cons:
+            self.send(shard, cmd, **kw)
+
+    def _handle_ConnectionOpened(self, event):
+        con = event.con
+        con.send({'CHANNEL': CHANNEL, 'cmd': 'hello', 'shard': self.shard,
+                  'switches': self.controller.local_dpids()})
+
+    def _handle_BarrierIn(self, event):
+        relayed = self.relayed.pop((event.dpid, event.xid), None)
+        if relayed is None:
+            return
+        con, xid = relayed
+        con.send({'CHANNEL': CHANNEL, 'cmd': 'barrier_reply',
+                  'shard': self.shard, 'dpid': event.dpid, 'xid': xid})
+        self.stats['sent'] += 1
+
+    def _local(self, event):
+        "Return the local Switch a request is for, or None."
+        self.stats['received'] += 1
+        sw = self.controller.switches.get(event.msg['dpid'])
+        if sw is None or isinstance(sw, RemoteSwitch) or \
+                sw.connection is None:
+            log.warn("Request for switch %s, which is not up here" %
+                     event.msg['dpid'])
+            return None
+        return sw
+
+    def _exec_cmd_hello(self, event):
+        msg = event.msg
+        shard = msg['shard']
+        con = event.con
+        if con not in self.cons.setdefault(shard, set()):
+            self.cons[shard].add(con)
+            con.addListenerByName("ConnectionClosed",
+                                  lambda e: self._closed(shard, con))
+            log.info("Connected to shard %i" % shard)
+        for dpid in msg['switches']:
+            self.controller.remote_switch_up(shard, dpid)
+
+    def _closed(self, shard, con):
+        self.cons[shard].discard(con)
+        if self.connection(shard) is None:
+            log.warn("Lost shard %i" % shard)
+
+    def _exec_cmd_switch_up(self, event):
+        self.controller.remote_switch_up(event.msg['shard'],
+                                         event.msg['dpid'])
+
+    def _exec_cmd_switch_down(self, event):
+        self.controller.remote_switch_down(event.msg['dpid'])
+
+    def _exec_cmd_flow_mod(self, event):
+        sw = self._local(event)
+        if sw is None:
+            return
+        msg = event.msg
+        match = unpack_match(msg['match'])
+        if msg['command'] == of.OFPFC_DELETE_STRICT:
+            sw.remove(match, msg['priority'])
+        else:
+            sw.install(msg['port'], match, idle_timeout=msg['idle_timeout'],
+                       hard_timeout=msg['hard_timeout'],
+                       priority=msg['priority'], command=msg['command'])
+
+    def _exec_cmd_barrier(self, event):
+        sw = self._local(event)
+        if sw is None:
+            return
+        xid = sw.send_barrier()
+        self.relayed[(sw.dpid, xid)] = (event.con, event.msg['xid'])
+
+    def _exec_cmd_barrier_reply(self, event):
+        self.controller._handle_BarrierIn(
+            BarrierReply(event.msg['dpid'], event.msg['xid']))
+
+    def _exec_cmd_packet_out(self, event):
+        sw = self._local(event)
+        if sw is not None:
+            sw.send_packet_data(event.msg['port'],
+                                b64decode(event.msg['data']))
+
+    def _exec_cmd_link_down(self, event):
+        self.controller._link_down(tuple(event.msg['link']), time.time())
+
+    def _exec_cmd_link_up(self, event):
+        self.controller._link_up(tuple(event.msg['link']))
+
+
+def start_peers(controller, shard, shards, base_port=DEF_BASE_PORT,
+                address='127.0.0.1'):
+    "Listen for the other shards, connect to lower ones; return ShardPeers."
+    if not core.hasComponent("MessengerNexus"):
+        core.registerNew(MessengerNexus)
+    peers = ShardPeers(CHANNEL, extra={'controller': controller,
+                                       'shard': shard, 'shards': shards})
+    TCPTransport(port=base_port + shard).start()
+    for other in xrange(shard):
+        ActiveTCPTransport(address, base_port + other).start()
+    return peers
@@ -0,0 +1,236 @@
+"""
+Shared switch statistics service for RipL-POX.
+
+Components that need port or flow counters register what they want with
+watch() and read rates from the cache instead of sending their own stats
+requests.  The service:
+
+- staggers requests so switches are not all polled at once,
+- shortens a switch's poll interval while its rates are changing and
+  lengthens it while they are steady,
+- never sends more than `budget` stats requests per second in total.
+
+Multi-part replies are merged by the OpenFlow connection
+(Connection._incoming_stats_reply) before FlowStatsReceived and
+PortStatsReceived fire, so each event here is one complete reply.
+
+Other components get the service with get_stats_service(); it is
+registered on demand as core.SwitchStats.  To tune it, launch it
+explicitly before the components that use it:
+
+  ./pox.py riplpox.stats --budget=20 --min_interval=0.5 riplpox.riplpox ...
+"""
+
+import heapq
+import time
+
+from pox.core import core
+from pox.lib.revent import Event, EventMixin
+from pox.lib.recoco import Timer
+import pox.openflow.libopenflow_01 as of
+
+log = core.getLogger()
+
+PORT = 'port'
+FLOW = 'flow'
+
+# Bounds in seconds for adaptive per-switch poll intervals
+DEF_MIN_INTERVAL = 1
+DEF_MAX_INTERVAL = 10
+
+# Maximum stats requests per second across all switches
+DEF_BUDGET = 50
+
+# Relative rate change above which a switch is polled more often
+CHANGE_THRESHOLD = 0.2
+
+# Seconds between scheduler ticks
+TICK = 0.1
+
+
+class StatsUpdated(Event):
+    "Fired when fresh counters for a switch are in the cache."
+    def __init__(self, dpid, kind):
+        self.dpid = dpid
+        self.kind = kind  # PORT or FLOW
+
+
+class _Watch(object):
+    "Polling state for one (dpid, kind)."
+    def __init__(self, dpid, kind, interval, max_interval):
+        self.dpid = dpid
+        self.kind = kind
+        self.interval = interval
+        self.max_interval = max_interval
+        self.next_due = None
+        self.last_total = None  # Aggregate rate at the previous reply
+
+
+class StatsService(EventMixin):
+    "Cache switch counters and rates, polling within a request budget."
+
+    _eventMixin_events = set([StatsUpdated])
+
+    def __init__(self, min_interval=DEF_MIN_INTERVAL,
+                 max_interval=DEF_MAX_INTERVAL, budget=DEF_BUDGET):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self._watches = {}  # [(dpid, kind)] -> _Watch
+        self._due = []  # heap of (next_due, dpid, kind)
+        self._tokens = float(budget)
+        self._last_tick = time.time()
+
+        self.port_counters = {}  # [dpid][port_no] -> (ofp_port_stats, time)
+        self.port_rates = {}  # [dpid][port_no] -> (tx B/s, rx B/s, time)
+        self.flow_rates = {}  # [dpid] -> [(match, B/s, byte_count, time)]
+        self._prev_flows = {}  # [dpid] -> {match key: (byte_count, time)}
+        self.stats = {'requests': 0, 'replies': 0, 'deferred': 0}
+
+        core.openflow.addListeners(self)
+        Timer(TICK, self._tick, recurring=True)
+
+    def watch(self, dpid, kind, interval=None, max_interval=None):
+        """Start polling kind (PORT or FLOW) counters on dpid.
+
+        interval is the initial poll interval; max_interval caps how far
+        the interval may grow while rates are steady.  Watching the same
+        switch twice keeps the shorter of the two settings.
+        """
+        if interval is None:
+            interval = self.min_interval
+        interval = max(interval, self.min_interval)
+        if max_interval is None:
+            max_interval = self.max_interval
+        max_interval = max(max_interval, interval)
+        w = self._watches.get((dpid, kind))
+        if w is not None:
+            w.interval = min(w.interval, interval)
+            w.max_interval = min(w.max_interval, max_interval)
+            return
+        w = _Watch(dpid, kind, interval, max_interval)
+        # Spread first polls over one interval so switches don't align.
+        offset = (hash((dpid, kind)) % 1000) / 1000.0
+        w.next_due = time.time() + offset * interval
+        self._watches[(dpid, kind)] = w
+        heapq.heappush(self._due, (w.next_due, dpid, kind))
+
+    def port_rate(self, dpid, port_no):
+        "Return (tx B/s, rx B/s, timestamp) for a port, or None."
+        return self.port_rates.get(dpid, {}).get(port_no)
+
+    def request_rate(self):
+        "Return the request rate the current intervals would need."
+        return sum(1.0 / w.interval for w in self._watches.itervalues())
+
+    def _tick(self):
+        now = time.time()
+        self._tokens = min(float(self.budget), self._tokens +
+                           (now - self._last_tick) * self.budget)
+        self._last_tick = now
+        while self._due and self._due[0][0] <= now:
+            if self._tokens < 1:
+                self.stats['deferred'] += 1
+                break
+            due, dpid, kind = heapq.heappop(self._due)
+            w = self._watches.get((dpid, kind))
+            if w is None or w.next_due != due:
+                continue  # Superseded entry
+            w.next_due = now + w.interval
+            heapq.heappush(self._due, (w.next_due, dpid, kind))
+            con = core.openflow.getConnection(dpid)
+            if con is None:
+                continue
+            if kind == PORT:
+                body = of.ofp_port_stats_request()
+            else:
+                body = of.ofp_flow_stats_request()
+            con.send(of.ofp_stats_request(body=body))
+            self._tokens -= 1
+            self.stats['requests'] += 1
+
+    def _adapt(self, w, total):
+        "Poll faster while the aggregate rate moves, slower while steady."
+        last = w.last_total
+        w.last_total = total
+        if last is None:
+            return
+        change = abs(total - last) / max(last, 1000.0)
+        if change > CHANGE_THRESHOLD:
+            w.interval = max(self.min_interval, w.interval / 2.0)
+        else:
+            w.interval = min(w.max_interval, w.interval * 1.5)
+
+    def _handle_PortStatsReceived(self, event):
+        now = time.time()
+        counters = self.port_counters.setdefault(event.dpid, {})
+        rates = self.port_rates.setdefault(event.dpid, {})
+        total = 0.0
+        for stat in event.stats:
+            prev = counters.get(stat.port_no)
+            counters[stat.port_no] = (stat, now)
+            if prev is None:
+                continue
+            pstat, ptime = prev
+            if now <= ptime or stat.tx_bytes < pstat.tx_bytes \
+                    or stat.rx_bytes < pstat.rx_bytes:
+                continue  # Counter reset
+            tx = (stat.tx_bytes - pstat.tx_bytes) / (now - ptime)
+            rx = (stat.rx_bytes - pstat.rx_bytes) / (now - ptime)
+            rates[stat.port_no] = (tx, rx, now)
+            total += tx
+        self._replied(event.dpid, PORT, total)
+
+    def _handle_FlowStatsReceived(self, event):
+        now = time.time()
+        prev = self._prev_flows.get(event.dpid, {})
+        cur = {}
+        rates = []
+        total = 0.0
+        for stat in event.stats:
+            key = (stat.match.pack(), stat.priority)
+            cur[key] = (stat.byte_count, now)
+            p = prev.get(key)
+            rate = 0.0
+            if p is not None and now > p[1] and stat.byte_count >= p[0]:
+                rate = (stat.byte_count - p[0]) / (now - p[1])
+            rates.append((stat.match, rate, stat.byte_count, now))
+            total += rate
+        self._prev_flows[event.dpid] = cur
+        self.flow_rates[event.dpid] = rates
+        self._replied(event.dpid, FLOW, total)
+
+    def _replied(self, dpid, kind, total):
+        self.stats['replies'] += 1
+        w = self._watches.get((dpid, kind))
+        if w is not None:
+            self._adapt(w, total)
+        self.raiseEventNoErrors(StatsUpdated, dpid, kind)
+
+    def _handle_ConnectionDown(self, event):
+        # Counters restart from zero when the switch comes back.
+        self.port_counters.pop(event.dpid, None)
+        self.port_rates.pop(event.dpid, None)
+        self.flow_rates.pop(event.dpid, None)
+        self._prev_flows.pop(event.dpid, None)
+
+
+def get_stats_service():
+    "Return core.SwitchStats, registering it with defaults if needed."
+    if not core.hasComponent("SwitchStats"):
+        core.register("SwitchStats", StatsService())
+    return core.SwitchStats
+
+
+def launch(min_interval=DEF_MIN_INTERVAL, max_interval=DEF_MAX_INTERVAL,
+           budget=DEF_BUDGET):
+    """
+    Launch the statistics service
+
+    min_interval and max_interval bound per-switch poll intervals (seconds)
+    budget is the maximum number of stats requests per second
+    """
+    service = get_stats_service()
+    service.min_interval = float(min_interval)
+    service.max_interval = float(max_interval)
+    service.budget = float(budget)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+'''Test ORTC table compression and its verifier.'''
+
+import random
+import unittest
+
+from ripl.dctopo import FatTreeTopo
+from ripl.routing import HashedStructuredRouting
+from riplpox.compress import compress, verify, forwarding_tables, report
+
+
+class testCompress(unittest.TestCase):
+    '''compress() finds the fewest equivalent prefix rules.'''
+
+    def testAlignedBlock(self):
+        '''Four addresses on one port make one /30.'''
+        table = dict((a, 1) for a in xrange(8, 12))
+        self.assertEqual(compress(table), [(8, 30, 1)])
+
+    def testMissInsideBlock(self):
+        '''An address missing from a block takes a rule of its own.'''
+        table = {8: 1, 9: 1, 10: 1}
+        rules = compress(table)
+        self.assertEqual(len(rules), 2)
+        self.assertEqual(verify(table, rules), [])
+        self.assertEqual(compress(table, dont_care=True), [(0, 0, 1)])
+
+    def testDefaultPort(self):
+        '''The most common port covers the rest with the shortest prefix.'''
+        table = {0: 1, 1: 2, 2: 1, 3: 1}
+        rules = compress(table, dont_care=True)
+        self.assertEqual(sorted(rules), [(0, 0, 1), (1, 32, 2)])
+
+    def testEmpty(self):
+        self.assertEqual(compress({}), [])
+        self.assertEqual(verify({}, []), [])
+
+    def testRandomTables(self):
+        '''Compressed random tables are equivalent and never larger.'''
+        rng = random.Random(3)
+        for _ in xrange(50):
+            base = rng.getrandbits(32) & ~0xff
+            table = dict((base + rng.randrange(256), rng.randrange(1, 5))
+                         for _ in xrange(rng.randrange(1, 64)))
+            for dont_care in (False, True):
+                rules = compress(table, dont_care)
+                self.assertEqual(verify(table, rules, dont_care), [])
+                self.assertTrue(len(rules) <= len(table) + 1)
+
+
+class testVerify(unittest.TestCase):
+    '''verify() finds every address forwarded differently.'''
+
+    def testWrongPort(self):
+        table = dict((a, 1) for a in xrange(8, 12))
+        self.assertEqual(verify(table, [(8, 30, 2)]), [8, 9, 10, 11])
+
+    def testMissingRule(self):
+        table = {8: 1, 9: 1, 10: 2}
+        self.assertEqual(verify(table, [(8, 31, 1)]), [10])
+
+    def testExtraAddress(self):
+        '''A broader rule forwards addresses the table misses.'''
+        table = {8: 1, 9: 1, 10: 1}
+        self.assertEqual(verify(table, [(8, 30, 1)]), [11])
+        self.assertEqual(verify(table, [(8, 30, 1)], dont_care=True), [])
+
+    def testLongerPrefixWins(self):
+        table = {8: 1, 9: 1, 10: 1}
+        self.assertEqual(verify(table, [(8, 30, 1), (11, 32, None)]), [])
+
+
+class testForwardingTables(unittest.TestCase):
+    '''forwarding_tables() gives hybrid mode's tables on a fat tree.'''
+
+    def setUp(self):
+        self.topo = FatTreeTopo(4, 1)
+        self.tables = forwarding_tables(self.topo,
+                                        HashedStructuredRouting(self.topo))
+
+    def testEdgeOnlyOwnHosts(self):
+        '''Edge switches have no transit entries.'''
+        for edge in self.topo.layer_nodes(FatTreeTopo.LAYER_EDGE):
+            hosts = [h for h in self.topo.g[edge] if h in self.topo.hosts()]
+            self.assertEqual(len(self.tables[edge]), len(hosts))
+            for port in self.tables[edge].itervalues():
+                self.assertTrue(self.topo.ports[edge][port][0] in hosts)
+
+    def testFabricReachesEveryHost(self):
+        n = len(self.topo.hosts())
+        for sw in self.topo.switches():
+            if self.topo.layer(sw) != FatTreeTopo.LAYER_EDGE:
+                self.assertEqual(len(self.tables[sw]), n)
+
+    def testReport(self):
+        counts = report(self.tables)
+        self.assertEqual(len(counts), len(self.topo.switches()))
+        for sw, before, after in counts:
+            self.assertTrue(after <= before + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+'''Test that batched ECMP hashing and routing match the per-flow versions.'''
+
+import random
+import unittest
+
+from ripl.dctopo import FatTreeTopo, BCubeTopo
+from ripl.routing import HashedStructuredRouting
+import riplpox.ecmp as ecmp
+
+
+def random_flows(rng, n):
+    '''Return n random 5-tuples, as (src IP, dst IP, proto, sport, dport).'''
+    return [(rng.getrandbits(32), rng.getrandbits(32),
+             rng.choice((6, 17, 253)), rng.getrandbits(16),
+             rng.getrandbits(16)) for _ in xrange(n)]
+
+
+class BatchTest(unittest.TestCase):
+    '''Base: runs each test with and without NumPy.'''
+
+    def setUp(self):
+        self._numpy = ecmp.numpy
+        self.rng = random.Random(1)
+
+    def tearDown(self):
+        ecmp.numpy = self._numpy
+
+    def both(self, check):
+        '''Call check() with NumPy, if installed, then without it.'''
+        check()
+        ecmp.numpy = None
+        check()
+
+
+class testBatchHashes(BatchTest):
+    '''The batch hashes equal the reference hash of each flow.'''
+
+    def testEcmpHashes(self):
+        flows = random_flows(self.rng, 200)
+
+        def check():
+            self.assertEqual(ecmp.ecmp_hashes(*zip(*flows)),
+                             [ecmp.ecmp_hash(*f) for f in flows])
+        self.both(check)
+
+    def testSrcDstHashes(self):
+        pairs = [(self.rng.getrandbits(48), self.rng.getrandbits(48))
+                 for _ in xrange(200)]
+
+        def check():
+            self.assertEqual(ecmp.src_dst_hashes(*zip(*pairs)),
+                             [ecmp.src_dst_hash(s, d) for s, d in pairs])
+        self.both(check)
+
+    def testEmpty(self):
+        self.both(lambda: self.assertEqual(ecmp.ecmp_hashes([], [], [], [],
+                                                            []), []))
+
+
+class AssignPathsTest(BatchTest):
+    '''Base: assign_paths() routes every flow as get_route() does.'''
+
+    def check_routes(self, topo, nodes):
+        r = HashedStructuredRouting(topo)
+        nodes = sorted(nodes)
+        pairs = [(self.rng.choice(nodes), self.rng.choice(nodes))
+                 for _ in xrange(300)]
+        hashes = [ecmp.ecmp_hash(*f) for f in random_flows(self.rng, 300)]
+
+        def check():
+            self.assertEqual(ecmp.assign_paths(r, pairs, hashes),
+                             [r.get_route(src, dst, h) for (src, dst), h in
+                              zip(pairs, hashes)])
+        self.both(check)
+        return ecmp.assign_paths(r, pairs, hashes)
+
+
+class testAssignPathsFatTree(AssignPathsTest):
+    '''Test assign_paths() on fat trees.'''
+
+    def edges(self, topo):
+        return topo.layer_nodes(FatTreeTopo.LAYER_EDGE)
+
+    def testFatTree4(self):
+        topo = FatTreeTopo(4, 1)
+        routes = self.check_routes(topo, self.edges(topo))
+        self.assertFalse(None in routes)
+
+    def testFatTree6(self):
+        topo = FatTreeTopo(6, 1)
+        self.check_routes(topo, self.edges(topo))
+
+    def testAllSwitches(self):
+        topo = FatTreeTopo(4, 1)
+        self.check_routes(topo, topo.switches())
+
+    def testProactivePairs(self):
+        '''Host pairs hashed by dpid, as proactive mode routes them.'''
+        topo = FatTreeTopo(4, 1)
+        r = HashedStructuredRouting(topo)
+        hosts = sorted(topo.hosts())
+        edge = dict((h, topo.g[h].keys()[0]) for h in hosts)
+        dpid = dict((h, topo.id_gen(name=h).dpid) for h in hosts)
+        pairs = [(s, d) for s in hosts for d in hosts if s != d]
+
+        def check():
+            hashes = ecmp.src_dst_hashes([dpid[s] for s, d in pairs],
+                                         [dpid[d] for s, d in pairs])
+            edges = [(edge[s], edge[d]) for s, d in pairs]
+            self.assertEqual(ecmp.assign_paths(r, edges, hashes),
+                             [r.get_route(src, dst, h) for (src, dst), h in
+                              zip(edges, hashes)])
+        self.both(check)
+
+
+class testAssignPathsBCube(AssignPathsTest):
+    '''Test assign_paths() on BCubes.'''
+
+    def testBCube14(self):
+        topo = BCubeTopo(1, 4)
+        self.check_routes(topo, topo.switches())
+
+    def testBCube23(self):
+        topo = BCubeTopo(2, 3)
+        self.check_routes(topo, topo.switches())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+'''Test that switch tables follow FlowRemoved messages and stats dumps.'''
+
+import unittest
+
+from pox.lib.addresses import EthAddr, IPAddr
+import pox.openflow.libopenflow_01 as of
+
+from riplpox.flowdb import SwitchTable, entry_key
+import riplpox.riplpox as riplpox
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+class FakeFlowRemoved(object):
+    '''A FlowRemoved event for msg, as its match comes back on the wire.'''
+
+    def __init__(self, msg, reason=of.OFPRR_IDLE_TIMEOUT):
+        match = of.ofp_match()
+        match.unpack(msg.match.pack())
+        self.ofp = of.ofp_flow_removed(match=match, priority=msg.priority,
+                                       reason=reason)
+        self.idleTimeout = self.timeout = reason == of.OFPRR_IDLE_TIMEOUT
+
+
+def flow_match(i):
+    return of.ofp_match(dl_type=0x800, dl_src=EthAddr('%012x' % i),
+                        dl_dst=EthAddr('%012x' % (i + 1)),
+                        nw_src=IPAddr(i), nw_dst=IPAddr(i + 1), nw_proto=6,
+                        tp_src=i, tp_dst=80)
+
+
+class testFlowRemoved(unittest.TestCase):
+    '''A switch's table drops exactly the entries the switch removes.'''
+
+    def setUp(self):
+        self.sw = riplpox.Switch()
+        self.sw.dpid = 1
+        self.sw.connection = FakeConnection()
+
+    def removed(self, msg, reason=of.OFPRR_IDLE_TIMEOUT):
+        self.sw._handle_FlowRemoved(FakeFlowRemoved(msg, reason))
+
+    def testInstallRequestsFlowRemoved(self):
+        self.sw.install(2, flow_match(1))
+        self.assertTrue(self.sw.connection.sent[0].flags &
+                        of.OFPFF_SEND_FLOW_REM)
+
+    def testRemovedEntryForgotten(self):
+        for i in xrange(1, 6):
+            self.sw.install(i % 2 + 1, flow_match(i))
+        table = self.sw.table
+        self.assertEqual(len(table), 5)
+        msgs = self.sw.connection.sent
+        self.removed(msgs[0])
+        self.removed(msgs[3], of.OFPRR_HARD_TIMEOUT)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.get(flow_match(1)), None)
+        self.assertNotEqual(table.get(flow_match(2)), None)
+        self.assertEqual(table.stats['removed'], 2)
+        # The port index follows
+        self.assertEqual(sorted(e.match.tp_src
+                                for e in table.entries_to_port(2)), [3, 5])
+        self.assertEqual(sorted(e.match.tp_src
+                                for e in table.entries_to_port(1)), [2])
+
+    def testPrioritiesKeptApart(self):
+        '''Removing a primary entry leaves the backup with its match.'''
+        match = flow_match(1)
+        self.sw.install(1, match)
+        self.sw.install(2, match, priority=riplpox.BACKUP_PRIORITY)
+        self.removed(self.sw.connection.sent[0])
+        self.assertEqual(len(self.sw.table), 1)
+        entry = self.sw.table.get(match, riplpox.BACKUP_PRIORITY)
+        self.assertEqual(entry.actions[0].port, 2)
+
+    def testPrefixMatch(self):
+        match = of.ofp_match(dl_type=0x800,
+                             nw_dst=(IPAddr('10.2.0.0'), 16))
+        self.sw.install(3, match, priority=riplpox.FABRIC_PRIORITY + 16)
+        self.removed(self.sw.connection.sent[0], of.OFPRR_DELETE)
+        self.assertEqual(len(self.sw.table), 0)
+
+    def testModifyReplaces(self):
+        '''A MODIFY_STRICT leaves one entry, with the new port.'''
+        match = flow_match(1)
+        self.sw.install(1, match)
+        self.sw.install(2, match, command=of.OFPFC_MODIFY_STRICT)
+        self.assertEqual(len(self.sw.table), 1)
+        self.assertEqual(self.sw.table.entries_to_port(1), [])
+        self.removed(self.sw.connection.sent[1])
+        self.assertEqual(len(self.sw.table), 0)
+        self.assertEqual(self.sw.table.by_port, {})
+
+    def testUnknownEntry(self):
+        '''Removals of entries never recorded change nothing.'''
+        self.sw.install(1, flow_match(1))
+        other = of.ofp_flow_mod(match=flow_match(2))
+        self.removed(other)
+        self.assertEqual(len(self.sw.table), 1)
+        self.assertEqual(self.sw.table.stats['removed'], 0)
+
+    def testRemoveSendsDeleteStrict(self):
+        match = flow_match(1)
+        self.sw.install(1, match, priority=riplpox.BACKUP_PRIORITY)
+        self.sw.remove(match, riplpox.BACKUP_PRIORITY)
+        msg = self.sw.connection.sent[-1]
+        self.assertEqual(msg.command, of.OFPFC_DELETE_STRICT)
+        self.assertEqual(len(self.sw.table), 0)
+        # The switch's own report of the delete finds nothing left
+        self.removed(msg, of.OFPRR_DELETE)
+        self.assertEqual(self.sw.table.stats['removed'], 1)
+
+
+class testReconcile(unittest.TestCase):
+    '''A flow stats dump brings the table back in line with the switch.'''
+
+    def stat(self, match, port, priority=of.OFP_DEFAULT_PRIORITY):
+        return of.ofp_flow_stats(match=match, priority=priority,
+                                 actions=[of.ofp_action_output(port=port)],
+                                 byte_count=100)
+
+    def testMissingAndUnknown(self):
+        table = SwitchTable()
+        for i in (1, 2):
+            table.add_flow_mod(of.ofp_flow_mod(
+                match=flow_match(i), action=of.ofp_action_output(port=i)))
+        missing, unknown = table.reconcile([self.stat(flow_match(2), 2),
+                                            self.stat(flow_match(3), 3)])
+        self.assertEqual([e.match.tp_src for e in missing], [1])
+        self.assertEqual([e.match.tp_src for e in unknown], [3])
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.get(flow_match(2)).byte_count, 100)
+        self.assertEqual(table.entries_to_port(1), [])
+        self.assertEqual(len(table.entries_to_port(3)), 1)
+
+    def testNewerEntriesKept(self):
+        '''Entries added after the dump was requested aren't in it.'''
+        table = SwitchTable()
+        msg = of.ofp_flow_mod(match=flow_match(1),
+                              action=of.ofp_action_output(port=1))
+        table.add_flow_mod(msg)
+        since = table.get(flow_match(1)).created
+        missing, unknown = table.reconcile([], since)
+        self.assertEqual(missing, [])
+        self.assertEqual(len(table), 1)
+        missing, unknown = table.reconcile([], since + 1)
+        self.assertEqual(len(missing), 1)
+        self.assertEqual(len(table), 0)
+
+    def testKeyIgnoresWireRoundTrip(self):
+        match = flow_match(7)
+        echoed = of.ofp_match()
+        echoed.unpack(match.pack())
+        self.assertEqual(entry_key(match), entry_key(echoed))
+
+
+if __name__ == '__main__':
+    unittest.main()
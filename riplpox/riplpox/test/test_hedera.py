@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''Test Hedera demand estimation.'''
+
+import random
+import unittest
+from collections import defaultdict
+
+from riplpox.hedera import estimate_demands
+
+
+class testEstimateDemands(unittest.TestCase):
+    '''Flows get the max-min fair rate their NICs allow.'''
+
+    def assertDemands(self, flows, expected):
+        demands = estimate_demands(flows)
+        self.assertEqual(len(demands), len(expected))
+        for got, want in zip(demands, expected):
+            self.assertAlmostEqual(got, want)
+
+    def testSingleFlow(self):
+        self.assertDemands([('a', 'b')], [1.0])
+
+    def testEmpty(self):
+        self.assertEqual(estimate_demands([]), [])
+
+    def testSenderLimited(self):
+        '''One sender splits its NIC evenly.'''
+        self.assertDemands([('a', 'b'), ('a', 'c'), ('a', 'd')],
+                           [1 / 3.0] * 3)
+
+    def testIncast(self):
+        '''Many senders to one receiver split the receiver's NIC.'''
+        self.assertDemands([(s, 'z') for s in 'abcd'], [0.25] * 4)
+
+    def testParallelFlows(self):
+        '''Flows between the same hosts are counted separately.'''
+        self.assertDemands([('a', 'b'), ('a', 'b')], [0.5, 0.5])
+
+    def testReceiverFreesSender(self):
+        '''A flow capped at its receiver leaves the rest to its sibling.'''
+        self.assertDemands([('a', 'x'), ('a', 'y'), ('b', 'y'), ('c', 'y')],
+                           [2 / 3.0, 1 / 3.0, 1 / 3.0, 1 / 3.0])
+
+    def testSmallFlowKeepsItsRate(self):
+        '''At a full receiver, flows wanting less than a fair share keep it.'''
+        self.assertDemands([('a', 'z'), ('a', 'w'), ('a', 'v'), ('b', 'z')],
+                           [1 / 3.0, 1 / 3.0, 1 / 3.0, 2 / 3.0])
+
+    def testFourHosts(self):
+        '''Oversubscribed receivers a and c settle b's and d's flows.'''
+        flows = [('a', 'b'), ('a', 'c'), ('a', 'd'),
+                 ('b', 'a'), ('b', 'c'),
+                 ('c', 'a'),
+                 ('d', 'c')]
+        self.assertDemands(flows, [1 / 3.0, 1 / 3.0, 1 / 3.0,
+                                   0.5, 1 / 3.0,
+                                   0.5,
+                                   1 / 3.0])
+
+    def testNicsNotOversubscribed(self):
+        '''No random demand matrix fills a NIC past its capacity.'''
+        rng = random.Random(5)
+        hosts = range(8)
+        for _ in xrange(50):
+            flows = [(rng.choice(hosts), rng.choice(hosts))
+                     for _ in xrange(rng.randrange(1, 30))]
+            demands = estimate_demands(flows)
+            sent = defaultdict(float)
+            received = defaultdict(float)
+            for (src, dst), demand in zip(flows, demands):
+                self.assertTrue(demand > 0)
+                sent[src] += demand
+                received[dst] += demand
+            for total in sent.values() + received.values():
+                self.assertTrue(total <= 1.0 + 1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+'''Test RipLController event handling against fake switch connections.'''
+
+import time
+import unittest
+
+from pox.core import core
+from pox.lib.revent import EventMixin
+from pox.lib.addresses import EthAddr, IPAddr
+from pox.lib.packet.ethernet import ethernet
+from pox.lib.packet.ipv4 import ipv4
+import pox.openflow.libopenflow_01 as of
+
+from ripl.dctopo import FatTreeTopo
+from ripl.routing import HashedStructuredRouting
+import riplpox.riplpox as riplpox
+from riplpox.compress import forwarding_tables
+
+
+class FakeOpenFlow(EventMixin):
+    '''Stands in for core.openflow; raises no events.'''
+
+
+class FakeConnection(object):
+    '''Records what a Switch sends.'''
+
+    def __init__(self, dpid):
+        self.dpid = dpid
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+class FakeTimer(object):
+    '''Keeps the controller's timers off the recoco scheduler.'''
+
+    def __init__(self, *args, **kw):
+        pass
+
+
+class FakePacketIn(object):
+    def __init__(self, connection, port, packet):
+        self.connection = connection
+        self.dpid = connection.dpid
+        self.port = port
+        self.parsed = packet
+        self.data = packet.pack()
+        self.ofp = of.ofp_packet_in(total_len=len(self.data))
+
+    def parse(self):
+        return self.parsed
+
+
+class ControllerTest(unittest.TestCase):
+    '''Base: a controller on a k=4 fat tree with every switch connected.'''
+
+    mode = 'reactive'
+    backup = False
+    compress_fabric = False
+
+    def setUp(self):
+        self.topo = FatTreeTopo(4, 1)
+        self.r = HashedStructuredRouting(self.topo)
+        core.register('openflow', FakeOpenFlow())
+        self._timer = riplpox.Timer
+        riplpox.Timer = FakeTimer
+        self.c = riplpox.RipLController(self.topo, self.r, self.mode,
+                                        backup=self.backup,
+                                        compress_fabric=self.compress_fabric)
+        core.register('RipLController', self.c)
+        for name in self.topo.switches():
+            dpid = self.topo.id_gen(name=name).dpid
+            sw = riplpox.Switch()
+            sw.dpid = dpid
+            sw.connection = FakeConnection(dpid)
+            self.c.switches[dpid] = sw
+
+    def tearDown(self):
+        riplpox.Timer = self._timer
+        del core.components['openflow']
+        del core.components['RipLController']
+
+    def dpid(self, name):
+        return self.topo.id_gen(name=name).dpid
+
+    def sent(self, name):
+        return self.c.switches[self.dpid(name)].connection.sent
+
+    def packet_in(self, src, dst):
+        '''Return a packet-in of an IP packet from host src to host dst.'''
+        ids = [self.topo.id_gen(name=h) for h in (src, dst)]
+        ip = ipv4(srcip=IPAddr(ids[0].ip_str()), dstip=IPAddr(ids[1].ip_str()))
+        ip.protocol = 253
+        eth = ethernet(src=EthAddr(ids[0].mac_str()),
+                       dst=EthAddr(ids[1].mac_str()), type=ethernet.IP_TYPE)
+        eth.payload = ip
+        edge = self.topo.g[src].keys()[0]
+        port = self.topo.port(edge, src)[0]
+        return FakePacketIn(self.c.switches[self.dpid(edge)].connection,
+                            port, eth)
+
+
+class testProactiveReplay(ControllerTest):
+    '''Packet-ins held until startup are forwarded, not raised on.'''
+
+    mode = 'proactive'
+
+    def testKnownUnicastResent(self):
+        hosts = sorted(self.topo.hosts())
+        event = self.packet_in(hosts[0], hosts[-1])
+        self.c.early_packets.push(event)
+        self.c.early_packets.push(self.packet_in(hosts[0], hosts[-2]))
+        self.c.all_switches_up = True
+        self.c._replay_early_packets()
+        stats = self.c.early_packets.stats
+        self.assertEqual(stats['resent'], 2)
+        self.assertEqual(stats['replayed'], 2)
+        sent = event.connection.sent
+        # One barrier, then each packet through the table
+        self.assertTrue(isinstance(sent[0], of.ofp_barrier_request))
+        self.assertEqual(len(sent), 3)
+        for msg in sent[1:]:
+            self.assertEqual(msg.actions[0].port, of.OFPP_TABLE)
+        self.assertEqual(sent[1].in_port, event.port)
+        self.assertEqual(sent[1].data, event.data)
+
+    def testUnknownUnicastDropped(self):
+        hosts = sorted(self.topo.hosts())
+        event = self.packet_in(hosts[0], hosts[-1])
+        event.parsed.dst = EthAddr('12:34:56:78:9a:bc')
+        self.c.early_packets.push(event)
+        self.c._replay_early_packets()
+        self.assertEqual(self.c.early_packets.stats['unroutable'], 1)
+        self.assertEqual(event.connection.sent, [])
+
+
+class testBackupFailover(ControllerTest):
+    '''Failing over rewrites every primary entry the backup must override.'''
+
+    backup = True
+
+    def testSharedSwitchesRewritten(self):
+        match = of.ofp_match(dl_type=ethernet.IP_TYPE,
+                             nw_dst=IPAddr('10.1.0.2'))
+        port = self.topo.port('se11', 'h5')[0]
+        flow = riplpox.InstalledFlow(match,
+                                     ['se7', 'sa5', 'sc1', 'sa9', 'se11'],
+                                     port, 0)
+        # Link-disjoint, but it crosses sa5 and sa9 on other ports.
+        flow.backup = ['se7', 'sa6', 'se8', 'sa5', 'sc2', 'sa9', 'se12',
+                       'sa10', 'se11']
+        self.c._add_flow(flow)
+        self.c._link_down(('sa5', 'sc1'), time.time())
+        expected = [('sa9', 'se12'), ('sa5', 'sc2'), ('se7', 'sa6')]
+        mods = []
+        for name, next_node in expected:
+            sent = self.sent(name)
+            self.assertEqual(len(sent), 2)
+            self.assertEqual(sent[0].command, of.OFPFC_MODIFY_STRICT)
+            self.assertEqual(sent[0].actions[0].port,
+                             self.topo.port(name, next_node)[0])
+            self.assertTrue(isinstance(sent[1], of.ofp_barrier_request))
+            mods.append(sent[0].xid)
+        # Downstream first
+        self.assertEqual(mods, sorted(mods))
+        # The egress already forwards to the host
+        self.assertEqual(self.sent('se11'), [])
+        self.assertEqual(self.c.flows[riplpox.flow_key(match)].route,
+                         flow.route)
+        self.assertEqual(len(self.c.pending_xids), 3)
+
+    def testUnansweredBarriersExpire(self):
+        match = of.ofp_match(dl_type=ethernet.IP_TYPE,
+                             nw_dst=IPAddr('10.1.0.2'))
+        flow = riplpox.InstalledFlow(match, ['se7', 'sa5', 'se8'], 1, 0)
+        flow.backup = ['se7', 'sa6', 'se8']
+        self.c._add_flow(flow)
+        self.c._link_down(('se7', 'sa5'), time.time())
+        self.assertEqual(len(self.c.pending_xids), 1)
+        self.c._expire_pending_setups()
+        self.assertEqual(len(self.c.pending_xids), 1)
+        self.c.pending_xids.values()[0].expires_at = 0
+        self.c._expire_pending_setups()
+        self.assertEqual(self.c.pending_xids, {})
+
+
+class testHybridBackup(ControllerTest):
+    '''Backup entries never shadow the fabric entries a flow uses.'''
+
+    mode = 'hybrid'
+    backup = True
+
+    def testNoBackupEntriesOnFabricRoute(self):
+        self.c._install_fabric_flows()
+        for sw in self.c.switches.itervalues():
+            del sw.connection.sent[:]
+        event = self.packet_in('h1', 'h5')
+        match = of.ofp_match.from_packet(event.parsed, event.port)
+        setup = riplpox.PendingSetup('key', None)
+        self.c.pending_setups[setup.key] = setup
+        # Past the ingress, the flow follows sa5's fabric route to se11.
+        # The backup crosses sa5 and sa9 on other ports.
+        fabric = self.c.fabric_routes[('sa5', 'se11')]
+        other = [c for c in ('sc1', 'sc2') if c not in fabric][0]
+        backup = ['se7', 'sa6', 'se8', 'sa5', other, 'sa9', 'se12', 'sa10',
+                  'se11']
+        self.c._setup_route(setup, event, match, self.dpid('se11'),
+                            self.topo.port('se11', 'h5')[0], 0,
+                            ['se7'] + fabric, backup)
+        flow = self.c.flows[riplpox.flow_key(match)]
+        self.assertEqual(flow.route, ['se7'] + fabric)
+        self.assertEqual(flow.backup, backup)
+        backup_at = []
+        for name in self.topo.switches():
+            for msg in self.sent(name):
+                if isinstance(msg, of.ofp_flow_mod) and \
+                        msg.priority == riplpox.BACKUP_PRIORITY:
+                    backup_at.append(name)
+        self.assertEqual(sorted(backup_at),
+                         sorted(['sa6', 'se8', other, 'se12', 'sa10']))
+        # Failing over puts per-flow entries over the fabric ones
+        self.c._link_down(('sa5', fabric[1]), time.time())
+        msg = self.sent('sa5')[-2]
+        self.assertEqual(msg.command, of.OFPFC_MODIFY_STRICT)
+        self.assertEqual(msg.priority, of.OFP_DEFAULT_PRIORITY)
+        self.assertEqual(msg.actions[0].port, self.topo.port('sa5', other)[0])
+
+
+class testCompressedFabric(ControllerTest):
+    '''Hybrid mode compresses the tables compress_tables.py reports on.'''
+
+    mode = 'hybrid'
+    compress_fabric = True
+
+    def testSameTablesAsReport(self):
+        installed = {}
+
+        def record(dpid, table):
+            installed[dpid] = table
+            return 0
+        self.c._install_compressed = record
+        self.c._install_fabric_flows()
+        expected = dict((self.dpid(name), table) for name, table in
+                        forwarding_tables(self.topo, self.r).iteritems())
+        self.assertEqual(installed, expected)
+
+
+class FakeLatency(object):
+    '''Stands in for core.SetupLatency; records keys.'''
+
+    def __init__(self):
+        self.records = []  # (source, stage, path length)
+
+    def record(self, source, stage, seconds, path_len=0):
+        self.records.append((source, stage, path_len))
+
+
+class FakeBarrierIn(object):
+    def __init__(self, dpid, xid):
+        self.dpid = dpid
+        self.xid = xid
+
+
+class testHostLocations(ControllerTest):
+    '''Topology hosts come from the topology; others are learned.'''
+
+    def other_host(self, edge, port, mac='02:00:00:00:00:01'):
+        '''Return a packet-in from a host outside the topology to h5.'''
+        event = self.packet_in('h1', 'h5')
+        event.parsed.src = EthAddr(mac)
+        return FakePacketIn(self.c.switches[self.dpid(edge)].connection,
+                            port, event.parsed)
+
+    def testHostIndex(self):
+        index = self.c.host_locations
+        self.assertEqual(len(index), len(self.topo.hosts()))
+        for h in self.topo.hosts():
+            edge = self.topo.g[h].keys()[0]
+            mac = EthAddr(self.topo.id_gen(name=h).mac_str())
+            self.assertEqual(index[mac], (self.dpid(edge),
+                                          self.topo.port(edge, h)[0], h))
+
+    def testTopologyHostsNotLearned(self):
+        event = self.packet_in('h1', 'h5')
+        event.port = self.topo.port('se7', 'sa5')[0]
+        self.c._handle_packet(event, time.time())
+        self.assertEqual(self.c.macTable, {})
+        self.assertEqual(self.c.host_moves, 0)
+
+    def testMoves(self):
+        mac = EthAddr('02:00:00:00:00:01')
+        port = self.topo.port('se7', 'h1')[0]
+        self.c._handle_packet(self.other_host('se7', port), time.time())
+        self.assertEqual(self.c.macTable, {mac: (self.dpid('se7'), port)})
+        # Seen again where it was isn't a move
+        self.c._handle_packet(self.other_host('se7', port), time.time())
+        self.assertEqual(self.c.host_moves, 0)
+        other_port = self.topo.port('se12', 'h8')[0]
+        self.c._handle_packet(self.other_host('se12', other_port),
+                              time.time())
+        self.assertEqual(self.c.host_moves, 1)
+        self.assertEqual(self.c.macTable[mac],
+                         (self.dpid('se12'), other_port))
+
+    def testSwitchPortsNotLearned(self):
+        '''Downstream packet-ins of a partial path aren't moves.'''
+        port = self.topo.port('se7', 'h1')[0]
+        self.c._handle_packet(self.other_host('se7', port), time.time())
+        for node, next_node in (('sa5', 'se7'), ('sc1', 'sa5'),
+                                ('se7', 'sa5')):
+            in_port = self.topo.port(node, next_node)[0]
+            self.c._handle_packet(self.other_host(node, in_port),
+                                  time.time())
+        self.assertEqual(self.c.host_moves, 0)
+        self.assertEqual(self.c.macTable.values(), [(self.dpid('se7'), port)])
+
+
+class testSetupLatency(ControllerTest):
+    '''A reactive setup reports each stage, keyed by route length.'''
+
+    def testStagesByRouteLength(self):
+        self.c.latency = FakeLatency()
+        event = self.packet_in('h1', 'h5')
+        self.c._handle_packet(event, time.time())
+        setup = self.c.pending_setups.values()[0]
+        n = len(setup.route)
+        self.assertEqual(n, 5)
+        self.assertEqual(self.c.latency.records, [])
+        for dpid, xid in sorted(setup.xids):
+            self.c._handle_BarrierIn(FakeBarrierIn(dpid, xid))
+        records = self.c.latency.records
+        self.assertEqual(records[:n], [('riplpox', 'barrier', n)] * n)
+        self.assertEqual(sorted(records[n:]),
+                         [('riplpox', stage, n) for stage in
+                          ('install', 'parse', 'route', 'total')])
+        self.assertEqual(self.c.pending_setups, {})
+
+
+class testDuplicateSetups(ControllerTest):
+    '''Packet-ins of a flow being set up don't set it up again.'''
+
+    def testCollapsed(self):
+        first = self.packet_in('h1', 'h5')
+        second = self.packet_in('h1', 'h5')
+        second.parsed.payload.payload = 'second'
+        second.data = second.parsed.pack()
+        self.c._handle_packet(first, time.time())
+        sent = dict((name, len(self.sent(name)))
+                    for name in self.topo.switches())
+        self.assertEqual(len(self.c.pending_setups), 1)
+        setup = self.c.pending_setups.values()[0]
+        self.c._handle_packet(second, time.time())
+        # Only the second packet went out, at the egress
+        for name in self.topo.switches():
+            if name != 'se11':
+                self.assertEqual(len(self.sent(name)), sent[name])
+        msgs = self.sent('se11')[sent['se11']:]
+        self.assertEqual(len(msgs), 1)
+        self.assertTrue(isinstance(msgs[0], of.ofp_packet_out))
+        self.assertEqual(msgs[0].data, second.data)
+        self.assertEqual(msgs[0].actions[0].port,
+                         self.topo.port('se11', 'h5')[0])
+        self.assertEqual(setup.suppressed, 1)
+        self.assertEqual(self.c.setup_stats['suppressed'], 1)
+        self.assertEqual(self.c.setup_stats['installed'], 1)
+        # Cleared once every barrier is back
+        for dpid, xid in sorted(setup.xids):
+            self.assertEqual(len(self.c.pending_setups), 1)
+            self.c._handle_BarrierIn(FakeBarrierIn(dpid, xid))
+        self.assertEqual(self.c.pending_setups, {})
+        self.assertEqual(self.c.pending_xids, {})
+        self.assertEqual(self.c.setup_stats['completed'], 1)
+        # A later packet-in of the flow sets it up anew
+        self.c._handle_packet(second, time.time())
+        self.assertEqual(self.c.setup_stats['installed'], 2)
+
+    def testOtherEgressNotCollapsed(self):
+        self.c._handle_packet(self.packet_in('h1', 'h5'), time.time())
+        self.c._handle_packet(self.packet_in('h1', 'h6'), time.time())
+        self.assertEqual(len(self.c.pending_setups), 2)
+        self.assertEqual(self.c.setup_stats['suppressed'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+'''Test the breadth-first fallback routes of RoutePool.'''
+
+import unittest
+
+from mininet.topo import Topo
+from ripl.dctopo import FatTreeTopo, BCubeTopo
+from ripl.routing import HashedStructuredRouting, BCSinglePathRouting
+import riplpox.routepool as routepool
+
+
+class FakeTimer(object):
+    '''Keeps the pool's deadline check off the recoco scheduler.'''
+
+    def __init__(self, *args, **kw):
+        pass
+
+
+class FakeRouting(object):
+    '''Just the down links, for topologies no engine routes.'''
+
+    def __init__(self):
+        self.down_links = set()
+
+
+class FallbackTest(unittest.TestCase):
+    def setUp(self):
+        self._timer = routepool.Timer
+        routepool.Timer = FakeTimer
+
+    def tearDown(self):
+        routepool.Timer = self._timer
+
+    def check_route(self, t, r, route, src, dst):
+        self.assertEqual(route[0], src)
+        self.assertEqual(route[-1], dst)
+        for a, b in zip(route[:-1], route[1:]):
+            self.assertTrue(b in t.g[a])
+            self.assertFalse((a, b) in r.down_links)
+
+
+class testFatTree(FallbackTest):
+    def testShortest(self):
+        t = FatTreeTopo(4, 1)
+        r = HashedStructuredRouting(t)
+        pool = routepool.RoutePool(t, r, 0)
+        edges = sorted(t.layer_nodes(FatTreeTopo.LAYER_EDGE))
+        for dst in edges[1:]:
+            route = pool.fallback_route(edges[0], dst)
+            self.check_route(t, r, route, edges[0], dst)
+            self.assertEqual(len(route), len(r.get_route(edges[0], dst, 0)))
+            for node in route:
+                self.assertTrue(node in t.switches())
+
+    def testAvoidsDownLink(self):
+        t = FatTreeTopo(4, 1)
+        r = HashedStructuredRouting(t)
+        pool = routepool.RoutePool(t, r, 0)
+        edges = sorted(t.layer_nodes(FatTreeTopo.LAYER_EDGE))
+        route = pool.fallback_route(edges[0], edges[-1])
+        r.set_link_down(route[1], route[2])
+        new_route = pool.fallback_route(edges[0], edges[-1])
+        self.check_route(t, r, new_route, edges[0], edges[-1])
+        self.assertEqual(len(new_route), len(route))
+
+
+class testBCube(FallbackTest):
+    '''Fallback routes relay through servers as BCube routes do.'''
+
+    def check(self, k, n):
+        t = BCubeTopo(k, n)
+        r = BCSinglePathRouting(t)
+        pool = routepool.RoutePool(t, r, 0)
+        relays = sorted(s for s in t.switches()
+                        if any(h in t.hosts() for h in t.g[s]))
+        for dst in relays[1:]:
+            route = pool.fallback_route(relays[0], dst)
+            self.check_route(t, r, route, relays[0], dst)
+            self.assertEqual(len(route), len(r.get_route(relays[0], dst, 0)))
+        # Losing the first hop of a route that needs a relay
+        dst = relays[-1]
+        route = pool.fallback_route(relays[0], dst)
+        self.assertTrue(len(route) > 3)
+        r.set_link_down(route[0], route[1])
+        new_route = pool.fallback_route(relays[0], dst)
+        self.check_route(t, r, new_route, relays[0], dst)
+        self.assertNotEqual(new_route[1], route[1])
+
+    def testBCube14(self):
+        self.check(1, 4)
+
+    def testBCube23(self):
+        self.check(2, 3)
+
+
+class testRelayHosts(FallbackTest):
+    def setUp(self):
+        FallbackTest.setUp(self)
+        # s1 and s2 are joined only through a dual-homed host
+        self.t = Topo()
+        for name in ('s1', 's2'):
+            self.t.addSwitch(name)
+        for name in ('relay', 'leaf'):
+            self.t.addHost(name)
+        self.t.addLink('s1', 'relay')
+        self.t.addLink('relay', 's2')
+        self.t.addLink('s1', 'leaf')
+        self.r = FakeRouting()
+        self.pool = routepool.RoutePool(self.t, self.r, 0)
+
+    def testThroughRelay(self):
+        self.assertEqual(self.pool.fallback_route('s1', 's2'),
+                         ['s1', 'relay', 's2'])
+
+    def testLeavesSkipped(self):
+        '''Single-homed hosts are never searched.'''
+        self.assertEqual(self.pool.fallback_route('s2', 'leaf'), None)
+        self.r.down_links.add(('relay', 's2'))
+        self.assertEqual(self.pool.fallback_route('s1', 's2'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+'''Test how switches are split among shards.'''
+
+import unittest
+from collections import defaultdict
+
+from ripl.dctopo import FatTreeTopo, BCubeTopo
+from riplpox.shard import shard_of
+
+
+def owners(topo, shards):
+    '''Return [shard] -> set of switch names it owns.'''
+    owned = defaultdict(set)
+    for name in topo.switches():
+        owned[shard_of(topo, name, shards)].add(name)
+    return owned
+
+
+class ShardTest(unittest.TestCase):
+    def check_partition(self, topo, shards):
+        '''Every switch is owned by exactly one valid shard, and all shards
+        own some.'''
+        owned = owners(topo, shards)
+        self.assertEqual(sorted(owned), range(shards))
+        names = [n for members in owned.itervalues() for n in members]
+        self.assertEqual(sorted(names), sorted(topo.switches()))
+        return owned
+
+
+class testFatTree(ShardTest):
+    '''Fat trees split by pod, with core switches dealt round-robin.'''
+
+    def pods(self, topo):
+        '''Return the sets of edge and aggregation switches in each pod.'''
+        aggs = topo.layer_nodes(FatTreeTopo.LAYER_AGG)
+        pods = []
+        for agg in sorted(aggs):
+            edges = set(n for n in topo.g[agg]
+                        if topo.layer(n) == FatTreeTopo.LAYER_EDGE)
+            for pod in pods:
+                if pod & edges:
+                    pod.add(agg)
+                    break
+            else:
+                pods.append(set([agg]) | edges)
+        return pods
+
+    def check(self, k, r=1):
+        topo = FatTreeTopo(k, r)
+        pods = self.pods(topo)
+        self.assertEqual(len(pods), k)
+        cores = topo.layer_nodes(FatTreeTopo.LAYER_CORE)
+        for shards in xrange(1, k + 1):
+            owned = self.check_partition(topo, shards)
+            for pod in pods:
+                self.assertEqual(len(set(shard_of(topo, n, shards)
+                                         for n in pod)), 1)
+            # Pods and cores are dealt out evenly
+            pod_counts = [sum(1 for pod in pods if pod <= owned[s])
+                          for s in xrange(shards)]
+            self.assertTrue(max(pod_counts) - min(pod_counts) <= 1)
+            core_counts = [len(owned[s] & set(cores))
+                           for s in xrange(shards)]
+            self.assertTrue(max(core_counts) - min(core_counts) <= 1)
+
+    def testK4(self):
+        self.check(4)
+
+    def testK6(self):
+        self.check(6)
+
+    def testK8(self):
+        self.check(8)
+
+    def testOversubscribed(self):
+        '''Fewer core switches shift the pod numbering.'''
+        self.check(8, 2)
+
+    def testOneShard(self):
+        topo = FatTreeTopo(4)
+        self.assertEqual(owners(topo, 1).keys(), [0])
+
+
+class testBCube(ShardTest):
+    '''Other topologies split their sorted switches round-robin.'''
+
+    def testBCube(self):
+        for k, n in ((1, 4), (2, 3), (1, 2)):
+            topo = BCubeTopo(k, n)
+            for shards in xrange(1, 6):
+                owned = self.check_partition(topo, shards)
+                sizes = [len(owned[s]) for s in xrange(shards)]
+                self.assertTrue(max(sizes) - min(sizes) <= 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
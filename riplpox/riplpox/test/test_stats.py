@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+'''Test that the statistics service keeps to its request budget.'''
+
+import unittest
+
+from pox.core import core
+from pox.lib.revent import EventMixin
+import pox.openflow.libopenflow_01 as of
+
+import riplpox.stats as stats
+
+
+class FakeClock(object):
+    '''Stands in for the time module.'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class FakeTimer(object):
+    '''Keeps the service's tick off the recoco scheduler.'''
+
+    def __init__(self, *args, **kw):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, dpid, log):
+        self.dpid = dpid
+        self.log = log
+
+    def send(self, msg):
+        self.log.append((self.dpid, msg))
+
+
+class FakeOpenFlow(EventMixin):
+    '''Stands in for core.openflow; every switch is connected.'''
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = []  # (time, dpid, msg)
+        self.down = set()
+
+    def getConnection(self, dpid):
+        if dpid in self.down:
+            return None
+        return FakeConnection(dpid, self)
+
+    def append(self, entry):
+        self.sent.append((self.clock.now,) + entry)
+
+
+class testBudget(unittest.TestCase):
+    '''Stats requests never exceed the budget, however much is watched.'''
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self._time = stats.time
+        self._timer = stats.Timer
+        stats.time = self.clock
+        stats.Timer = FakeTimer
+        self.of = FakeOpenFlow(self.clock)
+        core.register('openflow', self.of)
+
+    def tearDown(self):
+        stats.time = self._time
+        stats.Timer = self._timer
+        del core.components['openflow']
+
+    def run_for(self, service, seconds):
+        '''Tick the service every TICK seconds for a while.'''
+        for _ in xrange(int(round(seconds / stats.TICK))):
+            self.clock.now += stats.TICK
+            service._tick()
+
+    def testOverBudget(self):
+        '''100 switches at 1 s want 100 requests/s; 10 are allowed.'''
+        service = stats.StatsService(min_interval=1, max_interval=1,
+                                     budget=10)
+        for dpid in xrange(1, 101):
+            service.watch(dpid, stats.PORT)
+        self.assertEqual(service.request_rate(), 100)
+        start = self.clock.now
+        self.run_for(service, 20)
+        times = [t for t, dpid, msg in self.of.sent]
+        # A full bucket to start with, then the refill rate
+        self.assertTrue(len(times) <= 10 + 10 * 20)
+        self.assertTrue(len(times) >= 10 * 20 - 1)
+        for second in xrange(1, 20):
+            window = [t for t in times if start + second <= t <
+                      start + second + 1]
+            self.assertTrue(len(window) <= 11)
+        self.assertEqual(service.stats['requests'], len(times))
+        self.assertTrue(service.stats['deferred'] > 0)
+        # Deferred switches are polled in turn, not starved
+        self.assertEqual(len(set(dpid for t, dpid, msg in self.of.sent)),
+                         100)
+
+    def testUnderBudget(self):
+        '''Within the budget, every switch is polled at its interval.'''
+        service = stats.StatsService(min_interval=2, max_interval=2,
+                                     budget=50)
+        for dpid in xrange(1, 11):
+            service.watch(dpid, stats.PORT)
+            service.watch(dpid, stats.FLOW)
+        self.run_for(service, 10)
+        self.assertEqual(service.stats['deferred'], 0)
+        polls = {}
+        for t, dpid, msg in self.of.sent:
+            polls.setdefault((dpid, msg.body.__class__), []).append(t)
+        self.assertEqual(len(polls), 20)
+        for times in polls.itervalues():
+            self.assertTrue(len(times) in (4, 5))
+            for a, b in zip(times[:-1], times[1:]):
+                self.assertAlmostEqual(b - a, 2, places=5)
+
+    def testDisconnectedSwitchCostsNothing(self):
+        service = stats.StatsService(min_interval=1, budget=1)
+        service.watch(1, stats.PORT)
+        service.watch(2, stats.PORT)
+        self.of.down.add(1)
+        self.run_for(service, 5)
+        self.assertEqual(set(dpid for t, dpid, msg in self.of.sent), set([2]))
+        self.assertEqual(len(self.of.sent), 5)
+
+    def testBudgetChange(self):
+        '''A budget changed at launch applies from the next tick.'''
+        service = stats.StatsService(min_interval=1, max_interval=1,
+                                     budget=50)
+        service.budget = 2.0
+        for dpid in xrange(1, 51):
+            service.watch(dpid, stats.FLOW)
+        self.run_for(service, 10)
+        # The bucket filled for the old budget is capped at the new one
+        self.assertTrue(len(self.of.sent) <= 2 + 2 * 10)
+        for t, dpid, msg in self.of.sent:
+            self.assertTrue(isinstance(msg.body, of.ofp_flow_stats_request))
+
+
+if __name__ == '__main__':
+    unittest.main()
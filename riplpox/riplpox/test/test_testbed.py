@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+'''Test TestBedController's discovered port map and its cache.'''
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pox.core import core
+from pox.lib.revent import EventMixin
+from pox.lib.addresses import EthAddr, IPAddr
+from pox.lib.packet.ethernet import ethernet
+from pox.lib.packet.ipv4 import ipv4
+from pox.lib.util import dpid_to_str
+from pox.openflow.discovery import Discovery, LinkEvent
+import pox.openflow.libopenflow_01 as of
+
+from ripl.dctopo import TestBedTopo
+import riplpox.TestBedController as testbed
+
+
+class FakeOpenFlow(EventMixin):
+    '''Stands in for core.openflow; raises no events.'''
+
+
+class FakeConnection(object):
+    def __init__(self, dpid):
+        self.dpid = dpid
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+class FakeRouting(object):
+    '''Routes every pair along one fixed route.'''
+
+    def __init__(self, route):
+        self.route = route
+
+    def get_route(self, src, dst, hash_):
+        return self.route
+
+
+class FakePacketIn(object):
+    def __init__(self, connection, port, packet):
+        self.connection = connection
+        self.dpid = connection.dpid
+        self.port = port
+        self.parsed = packet
+        self.data = packet.pack()
+
+
+def dpid(name):
+    '''A testbed DPID that _dpidToStr names name.'''
+    digit = dict((n, d) for d, n in testbed.SWITCH_NAMES.iteritems())[name]
+    return ((20 + digit) << 48) | 0xf0921c22cac0
+
+
+ROUTE = ['se5', 'sa3', 'sc1', 'sa7', 'se10']
+
+
+class TestBedTest(unittest.TestCase):
+    def setUp(self):
+        core.register('openflow', FakeOpenFlow())
+        self.dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.dir, 'ports.json')
+        self.topo = TestBedTopo()
+
+    def tearDown(self):
+        del core.components['openflow']
+        shutil.rmtree(self.dir)
+
+    def controller(self, port_cache=None):
+        if port_cache is None:
+            port_cache = self.cache
+        return testbed.TestBedController(self.topo, FakeRouting(ROUTE),
+                                         'reactive', port_cache)
+
+    def link(self, c, name1, name2, port1, port2, added=True):
+        '''Report the link from name1 to name2.'''
+        l = Discovery.Link(dpid(name1), port1, dpid(name2), port2)
+        c._handle_LinkEvent(LinkEvent(added, l))
+
+    def write_cache(self, text):
+        f = open(self.cache, 'w')
+        f.write(text)
+        f.close()
+
+    def read_cache(self):
+        f = open(self.cache)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+
+class testPortCache(TestBedTest):
+    def testRoundTrip(self):
+        c = self.controller()
+        self.link(c, 'sc1', 'sa3', 1, 2)
+        self.link(c, 'sa3', 'sc1', 2, 1)
+        self.link(c, 'se10', 'sa7', 5, 9)
+        # Nothing is saved until discovery has checked the cache
+        self.assertFalse(os.path.exists(self.cache))
+        c._verify_ports()
+        cache = self.read_cache()
+        # Keyed by DPID, including the part above the MAC
+        self.assertEqual(cache[dpid_to_str(dpid('se10'))],
+                         {dpid_to_str(dpid('sa7')): [5, 9]})
+        self.assertTrue('|' in dpid_to_str(dpid('se10')))
+        c2 = self.controller()
+        self.assertEqual(c2.links, c.links)
+        self.assertEqual(c2.portsMap['sc1']['sa3'], (1, 2))
+        self.assertEqual(c2.portsMap['se10']['sa7'], (5, 9))
+        self.assertEqual(c2._getports('sa7', 'se10'), None)
+        self.assertFalse(c2.verified)
+
+    def testNoCache(self):
+        c = self.controller(port_cache='')
+        self.link(c, 'sc1', 'sa3', 1, 2)
+        c._verify_ports()
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def testCorruptIgnored(self):
+        for text in ('{"00-00', '[1, 2]', '{"sc1": 5}',
+                     '{"00-00-00-00-00-01": {"00-00-00-00-00-02": 3}}'):
+            self.write_cache(text)
+            self.assertEqual(self.controller().links, {})
+
+    def testUnreadableIgnored(self):
+        os.mkdir(self.cache)
+        self.assertEqual(self.controller().links, {})
+
+    def testUnknownSwitchIgnored(self):
+        c = self.controller()
+        self.link(c, 'sc1', 'sa3', 1, 2)
+        c._verify_ports()
+        cache = self.read_cache()
+        cache['00-00-00-00-00-07'] = {dpid_to_str(dpid('sa3')): [3, 4]}
+        self.write_cache(json.dumps(cache))
+        self.assertEqual(self.controller().links.keys(),
+                         [(dpid('sc1'), dpid('sa3'))])
+
+
+class testDiscovery(TestBedTest):
+    def testMovedPortOverwrites(self):
+        c = self.controller()
+        self.link(c, 'sc1', 'sa3', 1, 2)
+        c._verify_ports()
+        self.link(c, 'sc1', 'sa3', 3, 4)
+        self.assertEqual(c.links[(dpid('sc1'), dpid('sa3'))], (3, 4))
+        self.assertEqual(c._getports('sc1', 'sa3'), (3, 4))
+        # Once verified, every change is saved
+        self.assertEqual(self.read_cache(),
+                         {dpid_to_str(dpid('sc1')):
+                          {dpid_to_str(dpid('sa3')): [3, 4]}})
+        self.assertEqual(self.controller()._getports('sc1', 'sa3'), (3, 4))
+
+    def testRemovedLinkDropped(self):
+        c = self.controller()
+        self.link(c, 'sc1', 'sa3', 1, 2)
+        self.link(c, 'sc1', 'sa3', 1, 2, added=False)
+        self.assertEqual(c.links, {})
+        self.assertEqual(c._getports('sc1', 'sa3'), None)
+
+    def testStaleCachedLinksDropped(self):
+        c = self.controller()
+        for name1, name2 in (('sc1', 'sa3'), ('sc2', 'sa4'), ('sa7', 'se9')):
+            self.link(c, name1, name2, 1, 2)
+        c._verify_ports()
+        # After a restart discovery finds only one of the cached links
+        c2 = self.controller()
+        self.assertEqual(len(c2.links), 3)
+        self.link(c2, 'sc2', 'sa4', 1, 2)
+        c2._verify_ports()
+        self.assertTrue(c2.verified)
+        self.assertEqual(c2.links.keys(), [(dpid('sc2'), dpid('sa4'))])
+        self.assertEqual(c2._getports('sc1', 'sa3'), None)
+        self.assertEqual(self.read_cache().keys(),
+                         [dpid_to_str(dpid('sc2'))])
+
+
+class testReactive(TestBedTest):
+    def setUp(self):
+        TestBedTest.setUp(self)
+        self.c = self.controller()
+        for name in self.topo.switches():
+            sw = testbed.Switch()
+            sw.dpid = dpid(name)
+            sw.connection = FakeConnection(sw.dpid)
+            self.c.switches[name] = sw
+        self.c.all_switches_up = True
+        for name1, name2 in zip(ROUTE[:-1], ROUTE[1:]):
+            self.link(self.c, name1, name2, 1, 2)
+        self.dst = EthAddr('00:00:00:00:00:02')
+        self.c.macTable[self.dst] = ('se10', 5)
+
+    def packet_in(self):
+        ip = ipv4(srcip=IPAddr('10.0.0.1'), dstip=IPAddr('10.0.0.2'))
+        ip.protocol = 253
+        eth = ethernet(src=EthAddr('00:00:00:00:00:01'), dst=self.dst,
+                       type=ethernet.IP_TYPE)
+        eth.payload = ip
+        return FakePacketIn(self.c.switches['se5'].connection, 25, eth)
+
+    def flow_mods(self):
+        return [(name, msg) for name, sw in self.c.switches.iteritems()
+                for msg in sw.connection.sent
+                if isinstance(msg, of.ofp_flow_mod)]
+
+    def testInstalled(self):
+        event = self.packet_in()
+        self.assertTrue(self.c._install_reactive_path(event, 'se10', 5,
+                                                      event.parsed))
+        self.assertEqual(sorted(name for name, msg in self.flow_mods()),
+                         sorted(ROUTE))
+
+    def testUnknownHopFloods(self):
+        self.link(self.c, 'sc1', 'sa7', 1, 2, added=False)
+        event = self.packet_in()
+        self.assertFalse(self.c._install_reactive_path(event, 'se10', 5,
+                                                       event.parsed))
+        self.assertEqual(self.flow_mods(), [])
+        self.c._handle_PacketIn(event)
+        self.assertEqual(self.flow_mods(), [])
+        # Flooded out of every edge switch's host ports
+        outs = [(name, msg.actions[0].port)
+                for name, sw in self.c.switches.iteritems()
+                for msg in sw.connection.sent
+                if isinstance(msg, of.ofp_packet_out)]
+        self.assertEqual(len(outs), 8)
+        self.assertEqual(set(name for name, port in outs),
+                         set(['se5', 'se6', 'se9', 'se10']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,7 +3,7 @@
 from mininet.util import makeNumeric
 
 from ripl.routing import STStructuredRouting, RandomStructuredRouting, HashedStructuredRouting
-from ripl.routing import BCSinglePathRouting
+from ripl.routing import BCSinglePathRouting, LoadAwareStructuredRouting
 
 
 # TODO: this code is duplicated from mininet/bin/mn, except for TOPOS/topos.
@@ -35,7 +35,8 @@ ROUTING = {
     'st': STStructuredRouting,
     'random': RandomStructuredRouting,
     'hashed': HashedStructuredRouting,
-    'spath': BCSinglePathRouting
+    'spath': BCSinglePathRouting,
+    'load': LoadAwareStructuredRouting
 }
 
 
@@ -46,4 +47,30 @@ def getRouting(routing_type, topo):
     if routing_type not in ROUTING:
         raise Exception("unknown routing type %s not in %s" % (routing_type,
                                                                ROUTING.keys()))
-    return ROUTING[routing_type](topo)
\ No newline at end of file
+    return ROUTING[routing_type](topo)
+
+
+def ip_prefixes(addrs):
+    """Return the fewest (network, prefix length) blocks covering addrs.
+
+    addrs are IPv4 addresses as unsigned ints; the blocks cover exactly
+    those addresses and no others.
+    """
+    blocks = []
+    addrs = sorted(set(addrs))
+    i = 0
+    while i < len(addrs):
+        # Find the run of consecutive addresses starting at addrs[i].
+        j = i
+        while j + 1 < len(addrs) and addrs[j + 1] == addrs[j] + 1:
+            j += 1
+        start, end = addrs[i], addrs[j]
+        while start <= end:
+            # Largest aligned block at start that stays within the run.
+            size = start & -start if start else 1 << 32
+            while size > end - start + 1:
+                size >>= 1
+            blocks.append((start, 33 - size.bit_length()))
+            start += size
+        i = j + 1
+    return blocks
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+'''Measure reactive flow setup throughput against sharded RipL-POX.
+
+For each shard count, this starts that many RipL-POX processes on this
+machine, each with its own OpenFlow port, and a Mininet network whose
+switches connect to the shard that owns them:
+
+  sudo python shard_bench.py --topo ft,4 --shards 1,2,4
+
+Every host then pings every other host once, all hosts at the same time.
+Each ping needs two new flows (request and reply), so the rate of
+successful pings measures how fast the controllers set up flows.  ARP is
+configured statically so only IP flows are counted.
+'''
+
+from optparse import OptionParser
+from os.path import expanduser
+from subprocess import Popen
+from time import sleep, time
+import re
+
+from mininet.net import Mininet
+from mininet.node import RemoteController
+from mininet.log import setLogLevel, info
+
+from ripl.mn import topos
+from riplpox.util import buildTopo
+from riplpox.shard import shard_of, DEF_BASE_PORT
+
+OF_PORT = 6633
+
+
+def start_shards(pox, topo, routing, shards):
+    "Start one RipL-POX process per shard; return the Popen objects."
+    procs = []
+    for i in xrange(shards):
+        procs.append(Popen([pox, 'log.level', '--WARNING',
+                            'riplpox.riplpox', '--topo=%s' % topo,
+                            '--routing=%s' % routing, '--mode=reactive',
+                            '--shard=%i' % i, '--shards=%i' % shards,
+                            '--shard_port=%i' % DEF_BASE_PORT,
+                            'openflow.of_01', '--port=%i' % (OF_PORT + i)]))
+    return procs
+
+
+def bench(topo, shards, settle):
+    '''Ping all pairs at once with the switches split between shards.
+
+    @param topo topology object, as used by RipL-POX
+    @param shards number of controller processes
+    @param settle seconds to wait for switches and shards to connect
+    @return (successful pings, seconds)
+    '''
+    net = Mininet(topo=topo, controller=None, autoSetMacs=True, build=False)
+    ctrls = [net.addController('c%i' % i, controller=RemoteController,
+                               port=OF_PORT + i) for i in xrange(shards)]
+    net.build()
+    for c in ctrls:
+        c.start()
+    for sw in net.switches:
+        sw.start([ctrls[shard_of(topo, sw.name, shards)]])
+    net.staticArp()
+    sleep(settle)
+    hosts = net.hosts
+    try:
+        start = time()
+        procs = []
+        for src in hosts:
+            dsts = ' '.join(h.IP() for h in hosts if h is not src)
+            procs.append(src.popen('for d in %s; do ping -c 1 -W 2 $d; done'
+                                   % dsts, shell=True))
+        ok = 0
+        for p in procs:
+            out, err = p.communicate()
+            ok += len(re.findall(r'1 received', out))
+        elapsed = time() - start
+    finally:
+        net.stop()
+    return ok, elapsed
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--topo', dest='topo', default='ft,4',
+                      help='topology, as passed to RipL-POX')
+    parser.add_option('--routing', dest='routing', default='hashed',
+                      help='routing, as passed to RipL-POX')
+    parser.add_option('--shards', dest='shards', default='1,2,4',
+                      help='comma-separated shard counts to compare')
+    parser.add_option('--pox', dest='pox', default='~/pox/pox.py',
+                      help='path to pox.py')
+    parser.add_option('--settle', dest='settle', type='float', default=5,
+                      help='seconds to let switches and shards connect')
+    options, args = parser.parse_args()
+
+    setLogLevel('info')
+    topo = buildTopo(options.topo, topos)
+    pairs = len(topo.hosts()) * (len(topo.hosts()) - 1)
+    for shards in [int(s) for s in options.shards.split(',')]:
+        procs = start_shards(expanduser(options.pox), options.topo,
+                             options.routing, shards)
+        try:
+            ok, elapsed = bench(topo, shards, options.settle)
+        finally:
+            for p in procs:
+                p.terminate()
+                p.wait()
+        info('%i shards: %i/%i pings in %.2f s, %.0f flow setups/s\n' %
+             (shards, ok, pairs, elapsed, 2 * ok / elapsed))
+
+
+if __name__ == '__main__':
+    main()